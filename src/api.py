@@ -2,20 +2,65 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
+import zlib
 
 import beanstalkc
-from flask import Blueprint, current_app, jsonify, g, request
+from flask import Blueprint, Response, current_app, jsonify, g, request
 
+import codec
 import config
+import deliveries
+import invalid_tokens
+from jobs import (
+    CollapseIndex, LaneBatchBuilder, check_badges, drop_invalid_tokens,
+    expand, iter_lines, priority_name, push_tube)
+import pool
+import queues
 
 
 api = Blueprint('api', __name__)
+beanstalk_pool = pool.BeanstalkPool(
+    config.BEANSTALKD_HOST, config.BEANSTALKD_PORT,
+    size=config.BEANSTALK_POOL_SIZE,
+    check_interval=config.BEANSTALK_POOL_CHECK_INTERVAL,
+    timeout=config.BEANSTALK_POOL_TIMEOUT)
+collapse_index = CollapseIndex(config.COLLAPSE_INDEX_SIZE)
 
 
 @api.before_request
 def before_request():
-    g.beanstalk = beanstalkc.Connection(
-        host=config.BEANSTALKD_HOST, port=config.BEANSTALKD_PORT)
+    try:
+        g.beanstalk = beanstalk_pool.get()
+    except (pool.PoolExhausted, beanstalkc.SocketError) as e:
+        current_app.logger.error('No beanstalk connection: %r', e)
+        return jsonify(dict(error='queue_unavailable')), 503
+
+
+@api.teardown_request
+def teardown_request(exception):
+    beanstalk = getattr(g, 'beanstalk', None)
+    if beanstalk is not None:
+        beanstalk_pool.put(
+            beanstalk,
+            broken=isinstance(exception, beanstalkc.SocketError))
+
+
+def _collapse(job, jid, tube):
+    """Deletes the queued job that job, put as jid in tube, supersedes"""
+    key = collapse_index.key(job)
+    if key is None:
+        return
+    superseded = collapse_index.replace(key, (jid, tube))
+    if superseded is not None:
+        queues.delete_queued(g.beanstalk, [superseded])
+
+
+def _put_batch(tube, body, priority):
+    if getattr(g, 'using', None) != tube:
+        g.beanstalk.use(tube)
+        g.using = tube
+    g.beanstalk.put(body, priority=priority)
 
 
 @api.route('/push', methods=['POST'])
@@ -27,20 +72,117 @@ def push_jobs():
                 error='unknown_app_name',
                 detail='Unknown app name %s' % job['app_name'])
             return jsonify(ret), 400
+        try:
+            check_badges(job)
+        except ValueError as e:
+            ret = dict(error='invalid_badges', detail=str(e))
+            return jsonify(ret), 400
+    # lets pushers tell the age of a job without a stats-job round trip
+    # and the delivery log the latency of its notifications
+    enqueued_at = round(time.time(), 3)
+    for job in jobs:
+        job['enqueued_at'] = enqueued_at
 
+    jobs, dropped = drop_invalid_tokens(jobs, invalid_tokens.get_store())
     if len(jobs) < 5:
         for job in jobs:
             if job['app_name'] not in config.APPS:
                 continue
-            g.beanstalk.use(config.PUSH_TUBE % job['app_name'])
-            priority = config.PRIORITIES.get(job.get('priority', 'low'))
+            tube = push_tube(job)
+            g.beanstalk.use(tube)
+            priority = config.PRIORITIES[priority_name(job)]
             delay = job.get('delay', 0)
-            g.beanstalk.put(json.dumps(job), priority=priority, delay=delay)
+            for chunk in expand(job):
+                jid = g.beanstalk.put(
+                    codec.encode(chunk), priority=priority, delay=delay)
+                _collapse(chunk, jid, tube)
     else:
-        g.beanstalk.use(config.BATCH_PUSH_TUBE)
-        g.beanstalk.put(json.dumps(jobs))
-    current_app.logger.info(jobs)
-    return jsonify(dict())
+        builder = LaneBatchBuilder(_put_batch, config.BATCH_JOB_MAX_BYTES)
+        for job in jobs:
+            builder.add(job)
+        builder.flush()
+    current_app.logger.info(
+        'Enqueued %d jobs, dropped %d invalid tokens', len(jobs), dropped)
+    return jsonify(dict(invalid_tokens=dropped))
+
+
+def _job_error(job):
+    if not isinstance(job, dict):
+        return 'invalid_job'
+    if job.get('app_name') not in config.APPS:
+        return 'unknown_app_name'
+    if not isinstance(job.get('payload'), dict):
+        return 'invalid_payload'
+    device_tokens = job.get('device_tokens')
+    if device_tokens is None and not job.get('device_token'):
+        return 'no_device_token'
+    if device_tokens is not None and not isinstance(device_tokens, list):
+        return 'invalid_device_tokens'
+    try:
+        check_badges(job)
+    except ValueError:
+        return 'invalid_badges'
+    collapse_key = job.get('collapse_key')
+    if collapse_key is not None and not isinstance(collapse_key, basestring):
+        return 'invalid_collapse_key'
+    return None
+
+
+@api.route('/push_stream', methods=['POST'])
+def push_stream():
+    """
+    Takes one push job per line (NDJSON), gzipped with Content-Encoding:
+    gzip, and enqueues them in batch jobs while the body is still being
+    read. Invalid lines are skipped and reported by line number.
+    """
+    store = invalid_tokens.get_store()
+    builder = LaneBatchBuilder(_put_batch, config.BATCH_JOB_MAX_BYTES)
+    gzipped = request.headers.get('Content-Encoding') == 'gzip'
+    lines = iter_lines(
+        request.stream, gzipped, max_length=config.STREAM_MAX_LINE_BYTES)
+    line_number = 0
+    rejected = 0
+    errors = []
+    dropped = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            if line is None:
+                error = 'line_too_long'
+            elif not line.strip():
+                continue
+            else:
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    error = 'invalid_json'
+                else:
+                    error = _job_error(job)
+            if error:
+                rejected += 1
+                if len(errors) < config.STREAM_MAX_ERRORS:
+                    errors.append(dict(line=line_number, error=error))
+                continue
+            # coarse, so that jobs share their interned extra fields
+            job['enqueued_at'] = round(time.time(), 1)
+            kept, count = drop_invalid_tokens([job], store)
+            dropped += count
+            for job in kept:
+                builder.add(job)
+    except zlib.error as e:
+        builder.flush()
+        ret = dict(
+            error='invalid_gzip',
+            detail='Failed to decompress after line %d: %s' % (
+                line_number, e),
+            jobs=builder.jobs)
+        return jsonify(ret), 400
+    builder.flush()
+    current_app.logger.info(
+        'Streamed %d jobs in %d batches, rejected %d lines',
+        builder.jobs, builder.batches, rejected)
+    return jsonify(dict(
+        jobs=builder.jobs, batches=builder.batches, rejected=rejected,
+        errors=errors, invalid_tokens=dropped))
 
 
 @api.route('/push_stats', methods=['GET'])
@@ -48,9 +190,51 @@ def push_stats():
     ret = g.beanstalk.stats()
     ret['tubes'] = []
     for app_name in config.APPS.keys():
-        try:
-            ret['tubes'].append(
-                g.beanstalk.stats_tube(config.PUSH_TUBE % app_name))
-        except beanstalkc.CommandFailed:
-            continue
+        for tube in (config.PUSH_FAST_TUBE, config.PUSH_TUBE):
+            try:
+                ret['tubes'].append(g.beanstalk.stats_tube(tube % app_name))
+            except beanstalkc.CommandFailed:
+                continue
     return jsonify(ret)
+
+
+@api.route('/invalid_tokens', methods=['GET'])
+def list_invalid_tokens():
+    store = invalid_tokens.get_store()
+    store.refresh()
+    if request.args.get('format') == 'text':
+        return Response(
+            (token + '\n' for token in store.tokens()),
+            mimetype='text/plain')
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 1000, type=int)
+    return jsonify(dict(
+        count=len(store), tokens=list(store.tokens(offset, limit))))
+
+
+@api.route('/deliveries', methods=['GET'])
+def delivery_stats():
+    """
+    Notifications sent and failed per minute, with enqueue to send
+    latency percentiles, of one app_name or all apps, over the last
+    minutes (60 by default). A failed notification doesn't count as
+    sent, see deliveries.summary.
+    """
+    if not config.DELIVERY_LOG_DIR:
+        ret = dict(
+            error='delivery_log_disabled',
+            detail='DELIVERY_LOG_DIR is not configured')
+        return jsonify(ret), 404
+    minutes = request.args.get('minutes', 60, type=int)
+    app_name = request.args.get('app_name')
+    if app_name is None:
+        app_names = sorted(config.APPS.keys())
+    elif app_name in config.APPS:
+        app_names = [app_name]
+    else:
+        ret = dict(
+            error='unknown_app_name',
+            detail='Unknown app name %s' % app_name)
+        return jsonify(ret), 400
+    return jsonify(dict(apps=[
+        deliveries.summary(app_name, minutes) for app_name in app_names]))
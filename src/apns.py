@@ -23,13 +23,33 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from binascii import a2b_hex
+from binascii import a2b_hex, b2a_hex
+from collections import OrderedDict, deque
 import json
 import logging
-from struct import pack, unpack
+from struct import Struct, unpack
+from threading import Lock
+import time
 
-from gevent import ssl, socket
+import gevent
+from gevent import select, ssl, socket
 
+# the HTTP/2 provider API is optional, the binary protocol needs neither
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+import metrics
+
+
+log = logging.getLogger('apns')
 
 ENHANCED_NOTIFICATION_COMMAND = 1
 ENHANCED_NOTIFICATION_FORMAT = (
@@ -44,6 +64,18 @@ ENHANCED_NOTIFICATION_FORMAT = (
 )
 MAX_PAYLOAD_LENGTH = 2048
 TOKEN_LENGTH = 32
+NOTIFICATION_HEADER = Struct(
+    '!'  # network big-endian
+    'B'  # command
+    'I'  # identifier
+    'I'  # expiry
+    'H'  # token length
+    '32s'  # token
+    'H'  # payload length
+)
+NOTIFICATION_IDENTIFIER = Struct('!I')
+NOTIFICATION_IDENTIFIER_OFFSET = 1
+INVALID_TOKEN_STATUS = 8
 ERROR_RESPONSE_LENGTH = 6
 ERROR_RESPONSE_FORMAT = (
     '!'  # network big-endian
@@ -51,47 +83,180 @@ ERROR_RESPONSE_FORMAT = (
     'B'  # status
     'I'  # identifier
 )
+# HTTP/2 reasons meaning the token will never be valid again
+INVALID_TOKEN_REASONS = ('BadDeviceToken', 'Unregistered')
+
+handshakes_total = metrics.counter(
+    'gateway_handshakes_total',
+    'Gateway connects, standby connections included', ('tube',))
+handshake_seconds_total = metrics.counter(
+    'gateway_handshake_seconds_total',
+    'Time spent in gateway connects, standby connections included',
+    ('tube',))
+standby_connects_total = metrics.counter(
+    'gateway_standby_connects_total',
+    'Connects that took a ready standby connection (hit) or not (miss)',
+    ('tube', 'result'))
+
+
+def is_ssl_timeout(e):
+    """
+    True for an SSLError meaning only that no application data was read
+    in time, as for TLS records like session tickets, rather than a
+    broken session
+    """
+    if e.errno in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+        return True
+    # gevent raises the timeouts of its ssl sockets without an errno
+    return e.errno is None and 'timed out' in str(e)
 
 
 class APNsConnection(object):
     """
     A generic connection class for communicating with the APNs
+
+    With standby, a second connection is handshaken in the background
+    after every connect, so that reconnect can swap it in at once. tube
+    labels the connect metrics.
     """
-    def __init__(self, cert_file=None, key_file=None):
+    alpn_protocols = None
+
+    def __init__(
+            self, cert_file=None, key_file=None, standby=False, tube=''):
         super(APNsConnection, self).__init__()
         self.cert_file = cert_file
         self.key_file = key_file
+        self.standby = standby
+        self.tube = tube
         self._socket = None
         self._ssl = None
+        self._context = None
+        self._session = None
+        self._standby = None
+        self._standby_greenlet = None
         self.connection_alive = False
 
     def __del__(self):
-        self.disconnect()
+        self.close()
+
+    def _ssl_context(self):
+        # the pinned gevent 1.0 has no SSLContext, fall back to wrap_socket
+        if self._context is None and hasattr(ssl, 'SSLContext'):
+            self._context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            if self.cert_file:
+                self._context.load_cert_chain(self.cert_file, self.key_file)
+            if self.alpn_protocols:
+                self._context.set_alpn_protocols(self.alpn_protocols)
+        return self._context
+
+    def _open(self):
+        """Returns a new (socket, ssl socket) pair connected to the APNs"""
+        start = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect((self.server, self.port))
+        context = self._ssl_context()
+        if context is None:
+            ssl_sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        else:
+            # resume the last TLS session where the ssl module allows it
+            kwargs = {}
+            if self._session is not None:
+                kwargs['session'] = self._session
+            ssl_sock = context.wrap_socket(sock, **kwargs)
+            self._session = getattr(ssl_sock, 'session', None)
+        handshakes_total.inc(labels=(self.tube,))
+        handshake_seconds_total.inc(time.time() - start, (self.tube,))
+        return sock, ssl_sock
+
+    def _open_standby(self):
+        try:
+            self._standby = self._open()
+        except (ssl.SSLError, socket.error, IOError) as e:
+            log.debug('Open standby connection error: %s', e)
+
+    def _take_standby(self):
+        if self._standby_greenlet is None or \
+                not self._standby_greenlet.ready():
+            return None
+        self._standby_greenlet = None
+        standby, self._standby = self._standby, None
+        if standby is None:
+            return None
+        if self._is_closed(standby[1]):
+            standby[1].close()
+            standby[0].close()
+            return None
+        return standby
+
+    @staticmethod
+    def _is_closed(ssl_sock):
+        # the gateway only sends application data right before closing
+        rlist, _, _ = select.select([ssl_sock], [], [], 0)
+        if not rlist:
+            return False
+        ssl_sock.settimeout(0.01)
+        try:
+            ssl_sock.read(ERROR_RESPONSE_LENGTH)
+        except (ssl.SSLError, socket.timeout):
+            return False
+        except socket.error:
+            return True
+        finally:
+            ssl_sock.settimeout(10)
+        return True
+
+    def _prepare_standby(self):
+        if self._standby_greenlet is None and self._standby is None:
+            self._standby_greenlet = gevent.spawn(self._open_standby)
 
     def connect(self):
-        logging.debug('Connect to apns start')
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(10)
-        logging.debug('Connect to apns step 1')
-        self._socket.connect((self.server, self.port))
-        logging.debug('Connect to apns step 2')
-        self._ssl = ssl.wrap_socket(
-            self._socket,
-            self.key_file,
-            self.cert_file)
-        logging.debug('Connect to apns step 3')
+        log.debug('Connect to apns start')
+        standby = self._take_standby()
+        if standby is not None:
+            self._socket, self._ssl = standby
+            standby_connects_total.inc(labels=(self.tube, 'hit'))
+        else:
+            self._socket, self._ssl = self._open()
+            if self.standby:
+                standby_connects_total.inc(labels=(self.tube, 'miss'))
         self.connection_alive = True
-        logging.debug('Connect to apns end')
+        if self.standby:
+            self._prepare_standby()
+        log.debug('Connect to apns end')
 
     def disconnect(self):
-        logging.debug('Disonnect from apns start')
+        log.debug('Disonnect from apns start')
         if self.connection_alive:
             if self._socket:
                 self._socket.close()
             if self._ssl:
                 self._ssl.close()
             self.connection_alive = False
-        logging.debug('Disonnect from apns end')
+        log.debug('Disonnect from apns end')
+
+    def _drop_standby(self):
+        if self._standby_greenlet is not None:
+            self._standby_greenlet.kill()
+            self._standby_greenlet = None
+        if self._standby is not None:
+            self._standby[1].close()
+            self._standby[0].close()
+            self._standby = None
+
+    def close(self):
+        """Disconnects and drops the standby connection"""
+        self.disconnect()
+        self._drop_standby()
+
+    def set_credentials(self, cert_file, key_file):
+        """Uses another certificate from the next connect on"""
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self._context = None
+        self._session = None
+        # handshaken with the old certificate
+        self._drop_standby()
 
     def reconnect(self):
         self.disconnect()
@@ -102,14 +267,36 @@ class APNsConnection(object):
             self.connect()
         return self._ssl
 
-    def read(self, n=None):
-        return self.connection().read(n)
+    def read(self, n=None, timeout=None):
+        connection = self.connection()
+        if timeout is None:
+            return connection.read(n)
+        connection.settimeout(timeout)
+        try:
+            return connection.read(n)
+        finally:
+            connection.settimeout(10)
 
     def write(self, string):
         return self.connection().write(string)
 
 
+# json.dumps builds an encoder per call for non-default arguments
+_dumps = json.JSONEncoder(
+    separators=(',', ':'), ensure_ascii=False).encode
+
+
 class PayloadAlert(object):
+    __slots__ = (
+        'body', 'action_loc_key', 'loc_key', 'loc_args', 'launch_image',
+        'title', 'subtitle')
+    # attribute, key in the payload
+    KEYS = (
+        ('body', 'body'), ('action_loc_key', 'action-loc-key'),
+        ('loc_key', 'loc-key'), ('loc_args', 'loc-args'),
+        ('launch_image', 'launch-image'), ('title', 'title'),
+        ('subtitle', 'subtitle'))
+
     def __init__(
             self, body=None, action_loc_key=None, loc_key=None,
             loc_args=None, launch_image=None, title=None, subtitle=None):
@@ -124,42 +311,49 @@ class PayloadAlert(object):
 
     def dict(self):
         d = {}
-        if self.body:
-            d['body'] = self.body
-        if self.action_loc_key:
-            d['action-loc-key'] = self.action_loc_key
-        if self.loc_key:
-            d['loc-key'] = self.loc_key
-        if self.loc_args:
-            d['loc-args'] = self.loc_args
-        if self.launch_image:
-            d['launch-image'] = self.launch_image
-        if self.title:
-            d['title'] = self.title
-        if self.subtitle:
-            d['subtitle'] = self.subtitle
+        for name, key in self.KEYS:
+            value = getattr(self, name)
+            if value:
+                d[key] = value
         return d
 
 
 class Payload(object):
-    """A class representing an APNs message payload"""
+    """
+    An immutable APNs message payload, encoded once when it is created.
+    The JSON is built as the aps dict followed by custom, with the badge
+    last in aps, so that template can splice in other badges.
+    """
+    __slots__ = (
+        'alert', 'badge', 'sound', 'category', 'custom',
+        'content_available', 'mutable_content', 'attachment', '_head',
+        '_tail', '_json')
+
     def __init__(
             self, alert=None, badge=None, sound=None, category=None,
-            custom={}, content_available=False, mutable_content=None,
+            custom=None, content_available=False, mutable_content=None,
             attachment=None):
-        super(Payload, self).__init__()
-        self.alert = alert
-        self.badge = badge
-        self.sound = sound
-        self.category = category
-        self.custom = custom
-        self.content_available = content_available
-        self.mutable_content = mutable_content
-        self.attachment = attachment
+        set = object.__setattr__
+        set(self, 'alert', alert)
+        set(self, 'badge', badge)
+        set(self, 'sound', sound)
+        set(self, 'category', category)
+        set(self, 'custom', custom or {})
+        set(self, 'content_available', content_available)
+        set(self, 'mutable_content', mutable_content)
+        set(self, 'attachment', attachment)
+        self._build()
         self._check_size()
 
-    def dict(self):
-        """Returns the payload as a regular Python dictionary"""
+    @classmethod
+    def from_dict(cls, d):
+        """Returns the payload of a job's payload dict"""
+        return cls(**d)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Payload is immutable')
+
+    def _aps(self):
         d = {}
         if self.alert:
             if isinstance(self.alert, PayloadAlert):
@@ -168,31 +362,56 @@ class Payload(object):
                 d['alert'] = self.alert
         if self.sound:
             d['sound'] = self.sound
-        if self.badge is not None:
-            d['badge'] = int(self.badge)
         if self.category:
             d['category'] = self.category
-
         if self.content_available:
-            d.update({'content-available': 1})
-
-        if self.mutable_content == 1 and \
-                self.attachment:
+            d['content-available'] = 1
+        if self.mutable_content == 1 and self.attachment:
             d['mutable-content'] = 1
             d['attachment'] = self.attachment
+        return d
 
+    def dict(self):
+        """Returns the payload as a regular Python dictionary"""
+        d = self._aps()
+        if self.badge is not None:
+            d['badge'] = int(self.badge)
         d = {'aps': d}
         d.update(self.custom)
         return d
 
+    def _build(self):
+        set = object.__setattr__
+        if 'aps' in self.custom:
+            # custom replaces aps, there is no badge to splice
+            set(self, '_head', None)
+            set(self, '_tail', None)
+            set(self, '_json', _dumps(self.dict()).encode('utf-8'))
+            return
+        # {"aps":{...,"badge":<badge>},<custom>}
+        aps = _dumps(self._aps())
+        head = '{"aps":' + aps[:-1]
+        tail = '},' + _dumps(self.custom)[1:] if self.custom else '}}'
+        if self.badge is None:
+            set(self, '_json', (head + tail).encode('utf-8'))
+        if len(aps) > 2:
+            head += ','
+        set(self, '_head', (head + '"badge":').encode('utf-8'))
+        set(self, '_tail', tail.encode('utf-8'))
+        if self.badge is not None:
+            set(self, '_json', self._head + str(int(self.badge)) + self._tail)
+
     def json(self):
-        return json.dumps(
-            self.dict(),
-            separators=(',', ':'),
-            ensure_ascii=False).encode('utf-8')
+        return self._json
+
+    def template(self):
+        """Returns a PayloadTemplate of this payload, whatever its badge"""
+        if self._head is None:
+            raise ValueError('A custom aps has no badge to replace')
+        return PayloadTemplate(self._head, self._tail)
 
     def _check_size(self):
-        payload_length = len(self.json())
+        payload_length = len(self._json)
         if payload_length > MAX_PAYLOAD_LENGTH:
             raise PayloadTooLargeError(payload_length)
 
@@ -202,6 +421,74 @@ class Payload(object):
         return "%s(%s)" % (self.__class__.__name__, args)
 
 
+class PayloadTemplate(object):
+    """
+    The encoded JSON of a payload around its badge, to render the
+    payload of every device of a broadcast with its own badge without
+    encoding the rest again.
+    """
+    __slots__ = ('head', 'tail', 'max_badge_length')
+
+    def __init__(self, head, tail):
+        super(PayloadTemplate, self).__init__()
+        self.head = head
+        self.tail = tail
+        self.max_badge_length = MAX_PAYLOAD_LENGTH - len(head) - len(tail)
+
+    def render(self, badge):
+        badge = str(int(badge))
+        if len(badge) > self.max_badge_length:
+            raise PayloadTooLargeError(
+                len(self.head) + len(badge) + len(self.tail))
+        return self.head + badge + self.tail
+
+
+class PayloadCache(object):
+    """
+    A bounded LRU cache of payloads
+
+    Maps the canonical JSON of a Payload keyword dict to the Payload, so
+    identical payloads are built and size checked only once.
+    """
+    def __init__(self, size=1024):
+        super(PayloadCache, self).__init__()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, payload_kwargs):
+        key = json.dumps(
+            payload_kwargs, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self._cache[key] = value
+                self.hits += 1
+        if value is None:
+            try:
+                value = Payload.from_dict(payload_kwargs)
+            except PayloadTooLargeError as e:
+                value = e
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = value
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+        if isinstance(value, PayloadTooLargeError):
+            raise value
+        return value
+
+    def get(self, payload_kwargs):
+        """Returns the encoded payload for Payload(**payload_kwargs)"""
+        return self._get(payload_kwargs).json()
+
+    def get_template(self, payload_kwargs):
+        """Returns the PayloadTemplate for Payload(**payload_kwargs)"""
+        return self._get(payload_kwargs).template()
+
+
 class PayloadTooLargeError(StandardError):
     def __init__(self, payload_size):
         super(PayloadTooLargeError, self).__init__()
@@ -214,24 +501,305 @@ class InvalidTokenError(StandardError):
         self.token_hex = token_hex
 
 
+class NotificationEncoder(object):
+    """
+    Packs enhanced notification frames into a reusable buffer.
+
+    The fixed part of every frame is packed with a precompiled struct, the
+    payload bytes are copied right behind it, so a whole batch of frames is
+    built without intermediate string concatenation.
+    """
+    def __init__(self, size=65536):
+        super(NotificationEncoder, self).__init__()
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._offset = 0
+
+    def reset(self):
+        self._offset = 0
+
+    def _reserve(self, size):
+        end = self._offset + size
+        if end > len(self._buffer):
+            buff = bytearray(max(end, 2 * len(self._buffer)))
+            buff[:self._offset] = self._view[:self._offset]
+            self._buffer = buff
+            self._view = memoryview(buff)
+
+    def add(self, token_hex, payload, identifier, expiry):
+        """Appends one frame, payload is the encoded JSON payload"""
+        try:
+            token = a2b_hex(token_hex)
+        except TypeError:
+            raise InvalidTokenError(token_hex)
+        if len(token) != TOKEN_LENGTH:
+            raise InvalidTokenError(token_hex)
+        payload_length = len(payload)
+        self._reserve(NOTIFICATION_HEADER.size + payload_length)
+        NOTIFICATION_HEADER.pack_into(
+            self._buffer, self._offset, ENHANCED_NOTIFICATION_COMMAND,
+            identifier, expiry, TOKEN_LENGTH, token, payload_length)
+        self._offset += NOTIFICATION_HEADER.size
+        self._buffer[self._offset:self._offset + payload_length] = payload
+        self._offset += payload_length
+
+    def add_frame(self, frame, identifier):
+        """Appends a frame encoded earlier under a new identifier"""
+        length = len(frame)
+        self._reserve(length)
+        self._buffer[self._offset:self._offset + length] = frame
+        NOTIFICATION_IDENTIFIER.pack_into(
+            self._buffer, self._offset + NOTIFICATION_IDENTIFIER_OFFSET,
+            identifier)
+        self._offset += length
+
+    def add_many(self, notifications):
+        """Appends a (token_hex, payload, identifier, expiry) iterable"""
+        for token_hex, payload, identifier, expiry in notifications:
+            self.add(token_hex, payload, identifier, expiry)
+
+    def __len__(self):
+        return self._offset
+
+    def getvalue(self):
+        """Returns a view of the frames packed since the last reset"""
+        return self._view[:self._offset]
+
+
+def parse_notification(frame):
+    """Returns (identifier, expiry, token_hex, payload) of a frame"""
+    command, identifier, expiry, token_length, token, payload_length = \
+        NOTIFICATION_HEADER.unpack_from(frame)
+    payload_start = NOTIFICATION_HEADER.size
+    payload = frame[payload_start:payload_start + payload_length]
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    return identifier, expiry, b2a_hex(token), payload
+
+
 class GatewayConnection(APNsConnection):
     def __init__(self, host, port, **kwargs):
         super(GatewayConnection, self).__init__(**kwargs)
         self.server = host
         self.port = port
+        self.encoder = NotificationEncoder()
 
     def get_notification(self, token_hex, payload, identifier, expiry):
-        try:
-            token = a2b_hex(token_hex)
-        except TypeError:
-            raise InvalidTokenError(token_hex)
-        payload = payload.json()
-        fmt = ENHANCED_NOTIFICATION_FORMAT % len(payload)
-        notification = pack(
-            fmt, ENHANCED_NOTIFICATION_COMMAND, identifier,
-            expiry, TOKEN_LENGTH, token, len(payload), payload)
-        return notification
+        encoder = NotificationEncoder(
+            NOTIFICATION_HEADER.size + MAX_PAYLOAD_LENGTH)
+        encoder.add(token_hex, payload.json(), identifier, expiry)
+        return encoder.getvalue().tobytes()
+
+    def get_notifications(self, notifications):
+        """
+        Packs (token_hex, payload, identifier, expiry) tuples into one
+        buffer. The returned view is only valid until the next call.
+        """
+        self.encoder.reset()
+        for token_hex, payload, identifier, expiry in notifications:
+            self.encoder.add(token_hex, payload.json(), identifier, expiry)
+        return self.encoder.getvalue()
 
     def send_notification(self, token_hex, payload, identifier=0, expiry=0):
         self.write(
             self.get_notification(token_hex, payload, identifier, expiry))
+
+
+class ProviderToken(object):
+    """
+    The signed JWT for token based provider authentication.
+
+    APNs rejects tokens older than an hour and refuses tokens refreshed
+    more often than every 20 minutes, so the token is signed once and
+    shared until it is refresh_interval seconds old.
+    """
+    def __init__(self, key_file, key_id, team_id, refresh_interval=3000):
+        super(ProviderToken, self).__init__()
+        if jwt is None:
+            raise ImportError('Token authentication requires PyJWT')
+        with open(key_file) as f:
+            self.key = f.read()
+        self.key_id = key_id
+        self.team_id = team_id
+        self.refresh_interval = refresh_interval
+        self.issued_at = 0
+        self.sign_count = 0
+        self._token = None
+        self._lock = Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._token is None or \
+                    now - self.issued_at >= self.refresh_interval:
+                self._token = jwt.encode(
+                    {'iss': self.team_id, 'iat': int(now)}, self.key,
+                    algorithm='ES256', headers={'kid': self.key_id})
+                self.issued_at = now
+                self.sign_count += 1
+            return self._token
+
+    def expire(self):
+        """Signs a new token on the next get, after ExpiredProviderToken"""
+        with self._lock:
+            self._token = None
+
+
+class HTTP2GatewayConnection(APNsConnection):
+    """
+    A client of the HTTP/2 provider API.
+
+    Every notification is a stream of its own, up to
+    max_concurrent_streams of them are in flight on the connection at
+    once. Requests carry the provider_token when one is given, otherwise
+    the client certificate authenticates the connection. With secure
+    False the connection speaks HTTP/2 over plain TCP, for local
+    stand-ins.
+    """
+    alpn_protocols = ['h2']
+
+    def __init__(
+            self, host, port, topic=None, provider_token=None, secure=True,
+            max_concurrent_streams=500, **kwargs):
+        super(HTTP2GatewayConnection, self).__init__(**kwargs)
+        if h2 is None:
+            raise ImportError('The HTTP/2 provider API requires h2')
+        self.server = host
+        self.port = port
+        self.topic = topic
+        self.provider_token = provider_token
+        self.secure = secure
+        self.max_concurrent_streams = max_concurrent_streams
+        self._h2 = None
+
+    def _open(self):
+        if self.secure:
+            return super(HTTP2GatewayConnection, self)._open()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect((self.server, self.port))
+        handshakes_total.inc(labels=(self.tube,))
+        return sock, sock
+
+    def connect(self):
+        super(HTTP2GatewayConnection, self).connect()
+        self._h2 = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(
+                client_side=True, header_encoding='utf-8'))
+        self._h2.initiate_connection()
+        self._flush()
+        # the server's settings bound the streams that may be opened
+        settings = False
+        while not settings:
+            data = self._ssl.recv(65536)
+            if not data:
+                self.disconnect()
+                raise socket.error('Connection closed by the gateway')
+            for event in self._h2.receive_data(data):
+                if isinstance(event, h2.events.RemoteSettingsChanged):
+                    settings = True
+        self._flush()
+
+    def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self._ssl.sendall(data)
+
+    def _headers(self, token_hex, expiry):
+        headers = [
+            (':method', 'POST'),
+            (':scheme', 'https'),
+            (':path', '/3/device/%s' % token_hex),
+            (':authority', self.server),
+            ('apns-expiration', str(expiry)),
+        ]
+        if self.topic:
+            headers.append(('apns-topic', self.topic))
+        if self.provider_token is not None:
+            headers.append(
+                ('authorization', 'bearer %s' % self.provider_token.get()))
+        return headers
+
+    def _receive(self, streams, results):
+        data = self._ssl.recv(65536)
+        if not data:
+            self.disconnect()
+            raise socket.error('Connection closed by the gateway')
+        for event in self._h2.receive_data(data):
+            if isinstance(event, h2.events.ResponseReceived):
+                streams[event.stream_id][1] = \
+                    int(dict(event.headers)[':status'])
+            elif isinstance(event, h2.events.DataReceived):
+                streams[event.stream_id][2].append(event.data)
+                self._h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                index, status, body = streams.pop(event.stream_id)
+                reason = None
+                if body:
+                    try:
+                        reason = json.loads(''.join(body)).get('reason')
+                    except ValueError:
+                        pass
+                results[index] = (status, reason)
+            elif isinstance(event, h2.events.StreamReset):
+                index = streams.pop(event.stream_id)[0]
+                results[index] = (None, 'StreamReset')
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                log.debug(
+                    'GOAWAY from gateway: %s', event.additional_data)
+                self.disconnect()
+                return
+        self._flush()
+
+    def send_notifications(self, notifications):
+        """
+        Sends (token_hex, payload, identifier, expiry) tuples, payload
+        being the encoded JSON payload, and returns a (status, reason)
+        pair for each. Status is None for notifications the gateway did
+        not answer before it went away, which may be retried. A connection
+        error carries the results so far as its results attribute.
+        """
+        results = [None] * len(notifications)
+        self.connection()
+        try:
+            queue = deque(enumerate(notifications))
+            streams = {}
+            while queue or streams:
+                limit = min(
+                    self.max_concurrent_streams,
+                    self._h2.remote_settings.max_concurrent_streams)
+                while queue and len(streams) < limit:
+                    index, (token_hex, payload, identifier, expiry) = queue[0]
+                    try:
+                        token = a2b_hex(token_hex)
+                    except TypeError:
+                        token = None
+                    if token is None or len(token) != TOKEN_LENGTH:
+                        queue.popleft()
+                        results[index] = (400, 'BadDeviceToken')
+                        continue
+                    if len(payload) > self._h2.outbound_flow_control_window:
+                        break
+                    queue.popleft()
+                    stream_id = self._h2.get_next_available_stream_id()
+                    self._h2.send_headers(
+                        stream_id, self._headers(token_hex, expiry))
+                    self._h2.send_data(stream_id, payload, end_stream=True)
+                    streams[stream_id] = [index, None, []]
+                self._flush()
+                if not queue and not streams:
+                    break
+                self._receive(streams, results)
+                if not self.connection_alive:
+                    for index, status, body in streams.values():
+                        results[index] = (None, 'GoAway')
+                    for index, notification in queue:
+                        results[index] = (None, 'GoAway')
+                    break
+        except (ssl.SSLError, socket.error, IOError) as e:
+            # the caller keeps the answers received before the
+            # connection broke and retries the other streams
+            e.results = results
+            raise
+        return results
@@ -4,73 +4,220 @@
 from gevent import monkey
 monkey.patch_all()
 
+from itertools import groupby
 import json
 import logging
+from operator import itemgetter
 from threading import Thread
 import time
 
 import beanstalkc
 
+import codec
 import config
+import logs
+from jobs import (
+    CollapseIndex, expand, parse_batch_tube, priority_name, push_tube)
+import metrics
+import queues
 
 
-def batch_push(host, port, watching_tube, using_tube):
-    logging.debug('Starting')
+log = logs.get_logger('batch_push')
+
+batch_jobs_total = metrics.counter(
+    'batch_jobs_total', 'Batch jobs expanded', ('lane',))
+fanout_jobs_total = metrics.counter(
+    'batch_fanout_jobs_total', 'Push jobs put by batch jobs', ('tube',))
+put_seconds = metrics.histogram(
+    'batch_put_seconds', 'Time to put the push jobs of one batch job')
+collapsed_jobs_total = metrics.counter(
+    'batch_collapsed_jobs_total',
+    'Push jobs superseded by a later one with the same collapse_key')
+
+collapse_index = CollapseIndex(config.COLLAPSE_INDEX_SIZE)
+
+
+class LaneScheduler(object):
+    """
+    Picks the batch lane to expand a job from next.
+
+    Fast lanes always come first. The other lanes are picked by smooth
+    weighted round robin, weighted by BATCH_LANE_WEIGHTS and APP_WEIGHTS,
+    so a large campaign gets its share of the batch workers instead of
+    all of them. Lanes found empty are skipped until the next update.
+    The BATCH_PUSH_TUBE of older api processes is a normal lane.
+    """
+    def __init__(self):
+        super(LaneScheduler, self).__init__()
+        self.fast = {}
+        self.weights = {}
+        self.current = {}
+        self.empty = set()
+
+    def update(self, tubes):
+        fast = {}
+        weights = {}
+        for tube in tubes:
+            if tube == config.BATCH_PUSH_TUBE:
+                weights[tube] = config.BATCH_LANE_WEIGHTS.get('normal', 1)
+                continue
+            lane = parse_batch_tube(tube)
+            if lane is None:
+                continue
+            priority, app_name = lane
+            app_weight = config.APP_WEIGHTS.get(app_name, 1)
+            if priority in config.FAST_LANE_PRIORITIES:
+                fast[tube] = app_weight
+            else:
+                weights[tube] = \
+                    config.BATCH_LANE_WEIGHTS.get(priority, 1) * app_weight
+        self.fast = fast
+        self.weights = weights
+        self.current = dict(
+            (tube, self.current.get(tube, 0))
+            for tube in fast.keys() + weights.keys())
+        self.empty.clear()
+
+    def tubes(self):
+        return self.fast.keys() + self.weights.keys()
+
+    def _pick(self, weights):
+        best = None
+        total = 0
+        for tube, weight in weights.items():
+            if tube in self.empty:
+                continue
+            self.current[tube] += weight
+            total += weight
+            if best is None or self.current[tube] > self.current[best]:
+                best = tube
+        if best is not None:
+            self.current[best] -= total
+        return best
+
+    def next(self):
+        """Returns the lane to reserve from, None if all were empty"""
+        return self._pick(self.fast) or self._pick(self.weights)
+
+
+def watch_only(beanstalk, watching, tubes):
+    """Makes beanstalk watch tubes instead of watching, returns tubes"""
+    tubes = set(tubes)
+    # watch first, the last watched tube can't be ignored
+    for tube in tubes - watching:
+        beanstalk.watch(tube)
+    for tube in watching - tubes:
+        beanstalk.ignore(tube)
+    return tubes
+
+
+def expand_job(beanstalk, job, lane):
+    log.debug('Reserved job: %s %s', job.jid, job.body)
+    try:
+        push_jobs = json.loads(job.body)
+    except ValueError:
+        log.debug('Failed to load job body: %s %s', job.jid, job.body)
+        job.bury()
+        return
+
+    entries = []
+    latest = {}
+    for push_job in push_jobs:
+        priority = config.PRIORITIES[priority_name(push_job)]
+        delay = push_job.get('delay', 0)
+        tube = push_tube(push_job)
+        for chunk in expand(push_job):
+            key = collapse_index.key(chunk)
+            if key is not None:
+                latest[key] = len(entries)
+            entries.append(((tube, codec.encode(chunk), priority, delay), key))
+    if latest:
+        # a later job of the same batch supersedes one right away
+        kept = [
+            entry for i, entry in enumerate(entries)
+            if entry[1] is None or latest[entry[1]] == i]
+        collapsed_jobs_total.inc(len(entries) - len(kept))
+        entries = kept
+    entries.sort(key=lambda entry: entry[0][0])
+    puts = [put for put, key in entries]
+    start = time.time()
+    try:
+        jids = beanstalk.put_many(puts)
+    except beanstalkc.CommandFailed as e:
+        log.error('Failed to put jobs of %s: %s', job.jid, e)
+        # kicking the buried batch puts them again
+        beanstalk.delete_many(getattr(e, 'jids', []))
+        job.bury()
+        return
+    put_seconds.observe(time.time() - start)
+    if latest:
+        superseded = []
+        for (put, key), jid in zip(entries, jids):
+            if key is not None:
+                previous = collapse_index.replace(key, (jid, put[0]))
+                if previous is not None:
+                    superseded.append(previous)
+        collapsed_jobs_total.inc(queues.delete_queued(beanstalk, superseded))
+    for tube, group in groupby(puts, itemgetter(0)):
+        fanout_jobs_total.inc(len(list(group)), (tube,))
+    job.delete()
+    batch_jobs_total.inc(labels=(lane,))
+    log.debug('Delete job: %s %s', job.jid, job.body)
+
+
+def batch_push(host, port):
+    log.debug('Starting')
     while True:
         # init beanstalk
         try:
-            beanstalk = beanstalkc.Connection(host, port)
-            logging.debug('Connect to %s:%s success' % (host, port))
-            beanstalk.watch(watching_tube)
-            for tube in beanstalk.watching():
-                if tube != watching_tube:
-                    beanstalk.ignore(tube)
+            beanstalk = queues.connect(host, port)
+            log.debug('Connect to %s:%s success', host, port)
         except beanstalkc.SocketError:
-            logging.debug('Connect to %s:%s failed' % (host, port))
+            log.debug('Connect to %s:%s failed', host, port)
             time.sleep(2)
             continue
 
+        scheduler = LaneScheduler()
+        watching = set(['default'])
+        updated = 0
         try:
             while True:
-                job = beanstalk.reserve(timeout=10)
-                if not job:
-                    logging.debug('No job found. Sleep 2 seconds')
-                    time.sleep(2)
-                    continue
-                logging.debug('Reserved job: %s %s' % (job.jid, job.body))
-                try:
-                    push_jobs = json.loads(job.body)
-                except ValueError:
-                    logging.debug(
-                        'Failed to load job body: %s %s' % (job.jid, job.body))
-                    job.bury()
-
-                current_using = ''
-                for push_job in push_jobs:
-                    priority = config.PRIORITIES.get(
-                        push_job.get('priority', 'low'))
-                    delay = push_job.get('delay', 0)
-                    next_using = config.PUSH_TUBE % push_job['app_name']
-                    if next_using != current_using:
-                        beanstalk.use(next_using)
-                    beanstalk.put(
-                        json.dumps(push_job), priority=priority, delay=delay)
-                job.delete()
-                logging.debug('Delete job: %s %s' % (job.jid, job.body))
+                if time.time() - updated > config.BATCH_LANE_REFRESH_INTERVAL:
+                    scheduler.update(beanstalk.tubes())
+                    updated = time.time()
+                tube = scheduler.next()
+                if tube is None:
+                    # all lanes are empty, wait on all of them for the
+                    # next job, beanstalkd hands out the most urgent one
+                    watching = watch_only(
+                        beanstalk, watching,
+                        scheduler.tubes() or [config.BATCH_PUSH_TUBE])
+                    job = beanstalk.reserve(
+                        timeout=config.BATCH_LANE_REFRESH_INTERVAL)
+                    if not job:
+                        log.debug('No job found')
+                        updated = 0
+                        continue
+                    tube = job.stats()['tube']
+                else:
+                    watching = watch_only(beanstalk, watching, [tube])
+                    job = beanstalk.reserve(timeout=0)
+                    if not job:
+                        scheduler.empty.add(tube)
+                        continue
+                lane = parse_batch_tube(tube)
+                expand_job(beanstalk, job, lane[0] if lane else 'default')
         except beanstalkc.SocketError:
-            logging.debug('Server %s:%s is down' % (host, port))
+            log.debug('Server %s:%s is down', host, port)
             time.sleep(2)
             continue
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        format=config.LOGGING_FORMAT, level=config.LOGGING_LEVEL)
-    args = (
-        config.BEANSTALKD_HOST,
-        config.BEANSTALKD_PORT,
-        config.BATCH_PUSH_TUBE,
-        config.PUSH_TUBE)
+    logs.setup()
+    if config.BATCH_METRICS_PORT is not None:
+        metrics.serve(config.BATCH_METRICS_PORT)
+    args = (config.BEANSTALKD_HOST, config.BEANSTALKD_PORT)
     for i in range(config.BATCH_WORKER_COUNT):
         t = Thread(target=batch_push, args=args, name='worker.%d' % i)
         t.start()
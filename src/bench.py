@@ -0,0 +1,970 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+from collections import defaultdict
+import heapq
+import json
+import logging
+import os
+import resource
+import select
+import shutil
+import SocketServer
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+except ImportError:
+    h2 = None
+
+import apns
+import batch_push
+import codec
+import config
+import deliveries
+import local_queue
+import queues
+
+
+class FakeBeanstalkd(SocketServer.ThreadingTCPServer):
+    """
+    An in-process stand-in for beanstalkd, speaking enough of the
+    protocol for api, batch_push and push. TTRs are not enforced, jobs
+    reserved by a connection are released when it closes.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, address, FakeBeanstalkdHandler)
+        self.condition = threading.Condition()
+        self.next_jid = 1
+        self.jobs = {}
+        self.ready = defaultdict(list)
+        self.delayed = []
+        self.counters = defaultdict(int)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='beanstalkd')
+        t.daemon = True
+        t.start()
+        return self
+
+    def put(self, tube, priority, delay, ttr, body):
+        with self.condition:
+            jid = self.next_jid
+            self.next_jid += 1
+            now = time.time()
+            job = dict(
+                id=jid, tube=tube, pri=priority, ttr=ttr, body=body,
+                created=now, state='ready', reserves=0)
+            self.jobs[jid] = job
+            self.counters['cmd-put'] += 1
+            self.counters[(tube, 'total-jobs')] += 1
+            if delay:
+                job['state'] = 'delayed'
+                heapq.heappush(self.delayed, (now + delay, jid))
+            else:
+                heapq.heappush(self.ready[tube], (priority, jid))
+            self.condition.notify_all()
+            return jid
+
+    def _promote_delayed(self):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, jid = heapq.heappop(self.delayed)
+            job = self.jobs.get(jid)
+            if job and job['state'] == 'delayed':
+                job['state'] = 'ready'
+                heapq.heappush(self.ready[job['tube']], (job['pri'], jid))
+
+    def _pop_ready(self, tubes):
+        best = None
+        for tube in tubes:
+            heap = self.ready.get(tube)
+            while heap and self.jobs.get(heap[0][1], {}).get(
+                    'state') != 'ready':
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < self.ready[best][0]):
+                best = tube
+        if best is None:
+            return None
+        _, jid = heapq.heappop(self.ready[best])
+        return self.jobs[jid]
+
+    def reserve(self, tubes, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                self._promote_delayed()
+                job = self._pop_ready(tubes)
+                if job:
+                    job['state'] = 'reserved'
+                    job['reserves'] += 1
+                    self.counters['cmd-reserve'] += 1
+                    return job
+                if deadline is None:
+                    wait = 1
+                else:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        return None
+                    wait = min(wait, 0.1)
+                self.condition.wait(wait)
+
+    def delete(self, jid):
+        with self.condition:
+            job = self.jobs.pop(jid, None)
+            if job is None:
+                return False
+            self.counters['cmd-delete'] += 1
+            self.counters[(job['tube'], 'cmd-delete')] += 1
+            return True
+
+    def release(self, jid, priority, delay):
+        with self.condition:
+            job = self.jobs.get(jid)
+            if job is None or job['state'] != 'reserved':
+                return False
+            job['pri'] = priority
+            if delay:
+                job['state'] = 'delayed'
+                heapq.heappush(self.delayed, (time.time() + delay, jid))
+            else:
+                job['state'] = 'ready'
+                heapq.heappush(self.ready[job['tube']], (priority, jid))
+            self.condition.notify_all()
+            return True
+
+    def bury(self, jid):
+        with self.condition:
+            job = self.jobs.get(jid)
+            if job is None or job['state'] != 'reserved':
+                return False
+            job['state'] = 'buried'
+            return True
+
+    def stats_tube(self, tube):
+        with self.condition:
+            self._promote_delayed()
+            states = defaultdict(int)
+            for job in self.jobs.itervalues():
+                if job['tube'] == tube:
+                    states[job['state']] += 1
+            return {
+                'name': tube,
+                'current-jobs-ready': states['ready'],
+                'current-jobs-reserved': states['reserved'],
+                'current-jobs-delayed': states['delayed'],
+                'current-jobs-buried': states['buried'],
+                'total-jobs': self.counters[(tube, 'total-jobs')],
+                'cmd-delete': self.counters[(tube, 'cmd-delete')],
+            }
+
+    def stats(self):
+        with self.condition:
+            return {
+                'current-jobs-ready': sum(
+                    1 for job in self.jobs.itervalues()
+                    if job['state'] == 'ready'),
+                'cmd-put': self.counters['cmd-put'],
+                'cmd-reserve': self.counters['cmd-reserve'],
+                'cmd-delete': self.counters['cmd-delete'],
+                'total-jobs': self.next_jid - 1,
+            }
+
+
+def _yaml(value):
+    if isinstance(value, dict):
+        lines = ['%s: %s' % item for item in sorted(value.items())]
+    else:
+        lines = ['- %s' % item for item in value]
+    return '---\n' + '\n'.join(lines) + '\n'
+
+
+class FakeBeanstalkdHandler(SocketServer.StreamRequestHandler):
+    # like beanstalkd, else pipelined replies wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.using = 'default'
+        self.watching = ['default']
+        self.reserved = set()
+
+    def finish(self):
+        for jid in self.reserved:
+            self.server.release(jid, self.server.jobs.get(
+                jid, {}).get('pri', 0), 0)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def reply(self, line, body=None):
+        if body is None:
+            self.wfile.write(line + '\r\n')
+        else:
+            self.wfile.write('%s %d\r\n%s\r\n' % (line, len(body), body))
+        self.wfile.flush()
+
+    def reply_job(self, status, job):
+        self.reply('%s %d' % (status, job['id']), job['body'])
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = line.split()
+            if not args:
+                continue
+            command = args.pop(0)
+            if command == 'quit':
+                return
+            elif command == 'put':
+                priority, delay, ttr, size = map(int, args)
+                body = self.rfile.read(size + 2)[:-2]
+                jid = server.put(self.using, priority, delay, ttr, body)
+                self.reply('INSERTED %d' % jid)
+            elif command == 'use':
+                self.using = args[0]
+                self.reply('USING %s' % self.using)
+            elif command == 'watch':
+                if args[0] not in self.watching:
+                    self.watching.append(args[0])
+                self.reply('WATCHING %d' % len(self.watching))
+            elif command == 'ignore':
+                if len(self.watching) == 1 and args[0] in self.watching:
+                    self.reply('NOT_IGNORED')
+                    continue
+                if args[0] in self.watching:
+                    self.watching.remove(args[0])
+                self.reply('WATCHING %d' % len(self.watching))
+            elif command in ('reserve', 'reserve-with-timeout'):
+                timeout = int(args[0]) if args else None
+                job = server.reserve(self.watching, timeout)
+                if job is None:
+                    self.reply('TIMED_OUT')
+                else:
+                    self.reserved.add(job['id'])
+                    self.reply_job('RESERVED', job)
+            elif command == 'delete':
+                jid = int(args[0])
+                self.reserved.discard(jid)
+                self.reply('DELETED' if server.delete(jid) else 'NOT_FOUND')
+            elif command == 'release':
+                jid, priority, delay = map(int, args)
+                self.reserved.discard(jid)
+                ok = server.release(jid, priority, delay)
+                self.reply('RELEASED' if ok else 'NOT_FOUND')
+            elif command == 'bury':
+                jid = int(args[0])
+                self.reserved.discard(jid)
+                self.reply('BURIED' if server.bury(jid) else 'NOT_FOUND')
+            elif command == 'touch':
+                self.reply('TOUCHED')
+            elif command == 'stats-job':
+                job = server.jobs.get(int(args[0]))
+                if job is None:
+                    self.reply('NOT_FOUND')
+                    continue
+                self.reply('OK', _yaml({
+                    'id': job['id'], 'tube': job['tube'],
+                    'state': job['state'], 'pri': job['pri'],
+                    'age': int(time.time() - job['created']),
+                    'ttr': job['ttr'], 'reserves': job['reserves']}))
+            elif command == 'stats-tube':
+                self.reply('OK', _yaml(server.stats_tube(args[0])))
+            elif command == 'stats':
+                self.reply('OK', _yaml(server.stats()))
+            elif command == 'list-tubes':
+                with server.condition:
+                    tubes = set(
+                        job['tube'] for job in server.jobs.itervalues())
+                self.reply('OK', _yaml(sorted(tubes | set(self.watching))))
+            elif command == 'list-tubes-watched':
+                self.reply('OK', _yaml(self.watching))
+            elif command == 'list-tube-used':
+                self.reply('USING %s' % self.using)
+            else:
+                self.reply('UNKNOWN_COMMAND')
+
+
+class FakeHTTP2Gateway(SocketServer.ThreadingTCPServer):
+    """
+    An in-process stand-in for the HTTP/2 provider API, over plain TCP.
+    Every request is answered after latency seconds, with 410 Unregistered
+    for the tokens in unregistered and 200 otherwise.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(
+            self, address=('127.0.0.1', 0), latency=0,
+            max_concurrent_streams=1000, unregistered=()):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, address, FakeHTTP2GatewayHandler)
+        self.latency = latency
+        self.max_concurrent_streams = max_concurrent_streams
+        self.unregistered = set(unregistered)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.authorizations = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='apns-http2')
+        t.daemon = True
+        t.start()
+        return self
+
+    def answer(self, headers):
+        token_hex = headers[':path'].rsplit('/', 1)[-1]
+        with self.lock:
+            self.requests += 1
+            self.authorizations.add(headers.get('authorization'))
+        if token_hex in self.unregistered:
+            return 410, 'Unregistered'
+        return 200, None
+
+
+class FakeHTTP2GatewayHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(
+                client_side=False, header_encoding='utf-8'))
+        conn.local_settings = h2.settings.Settings(
+            client=False, initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                    server.max_concurrent_streams})
+        conn.initiate_connection()
+        self.request.sendall(conn.data_to_send())
+        headers = {}
+        due = []
+        while True:
+            timeout = None
+            if due:
+                timeout = max(0, due[0][0] - time.time())
+            rlist, _, _ = select.select([self.request], [], [], timeout)
+            if rlist:
+                data = self.request.recv(65536)
+                if not data:
+                    return
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        headers[event.stream_id] = dict(event.headers)
+                    elif isinstance(event, h2.events.DataReceived):
+                        conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        answer = server.answer(headers.pop(event.stream_id))
+                        heapq.heappush(due, (
+                            time.time() + server.latency, event.stream_id,
+                            answer))
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+            now = time.time()
+            while due and due[0][0] <= now:
+                _, stream_id, (status, reason) = heapq.heappop(due)
+                if reason is None:
+                    conn.send_headers(
+                        stream_id, [(':status', str(status))],
+                        end_stream=True)
+                    continue
+                body = json.dumps(dict(reason=reason))
+                conn.send_headers(stream_id, [
+                    (':status', str(status)),
+                    ('content-length', str(len(body)))])
+                conn.send_data(stream_id, body, end_stream=True)
+            data = conn.data_to_send()
+            if data:
+                self.request.sendall(data)
+
+
+def make_certificate(directory):
+    """Writes a throwaway self-signed certificate, returns its paths"""
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', key_file, '-out', cert_file],
+            stdout=devnull, stderr=devnull)
+    return cert_file, key_file
+
+
+class FakeAPNsGateway(SocketServer.ThreadingTCPServer):
+    """
+    An in-process stand-in for the binary protocol gateway, over TLS.
+
+    Every read is held back latency seconds. With fail_every, every Nth
+    frame is answered with an invalid token error response and the
+    connection is closed, as the gateway does, discarding the frames
+    read after it. The first arrival time of every token is kept in
+    arrivals; a discarded token arriving later counts as resent, a token
+    arriving again as a duplicate.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(
+            self, cert_file, key_file, address=('127.0.0.1', 0), latency=0,
+            fail_every=0):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, address, FakeAPNsGatewayHandler)
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.latency = latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.frames = 0
+        self.arrivals = {}
+        self.failed = []
+        self.discarded = set()
+        self.resent = 0
+        self.duplicates = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='apns')
+        t.daemon = True
+        t.start()
+        return self
+
+    def frame(self, token_hex):
+        """Records a frame, returns True if it is to fail"""
+        with self.lock:
+            self.frames += 1
+            if self.fail_every and self.frames % self.fail_every == 0:
+                self.failed.append(token_hex)
+                return True
+            if token_hex in self.arrivals:
+                self.duplicates += 1
+                return False
+            if token_hex in self.discarded:
+                self.discarded.remove(token_hex)
+                self.resent += 1
+            self.arrivals[token_hex] = time.time()
+            return False
+
+    def accounted(self):
+        """The number of tokens delivered or failed"""
+        with self.lock:
+            return len(self.arrivals) + len(
+                set(self.failed).difference(self.arrivals))
+
+    def discard(self, tokens_hex):
+        """Records the tokens of frames dropped after an error response"""
+        with self.lock:
+            self.discarded.update(
+                token_hex for token_hex in tokens_hex
+                if token_hex not in self.arrivals)
+
+
+class FakeAPNsGatewayHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        try:
+            conn = ssl.wrap_socket(
+                self.request, server_side=True, certfile=server.cert_file,
+                keyfile=server.key_file, ssl_version=ssl.PROTOCOL_TLSv1_2)
+        except (ssl.SSLError, IOError):
+            return
+        buff = ''
+        while True:
+            try:
+                data = conn.read(65536)
+            except (ssl.SSLError, IOError):
+                return
+            if not data:
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            buff += data
+            offset = 0
+            for token_hex, identifier, end in self.frames(buff):
+                if server.frame(token_hex):
+                    conn.write(struct.pack(
+                        apns.ERROR_RESPONSE_FORMAT, 8,
+                        apns.INVALID_TOKEN_STATUS, identifier))
+                    conn.close()
+                    server.discard(
+                        token_hex for token_hex, _, _ in
+                        self.frames(buff, end))
+                    return
+                offset = end
+            buff = buff[offset:]
+
+    @staticmethod
+    def frames(buff, offset=0):
+        """Yields (token_hex, identifier, end) of the whole frames in buff"""
+        header = apns.NOTIFICATION_HEADER
+        while len(buff) - offset >= header.size:
+            command, identifier, expiry, token_length, token, \
+                payload_length = header.unpack_from(buff, offset)
+            end = offset + header.size + payload_length
+            if end > len(buff):
+                return
+            yield token.encode('hex'), identifier, end
+            offset = end
+
+
+def make_puts(count, apps, devices_per_job=1):
+    puts = []
+    for i in range(count):
+        app_name = 'bench_app_%d' % (i % apps)
+        job = dict(
+            app_name=app_name,
+            payload=dict(alert='Benchmark %d' % i, badge=1))
+        if devices_per_job > 1:
+            job['device_tokens'] = ['%064x' % i] * devices_per_job
+        else:
+            job['device_token'] = '%064x' % i
+        puts.append(('ios_push.%s' % app_name, json.dumps(job), 0, 0))
+    return puts
+
+
+def put_each(beanstalk, puts):
+    """The per job use + put round trips batch_push used to make"""
+    for tube, body, priority, delay in puts:
+        beanstalk.use(tube)
+        beanstalk.put(body, priority=priority, delay=delay)
+
+
+def bench_enqueue(args):
+    server = FakeBeanstalkd().start()
+    puts = make_puts(args.jobs, args.apps)
+    beanstalk = queues.BeanstalkConnection('127.0.0.1', server.port)
+
+    start = time.time()
+    put_each(beanstalk, puts)
+    old = time.time() - start
+
+    start = time.time()
+    beanstalk.put_many(sorted(puts))
+    new = time.time() - start
+
+    print 'jobs: %d, apps: %d' % (args.jobs, args.apps)
+    print 'use + put per job: %8.0f jobs/s' % (args.jobs / old)
+    print 'pipelined put:     %8.0f jobs/s' % (args.jobs / new)
+    server.shutdown()
+
+
+def bench_queue(args):
+    directory = tempfile.mkdtemp(prefix='push_turbo_bench')
+    server = None
+    if args.beanstalkd:
+        host, port = args.beanstalkd.split(':')
+        port = int(port)
+    else:
+        server = FakeBeanstalkd().start()
+        host, port = '127.0.0.1', server.port
+    local = local_queue.LocalQueue(
+        os.path.join(directory, 'queue'), args.segment_bytes)
+    backends = [
+        ('beanstalk', lambda: queues.BeanstalkConnection(host, port)),
+        ('local', lambda: local_queue.LocalConnection(local)),
+    ]
+    tube = 'bench_queue'
+    puts = [(tube, body, priority, delay)
+            for _, body, priority, delay in make_puts(args.jobs, 1)]
+
+    print 'jobs: %d, batch: %d, beanstalkd: %s' % (
+        args.jobs, args.batch, args.beanstalkd or 'in-process stand-in')
+    print '%-10s %12s %12s %12s %12s' % (
+        'backend', 'put', 'reserve+del', 'put_many', 'batch r+d')
+    for name, connect in backends:
+        conn = connect()
+        conn.use(tube)
+        conn.watch(tube)
+        conn.ignore('default')
+
+        start = time.time()
+        for _, body, priority, delay in puts:
+            conn.put(body, priority=priority, delay=delay)
+        put_time = time.time() - start
+        start = time.time()
+        for i in range(args.jobs):
+            conn.reserve(timeout=0).delete()
+        reserve_time = time.time() - start
+
+        start = time.time()
+        conn.put_many(puts)
+        put_many_time = time.time() - start
+        start = time.time()
+        consumed = 0
+        while consumed < args.jobs:
+            jobs = conn.reserve_many(args.batch)
+            consumed += conn.delete_many([job.jid for job in jobs])
+        batch_time = time.time() - start
+        conn.close()
+        print '%-10s %10.0f/s %10.0f/s %10.0f/s %10.0f/s' % (
+            name, args.jobs / put_time, args.jobs / reserve_time,
+            args.jobs / put_many_time, args.jobs / batch_time)
+
+    # what a restart costs: replaying the segments of queued jobs
+    local_queue.LocalConnection(local).put_many(puts)
+    local.close()
+    start = time.time()
+    local = local_queue.LocalQueue(
+        os.path.join(directory, 'queue'), args.segment_bytes)
+    print 'local replay of %d jobs: %.2fs' % (
+        args.jobs, time.time() - start)
+    local.close()
+    if server is not None:
+        server.shutdown()
+    shutil.rmtree(directory)
+
+
+def bench_http2(args):
+    server = FakeHTTP2Gateway(latency=args.latency / 1000.0).start()
+    payload = apns.Payload(alert='Benchmark', badge=1).json()
+    notifications = [
+        ('%064x' % i, payload, i, 0) for i in range(args.notifications)]
+
+    print 'notifications: %d, gateway latency: %d ms' % (
+        args.notifications, args.latency)
+    for streams in (1, args.streams):
+        connection = apns.HTTP2GatewayConnection(
+            '127.0.0.1', server.port, topic='bench', secure=False,
+            max_concurrent_streams=streams)
+        start = time.time()
+        results = connection.send_notifications(notifications)
+        elapsed = time.time() - start
+        connection.close()
+        ok = sum(1 for status, reason in results if status == 200)
+        print '%4d streams: %8.0f notifications/s, %d ok' % (
+            streams, args.notifications / elapsed, ok)
+    server.shutdown()
+
+
+def bench_codec(args):
+    jobs = []
+    for i in range(args.jobs):
+        job = dict(
+            app_name='bench_app', payload=dict(alert='Benchmark', badge=1))
+        if args.tokens > 1:
+            job['device_tokens'] = [
+                '%064x' % (i * args.tokens + j) for j in range(args.tokens)]
+        else:
+            job['device_token'] = '%064x' % i
+        jobs.append(job)
+
+    print 'jobs: %d, tokens per job: %d' % (args.jobs, args.tokens)
+    for name, encode in (
+            ('json', json.dumps), ('binary', codec.encode_binary)):
+        bodies = [encode(job) for job in jobs]
+        start = time.time()
+        for body in bodies:
+            codec.decode(body)
+        elapsed = time.time() - start
+        print '%-6s %8.0f bytes/job, %8.0f decodes/s' % (
+            name, sum(map(len, bodies)) / float(len(bodies)),
+            len(bodies) / elapsed)
+
+
+class DictPayload(object):
+    """The Payload that built a nested dict and encoded it on every change"""
+    def __init__(self, alert=None, badge=None, sound=None, custom={}):
+        super(DictPayload, self).__init__()
+        self.alert = alert
+        self.badge = badge
+        self.sound = sound
+        self.custom = custom
+        self._json = None
+        self.json()
+
+    def dict(self):
+        d = {}
+        if self.alert:
+            d['alert'] = self.alert
+        if self.sound:
+            d['sound'] = self.sound
+        if self.badge is not None:
+            d['badge'] = int(self.badge)
+        d = {'aps': d}
+        d.update(self.custom)
+        return d
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(
+                self.dict(), separators=(',', ':'),
+                ensure_ascii=False).encode('utf-8')
+        return self._json
+
+
+def bench_payload(args):
+    kwargs = dict(
+        alert=u'Benchmark \u2713', sound='default',
+        custom=dict(id=12345, url='https://example.com/a'))
+    badges = range(args.devices)
+
+    def timed(name, build):
+        start = time.time()
+        for i in range(args.rounds):
+            build()
+        elapsed = time.time() - start
+        print '%-28s %8.0f payloads/s' % (
+            name, args.rounds * args.devices / elapsed)
+
+    print 'rounds: %d, devices with own badge: %d' % (
+        args.rounds, args.devices)
+    timed('dict payload per device', lambda: [
+        DictPayload(badge=badge, **kwargs).json() for badge in badges])
+    timed('slotted payload per device', lambda: [
+        apns.Payload(badge=badge, **kwargs).json() for badge in badges])
+    template = apns.Payload(**kwargs).template()
+    timed('template render per device', lambda: [
+        template.render(badge) for badge in badges])
+    payload = apns.Payload(badge=1, **kwargs)
+    print 'object size: dict payload %d bytes, slotted payload %d bytes' % (
+        sys.getsizeof(DictPayload(badge=1, **kwargs)) +
+        sys.getsizeof(DictPayload(badge=1, **kwargs).__dict__),
+        sys.getsizeof(payload))
+
+
+def percentile(values, p):
+    """values must be sorted"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def rss_kb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def bench_e2e(args):
+    logging.basicConfig(level=logging.WARNING)
+    directory = tempfile.mkdtemp(prefix='push_turbo_bench')
+    cert_file, key_file = make_certificate(directory)
+    beanstalkd = FakeBeanstalkd().start()
+    gateway = FakeAPNsGateway(
+        cert_file, key_file, latency=args.latency / 1000.0,
+        fail_every=args.fail_every).start()
+
+    apps = dict(
+        ('bench_app_%d' % i, (cert_file, key_file, args.pipes))
+        for i in range(args.apps))
+    config.APPS = apps
+    config.BEANSTALKD_PORT = beanstalkd.port
+    config.APNS_PROTOCOL = 'binary'
+    config.APNS_HOST = '127.0.0.1'
+    config.APNS_PORT = gateway.port
+    config.INVALID_TOKENS_FILE = os.path.join(directory, 'invalid_tokens')
+    config.ENGINE_WATCH_INTERVAL = 0.5
+    config.RATE_LIMITS = dict(
+        (app_name, (args.rate, args.rate)) for app_name in apps
+        if args.rate)
+    if args.delivery_log:
+        config.DELIVERY_LOG_DIR = directory
+    config.QUEUE_BACKEND = args.queue
+    config.LOCAL_QUEUE_DIR = os.path.join(directory, 'queue')
+    # api and push read config when imported
+    import app
+    import push
+    app.app.logger.setLevel(logging.WARNING)
+    if args.delivery_log:
+        push.delivery_log = deliveries.open_log('bench')
+
+    for i in range(args.batch_workers):
+        t = threading.Thread(
+            target=batch_push.batch_push, args=('127.0.0.1', beanstalkd.port))
+        t.daemon = True
+        t.start()
+    engine = threading.Thread(target=push.Engine(apps).run)
+    engine.daemon = True
+    engine.start()
+
+    client = app.app.test_client()
+    app_names = sorted(apps)
+    count = args.notifications
+    enqueued = [0] * count
+    high = set()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    for first in range(0, count, args.per_request):
+        jobs = []
+        indexes = range(first, min(count, first + args.per_request))
+        for j in range(0, len(indexes), args.devices_per_job):
+            tokens = ['%064x' % i for i in indexes[j:j + args.devices_per_job]]
+            job = dict(
+                app_name=app_names[indexes[j] % len(app_names)],
+                payload=dict(alert='Benchmark %d' % (indexes[j] % 10)))
+            if args.high_every and indexes[j] % args.high_every == 0:
+                job['priority'] = 'high'
+                high.update(indexes[j:j + args.devices_per_job])
+            if len(tokens) > 1:
+                job['device_tokens'] = tokens
+            else:
+                job['device_token'] = tokens[0]
+            jobs.append(job)
+        now = time.time()
+        for i in indexes:
+            enqueued[i] = now
+        response = client.post(
+            '/api/push', data=json.dumps(jobs),
+            content_type='application/json')
+        if response.status_code != 200:
+            raise RuntimeError('Enqueue failed: %s' % response.data)
+    enqueue_time = time.time() - start
+
+    deadline = start + args.timeout
+    while gateway.accounted() < count and time.time() < deadline:
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = after.ru_utime - usage.ru_utime + after.ru_stime - usage.ru_stime
+
+    latencies = []
+    high_latencies = []
+    for token_hex, arrival in gateway.arrivals.items():
+        i = int(token_hex, 16)
+        latencies.append(arrival - enqueued[i])
+        if i in high:
+            high_latencies.append(arrival - enqueued[i])
+    latencies.sort()
+    high_latencies.sort()
+    delivered = len(gateway.arrivals)
+    if delivered:
+        elapsed = max(gateway.arrivals.values()) - start
+    print 'notifications: %d, apps: %d, pipes per app: %d, per request: ' \
+        '%d, devices per job: %d, latency: %d ms, fail every: %d' % (
+            count, args.apps, args.pipes, args.per_request,
+            args.devices_per_job, args.latency, args.fail_every)
+    print 'delivered:   %d (%d failed, %d missing)' % (
+        delivered, len(gateway.failed),
+        count - gateway.accounted())
+    print 'resent:      %d after error responses, %d duplicates' % (
+        gateway.resent, gateway.duplicates)
+    print 'enqueue:     %8.0f notifications/s' % (count / enqueue_time)
+    print 'end to end:  %8.0f notifications/s' % (delivered / elapsed)
+    print 'latency:     p50 %.1f ms, p99 %.1f ms' % (
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+    if high_latencies:
+        print 'high:        p50 %.1f ms, p99 %.1f ms (%d notifications)' % (
+            percentile(high_latencies, 50) * 1000,
+            percentile(high_latencies, 99) * 1000, len(high_latencies))
+    print 'cpu:         %.2fs (%.0f%% of one core)' % (
+        cpu, 100 * cpu / elapsed)
+    print 'rss:         %d KB now, %d KB peak' % (rss_kb(), after.ru_maxrss)
+    print 'connections: %d' % gateway.connections
+    if args.delivery_log:
+        response = client.get('/api/deliveries?minutes=5')
+        for summary in json.loads(response.data)['apps']:
+            print 'logged:      %s sent %d, failed %d, p50 <= %ss, ' \
+                'p99 <= %ss' % (
+                    summary['app_name'], summary['sent'], summary['failed'],
+                    summary['p50'], summary['p99'])
+    shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks against local beanstalkd/APNs stand-ins')
+    subparsers = parser.add_subparsers()
+
+    enqueue = subparsers.add_parser(
+        'enqueue', help='batch_push enqueue, per job vs pipelined puts')
+    enqueue.add_argument('--jobs', type=int, default=20000)
+    enqueue.add_argument('--apps', type=int, default=4)
+    enqueue.set_defaults(func=bench_enqueue)
+
+    job_codec = subparsers.add_parser(
+        'codec', help='push job bodies, JSON vs the binary codec')
+    job_codec.add_argument('--jobs', type=int, default=20000)
+    job_codec.add_argument('--tokens', type=int, default=1)
+    job_codec.set_defaults(func=bench_codec)
+
+    payload = subparsers.add_parser(
+        'payload', help='encoding payloads with a badge per device')
+    payload.add_argument('--rounds', type=int, default=200)
+    payload.add_argument('--devices', type=int, default=500)
+    payload.set_defaults(func=bench_payload)
+
+    e2e = subparsers.add_parser(
+        'e2e', help='/api/push, batch_push and push against local '
+        'beanstalkd and APNs stand-ins')
+    e2e.add_argument('--notifications', type=int, default=20000)
+    e2e.add_argument('--apps', type=int, default=2)
+    e2e.add_argument('--pipes', type=int, default=2)
+    e2e.add_argument('--batch-workers', type=int, default=2)
+    e2e.add_argument(
+        '--per-request', type=int, default=100,
+        help='notifications per /api/push request')
+    e2e.add_argument('--devices-per-job', type=int, default=1)
+    e2e.add_argument('--latency', type=int, default=0, help='ms per read')
+    e2e.add_argument(
+        '--fail-every', type=int, default=0,
+        help='answer every Nth frame with an invalid token error')
+    e2e.add_argument(
+        '--rate', type=int, default=0,
+        help='rate limit of every app, notifications per second')
+    e2e.add_argument(
+        '--high-every', type=int, default=0,
+        help='send every Nth job with high priority')
+    e2e.add_argument('--timeout', type=int, default=120)
+    e2e.add_argument(
+        '--queue', choices=('beanstalk', 'local'), default='beanstalk',
+        help='QUEUE_BACKEND to push through')
+    e2e.add_argument(
+        '--delivery-log', action='store_true',
+        help='record deliveries and report them from /api/deliveries')
+    e2e.set_defaults(func=bench_e2e)
+
+    queue = subparsers.add_parser(
+        'queue', help='beanstalkd vs the local queue, per job vs batched')
+    queue.add_argument('--jobs', type=int, default=20000)
+    queue.add_argument(
+        '--batch', type=int, default=500, help='jobs per reserve_many')
+    queue.add_argument(
+        '--beanstalkd', help='host:port of a beanstalkd to use instead of '
+        'the in-process stand-in')
+    queue.add_argument(
+        '--segment-bytes', type=int, default=64 * 1024 * 1024)
+    queue.set_defaults(func=bench_queue)
+
+    http2 = subparsers.add_parser(
+        'http2', help='HTTP/2 provider API, one vs concurrent streams')
+    http2.add_argument('--notifications', type=int, default=2000)
+    http2.add_argument('--streams', type=int, default=500)
+    http2.add_argument('--latency', type=int, default=20, help='ms')
+    http2.set_defaults(func=bench_http2)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from binascii import a2b_hex, b2a_hex
+import json
+from struct import Struct, error as StructError
+
+import config
+
+
+MAGIC = '\xffJ'
+VERSION = 1
+# the job has one device_token rather than a device_tokens list
+FLAG_SINGLE = 1
+JOB_HEADER = Struct(
+    '!'  # network big-endian
+    '2s'  # magic
+    'B'  # version
+    'B'  # flags
+    'I'  # token count
+    'H'  # payload length
+    'H'  # extra fields length
+)
+TOKEN_LENGTH = 32
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+class Interner(object):
+    """
+    Decodes JSON through a bounded cache, so the jobs of one broadcast
+    share a single payload dict instead of parsing it each. The cache is
+    simply emptied when full.
+    """
+    def __init__(self, size=1024):
+        super(Interner, self).__init__()
+        self.size = size
+        self._cache = {}
+
+    def get(self, value_json):
+        value = self._cache.get(value_json)
+        if value is None:
+            if len(self._cache) >= self.size:
+                self._cache.clear()
+            value = self._cache[value_json] = json.loads(value_json)
+        return value
+
+
+_interned = Interner()
+
+
+def _binary_tokens(job):
+    device_tokens = job.get('device_tokens')
+    if device_tokens is None:
+        device_tokens = [job.get('device_token')]
+    tokens = []
+    for device_token in device_tokens:
+        try:
+            token = a2b_hex(device_token)
+        except TypeError:
+            return None
+        if len(token) != TOKEN_LENGTH:
+            return None
+        tokens.append(token)
+    return tokens
+
+
+def encode_binary(job):
+    """
+    Packs a push job as a header, the payload JSON, the other fields as
+    JSON and the raw 32 byte tokens. Returns None for jobs that can't be
+    packed, e.g. with malformed tokens, which stay JSON.
+    """
+    tokens = _binary_tokens(job)
+    if tokens is None:
+        return None
+    flags = 0
+    if job.get('device_tokens') is None:
+        flags |= FLAG_SINGLE
+    payload = _dumps(job['payload'])
+    extra = dict(job)
+    extra.pop('payload')
+    extra.pop('device_token', None)
+    extra.pop('device_tokens', None)
+    extra = _dumps(extra) if extra else ''
+    if len(payload) > 0xffff or len(extra) > 0xffff:
+        return None
+    return ''.join([
+        JOB_HEADER.pack(
+            MAGIC, VERSION, flags, len(tokens), len(payload), len(extra)),
+        payload, extra] + tokens)
+
+
+def decode_binary(body):
+    try:
+        magic, version, flags, token_count, payload_length, extra_length = \
+            JOB_HEADER.unpack_from(body)
+    except StructError:
+        raise ValueError('Truncated job header')
+    if version != VERSION:
+        raise ValueError('Unknown job version %d' % version)
+    offset = JOB_HEADER.size
+    job = {}
+    if extra_length:
+        start = offset + payload_length
+        # the extra fields are shared too, so copy them
+        job.update(_interned.get(body[start:start + extra_length]))
+    job['payload'] = _interned.get(body[offset:offset + payload_length])
+    offset += payload_length + extra_length
+    if len(body) != offset + token_count * TOKEN_LENGTH:
+        raise ValueError('Job length does not match its token count')
+    tokens_hex = b2a_hex(body[offset:])
+    hex_length = 2 * TOKEN_LENGTH
+    device_tokens = [
+        tokens_hex[i:i + hex_length]
+        for i in range(0, len(tokens_hex), hex_length)]
+    if flags & FLAG_SINGLE:
+        job['device_token'] = device_tokens[0]
+    else:
+        job['device_tokens'] = device_tokens
+    return job
+
+
+def encode(job):
+    """Returns the body of a push job in the configured JOB_FORMAT"""
+    if config.JOB_FORMAT == 'binary':
+        body = encode_binary(job)
+        if body is not None:
+            return body
+    return json.dumps(job)
+
+
+def decode(body):
+    """
+    Returns the push job of a body in either format, raises ValueError
+    for malformed bodies.
+    """
+    if body.startswith(MAGIC):
+        return decode_binary(body)
+    return json.loads(body)
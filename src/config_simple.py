@@ -8,20 +8,168 @@ APPS = {
 }
 
 BATCH_WORKER_COUNT = 10
+# put commands written to beanstalkd before reading their replies
+BATCH_PIPELINE_SIZE = 1000
 BEANSTALKD_HOST = '127.0.0.1'
 BEANSTALKD_PORT = 11300
+# 'beanstalk': jobs are queued in beanstalkd at BEANSTALKD_HOST
+# 'local': jobs are queued in segment files in LOCAL_QUEUE_DIR, embedded in
+# the one process of single_node.py running the api, batch workers and
+# pushers
+QUEUE_BACKEND = 'beanstalk'
+LOCAL_QUEUE_DIR = '/var/tmp/push_turbo/queue'
+LOCAL_QUEUE_SEGMENT_BYTES = 64 * 1024 * 1024
+SINGLE_NODE_PORT = 5000
+
+# beanstalk connections shared by the api handlers of one process
+BEANSTALK_POOL_SIZE = 20
+BEANSTALK_POOL_CHECK_INTERVAL = 30
+BEANSTALK_POOL_TIMEOUT = 5
 
 PRIORITIES = dict(low=4294967295, normal=2147483647, high=0)
 
 PUSH_TUBE = 'ios_push.%s'
+# jobs of FAST_LANE_PRIORITIES go to PUSH_FAST_TUBE instead, which every
+# pipe of the app drains first and PUSH_FAST_PIPES extra pipes per app
+# drain without lingering for batches
+PUSH_FAST_TUBE = 'ios_push_fast.%s'
+FAST_LANE_PRIORITIES = ('high',)
+PUSH_FAST_PIPES = 1
+# body of the jobs in PUSH_TUBE: 'json', or 'binary' for the compact codec
+# of codec.py, which reads both
+JOB_FORMAT = 'json'
 BATCH_PUSH_TUBE = 'ios_batch_push'
+# batch jobs wait in one lane per priority and app, the tube
+# BATCH_PUSH_TUBE.<priority>.<app_name>. Fast lanes are expanded first,
+# the others share the batch workers by BATCH_LANE_WEIGHTS times the app's
+# APP_WEIGHTS (default 1). New lanes are picked up every
+# BATCH_LANE_REFRESH_INTERVAL seconds.
+BATCH_LANE_WEIGHTS = dict(normal=4, low=1)
+APP_WEIGHTS = {}
+BATCH_LANE_REFRESH_INTERVAL = 1
+# (app, device_token, collapse_key) of the latest single device jobs
+# remembered by every api and batch_push process to delete the queued jobs
+# they supersede
+COLLAPSE_INDEX_SIZE = 100000
+# batch jobs are cut at this size, below beanstalkd's max job size (-z)
+BATCH_JOB_MAX_BYTES = 60000
+
+# /api/push_stream: longest accepted NDJSON line and line errors reported
+STREAM_MAX_LINE_BYTES = 1024 * 1024
+STREAM_MAX_ERRORS = 100
 
 LOGGING_LEVEL = 10
 LOGGING_FORMAT = \
     '%(asctime)s - %(levelname)s - %(threadName)s - %(funcName)s - %(message)s'
 LOGGING_HANDLERS = []
+# levels of single subsystems: push, batch_push, supervisor, apns
+LOGGING_LEVELS = {}
+# share of the debug and info records of push, batch_push or supervisor
+# that are logged at all
+LOGGING_SAMPLE_RATES = {
+    'push': 1,
+    'batch_push': 1,
+}
+# messages, e.g. with job bodies, are cut after this many chars
+LOGGING_MAX_MESSAGE_LENGTH = 2000
+# write logs from a background thread, dropping records beyond the queue
+LOGGING_ASYNC = True
+LOGGING_QUEUE_SIZE = 10000
 
 APNS_HOST = '127.0.0.1'
 APNS_PORT = 2190
+# keep a handshaken spare gateway connection per pipe for fast reconnects
+GATEWAY_STANDBY = True
+
+# 'binary': the legacy binary protocol on APNS_HOST:APNS_PORT
+# 'http2': the HTTP/2 provider API on APNS_HTTP2_HOST:APNS_HTTP2_PORT
+APNS_PROTOCOL = 'binary'
+APNS_HTTP2_HOST = 'api.push.apple.com'
+APNS_HTTP2_PORT = 443
+# False speaks HTTP/2 without TLS, for local stand-ins only
+APNS_HTTP2_SECURE = True
+APNS_HTTP2_CONCURRENT_STREAMS = 500
+# times a notification is requeued after 429, 5xx or GOAWAY
+APNS_HTTP2_MAX_RETRIES = 3
+# token authentication, the app certificates in APPS are used without it
+APNS_AUTH_KEY_FILE = None
+APNS_AUTH_KEY_ID = ''
+APNS_TEAM_ID = ''
+APNS_AUTH_TOKEN_REFRESH = 3000
+# apns-topic of every app, usually its bundle id
+APNS_TOPICS = {
+    'demo_app_name': 'com.example.demo',
+}
 
 EXPIRE_SECONDS = 3600
+
+# tokens rejected by the gateway, shared by api and pushers on one host
+INVALID_TOKENS_FILE = '/var/tmp/push_turbo/invalid_tokens'
+INVALID_TOKENS_CAPACITY = 1000000
+INVALID_TOKENS_ERROR_RATE = 0.0001
+INVALID_TOKENS_REFRESH_INTERVAL = 5
+
+# 'thread': every pipe of APPS is a thread polling its own tube
+# 'gevent': pipes are greenlets started on demand by one tube watcher
+PUSH_ENGINE = 'thread'
+ENGINE_WATCH_INTERVAL = 5
+
+# gevent engine only: size every app between AUTOSCALE_MIN_PIPES and its
+# pipe count in APPS, aiming to drain the backlog in AUTOSCALE_TARGET_SECONDS
+AUTOSCALE = False
+AUTOSCALE_MIN_PIPES = 1
+AUTOSCALE_TARGET_SECONDS = 10
+AUTOSCALE_DOWN_INTERVALS = 6
+
+# gevent engine only: SIGHUP re-reads APPS, APNS_TOPICS and RATE_LIMITS and
+# restarts no pipes but those of removed apps, new certificates are used
+# from the next reconnect. Stopping pipes wait PUSH_DRAIN_SECONDS after
+# their last write for error responses, SIGTERM waits up to
+# PUSH_STOP_TIMEOUT for all of them
+PUSH_DRAIN_SECONDS = 1
+PUSH_STOP_TIMEOUT = 30
+
+# local /metrics ports, None disables them; supervisor.py workers listen on
+# PUSH_METRICS_PORT + 1 + their index
+PUSH_METRICS_PORT = 9300
+BATCH_METRICS_PORT = 9390
+
+# supervisor.py forks PUSH_WORKER_COUNT pushers and shards APPS across them
+PUSH_WORKER_COUNT = 4
+SUPERVISOR_REPORT_INTERVAL = 10
+SUPERVISOR_RESTART_DELAY = 2
+
+# reserve up to PUSH_BATCH_SIZE jobs, waiting at most PUSH_BATCH_LINGER_MS
+# for more to arrive, and write them to the gateway in chunks of about
+# PUSH_BATCH_MAX_BYTES
+PUSH_BATCH_SIZE = 500
+PUSH_BATCH_MAX_BYTES = 65536
+PUSH_BATCH_LINGER_MS = 5
+
+# token buckets pacing the notifications of an app across its pipes,
+# app_name: (per second, burst), or a dict of those by priority name. A
+# pipe reserves no more jobs than the tokens left pay for and waits while
+# a bucket is in debt.
+RATE_LIMITS = {}
+# directory, e.g. under /dev/shm, of mmap'd buckets shared by all push
+# processes of the host instead of one set of buckets per process
+RATE_LIMIT_SHARED_DIR = None
+
+# pushers append a record per notification to segment files in
+# DELIVERY_LOG_DIR, keeping the last DELIVERY_LOG_SEGMENTS, and count them
+# per app and minute for /api/deliveries over DELIVERY_AGGREGATE_MINUTES,
+# for up to DELIVERY_AGGREGATE_APPS apps a minute
+DELIVERY_LOG_DIR = None
+DELIVERY_LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+DELIVERY_LOG_SEGMENTS = 16
+DELIVERY_AGGREGATE_MINUTES = 1440
+DELIVERY_AGGREGATE_APPS = 64
+
+# number of distinct encoded payloads kept per pusher process
+PAYLOAD_CACHE_SIZE = 1024
+
+# bytes of written frames each pipe keeps to replay after an error response
+LEDGER_MAX_BYTES = 8 * 1024 * 1024
+
+# device tokens per broadcast job, keep jobs below beanstalkd's max job size
+BROADCAST_CHUNK_SIZE = 500
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from collections import defaultdict
+import glob
+import hashlib
+import mmap
+import os
+import re
+from struct import Struct
+from threading import Lock
+import time
+import zlib
+
+import config
+
+
+# status of notifications written to the gateway, others are the binary
+# protocol's error status or the HTTP/2 response status
+SENT = 0
+# flag of a failure reported for a notification already recorded as SENT
+CORRECTION = 1
+# jid, enqueued at, sent at, token hash, app id, status, flags
+RECORD = Struct('!QddQIHBx')
+SEGMENT_HEADER = Struct('=Q')  # records written
+
+# seconds from enqueue to send
+LATENCY_BUCKETS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+# minute, app id, sent, failed, then the latency histogram with +Inf.
+# sent is signed, a correction may land in a later minute than its send
+SLOT = Struct('=IIiI%dI' % (len(LATENCY_BUCKETS) + 1))
+_HASH = Struct('!Q')
+
+
+def app_id(app_name):
+    if isinstance(app_name, unicode):
+        app_name = app_name.encode('utf-8')
+    return zlib.crc32(app_name) & 0xffffffff
+
+
+def token_hash(token_hex):
+    return _HASH.unpack_from(hashlib.sha1(token_hex).digest())[0]
+
+
+class Aggregates(object):
+    """
+    Counts and latency histograms per app and minute, in an mmap'd ring
+    of minutes x apps slots written by one process and read by any.
+    A slot is reused once its minute is out of the ring.
+    """
+    def __init__(self, path, minutes, apps, readonly=False):
+        super(Aggregates, self).__init__()
+        self.path = path
+        self.minutes = minutes
+        self.apps = apps
+        size = minutes * apps * SLOT.size
+        if readonly:
+            with open(path, 'rb') as f:
+                self._map = mmap.mmap(
+                    f.fileno(), size, access=mmap.ACCESS_READ)
+            return
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _find(self, minute, app, create):
+        row = (minute % self.minutes) * self.apps
+        free = None
+        for i in range(self.apps):
+            offset = (row + i) * SLOT.size
+            slot_minute, slot_app = SLOT.unpack_from(self._map, offset)[:2]
+            if slot_minute == minute and slot_app == app:
+                return offset
+            if free is None and slot_minute != minute:
+                free = offset
+        if not create or free is None:
+            return None
+        SLOT.pack_into(
+            self._map, free, minute, app,
+            *([0] * (SLOT.size // 4 - 2)))
+        return free
+
+    def add(self, minute, app, sent, failed, latencies):
+        """Adds to the counts of app in minute, latencies by bucket"""
+        offset = self._find(minute, app, True)
+        if offset is None:
+            # more apps in this minute than slots
+            return
+        values = list(SLOT.unpack_from(self._map, offset))
+        values[2] += sent
+        values[3] += failed
+        for bucket, count in latencies.items():
+            values[4 + bucket] += count
+        SLOT.pack_into(self._map, offset, *values)
+
+    def get(self, minute, app):
+        """Returns (sent, failed, latency histogram) of app in minute"""
+        offset = self._find(minute, app, False)
+        if offset is None:
+            return None
+        values = SLOT.unpack_from(self._map, offset)
+        return values[2], values[3], values[4:]
+
+    def close(self):
+        self._map.close()
+
+
+class DeliveryLog(object):
+    """
+    Appends a record per notification to mmap'd segment files of one
+    writer, <directory>/<name>.<n>.log, starting a new one when a
+    segment is full and keeping the last `segments`. The aggregates of
+    the writer, <name>.agg, are updated with every append.
+    """
+    def __init__(
+            self, directory, name, segment_bytes=64 * 1024 * 1024,
+            segments=16, minutes=1440, apps=64):
+        super(DeliveryLog, self).__init__()
+        self.directory = directory
+        self.name = name
+        self.capacity = (segment_bytes - SEGMENT_HEADER.size) // RECORD.size
+        self.segments = segments
+        self.aggregates = Aggregates(
+            os.path.join(directory, name + '.agg'), minutes, apps)
+        self._lock = Lock()
+        self._map = None
+        numbers = self._segment_numbers()
+        self._open(numbers[-1] if numbers else 0)
+
+    def _segment_path(self, number):
+        return os.path.join(
+            self.directory, '%s.%d.log' % (self.name, number))
+
+    def _segment_numbers(self):
+        pattern = re.compile(r'%s\.(\d+)\.log$' % re.escape(self.name))
+        numbers = []
+        for path in os.listdir(self.directory):
+            match = pattern.match(path)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _open(self, number):
+        if self._map is not None:
+            self._map.close()
+        size = SEGMENT_HEADER.size + self.capacity * RECORD.size
+        fd = os.open(self._segment_path(number), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.number = number
+        self.count = SEGMENT_HEADER.unpack_from(self._map)[0]
+        for old in self._segment_numbers()[:-self.segments]:
+            os.remove(self._segment_path(old))
+
+    def append(self, app_name, records, correction=False):
+        """
+        Appends (jid, token_hex, enqueued_at, sent_at, status) records of
+        app_name. enqueued_at is 0 if unknown, sent_at of failures is
+        when the failure was reported. With correction, the records are
+        failures of notifications appended as SENT before, which then
+        count as failed instead of sent.
+        """
+        app = app_id(app_name)
+        flags = CORRECTION if correction else 0
+        counts = defaultdict(lambda: [0, 0, defaultdict(int)])
+        with self._lock:
+            for jid, token_hex, enqueued_at, sent_at, status in records:
+                if self.count >= self.capacity:
+                    self._open(self.number + 1)
+                RECORD.pack_into(
+                    self._map,
+                    SEGMENT_HEADER.size + self.count * RECORD.size,
+                    jid or 0, enqueued_at or 0, sent_at,
+                    token_hash(token_hex), app, status, flags)
+                self.count += 1
+                # readers only trust the records counted in the header
+                SEGMENT_HEADER.pack_into(self._map, 0, self.count)
+
+                minute_counts = counts[int(sent_at // 60)]
+                if status == SENT:
+                    minute_counts[0] += 1
+                    if enqueued_at:
+                        minute_counts[2][bisect_left(
+                            LATENCY_BUCKETS, sent_at - enqueued_at)] += 1
+                else:
+                    minute_counts[1] += 1
+                    if correction:
+                        minute_counts[0] -= 1
+            for minute, (sent, failed, latencies) in counts.items():
+                self.aggregates.add(minute, app, sent, failed, latencies)
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            self.aggregates.close()
+
+
+def open_log(name):
+    """Returns the DeliveryLog of writer name, None without a directory"""
+    if not config.DELIVERY_LOG_DIR:
+        return None
+    return DeliveryLog(
+        config.DELIVERY_LOG_DIR, name,
+        segment_bytes=config.DELIVERY_LOG_SEGMENT_BYTES,
+        segments=config.DELIVERY_LOG_SEGMENTS,
+        minutes=config.DELIVERY_AGGREGATE_MINUTES,
+        apps=config.DELIVERY_AGGREGATE_APPS)
+
+
+def percentile(histogram, p):
+    """The bucket bound below which p percent of a histogram falls"""
+    total = sum(histogram)
+    if not total:
+        return None
+    count = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS + (None,), histogram):
+        count += bucket_count
+        if count * 100.0 >= total * p:
+            return bound
+    return None
+
+
+def summary(app_name, minutes, now=None):
+    """
+    Returns the per minute counts and latency percentiles of app_name
+    for the last minutes, merged from the aggregates of all writers.
+    sent and failed don't overlap: sent counts the notifications the
+    gateway accepted, or at least didn't reject, failed those it
+    rejected or left unanswered, so their sum is the notifications
+    pushed. The latencies of the binary protocol include notifications
+    it rejected after they were written.
+    """
+    now = time.time() if now is None else now
+    current = int(now // 60)
+    app = app_id(app_name)
+    readers = []
+    for path in glob.glob(os.path.join(config.DELIVERY_LOG_DIR, '*.agg')):
+        try:
+            readers.append(Aggregates(
+                path, config.DELIVERY_AGGREGATE_MINUTES,
+                config.DELIVERY_AGGREGATE_APPS, readonly=True))
+        except (ValueError, EnvironmentError):
+            # written with another ring size
+            continue
+    minutes = min(minutes, config.DELIVERY_AGGREGATE_MINUTES)
+    rows = []
+    total_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    total_sent = total_failed = 0
+    try:
+        for minute in range(current - minutes + 1, current + 1):
+            sent = failed = 0
+            histogram = [0] * len(total_histogram)
+            for reader in readers:
+                values = reader.get(minute, app)
+                if values is None:
+                    continue
+                sent += values[0]
+                failed += values[1]
+                for i, count in enumerate(values[2]):
+                    histogram[i] += count
+            if not sent and not failed:
+                continue
+            rows.append(dict(
+                minute=minute * 60, sent=sent, failed=failed,
+                p50=percentile(histogram, 50),
+                p99=percentile(histogram, 99)))
+            total_sent += sent
+            total_failed += failed
+            for i, count in enumerate(histogram):
+                total_histogram[i] += count
+    finally:
+        for reader in readers:
+            reader.close()
+    return dict(
+        app_name=app_name, minutes=rows, sent=total_sent,
+        failed=total_failed,
+        p50=percentile(total_histogram, 50),
+        p90=percentile(total_histogram, 90),
+        p99=percentile(total_histogram, 99))
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from array import array
+from binascii import a2b_hex, b2a_hex
+from hashlib import md5
+import math
+import mmap
+import os
+from struct import Struct
+from threading import Lock
+import time
+
+import config
+
+
+TOKEN_LENGTH = 32
+HASHES = Struct('<QQ')
+# the leading bytes of a token, random enough to hash records by
+SLOT_KEY = Struct('<Q')
+
+
+class BloomFilter(object):
+    """A bit array bloom filter sized for capacity keys at error_rate"""
+    def __init__(self, capacity, error_rate=0.001):
+        super(BloomFilter, self).__init__()
+        bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.bit_count = max(bits, 8)
+        self.hash_count = max(int(round(
+            self.bit_count / float(capacity) * math.log(2))), 1)
+        self._bits = bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, key):
+        h1, h2 = HASHES.unpack(md5(key).digest())
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class InvalidTokenStore(object):
+    """
+    Device tokens the gateway rejected as invalid.
+
+    Tokens are appended as 32 byte records to a file shared by every
+    process, which is memory mapped for lookups. A bloom filter in front
+    answers most lookups without touching the map, an open addressing
+    table of record numbers finds the record of the others. Records
+    appended by other processes are picked up every refresh_interval
+    seconds.
+    """
+    def __init__(
+            self, path, capacity=1000000, error_rate=0.0001,
+            refresh_interval=5):
+        super(InvalidTokenStore, self).__init__()
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.bloom = BloomFilter(capacity, error_rate)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        self._map = None
+        self._size = 0
+        # record number + 1 by slot, 0 for free slots, at most half full
+        self._slots = array('I', [0]) * 1024
+        self._last_refresh = 0
+        self._lock = Lock()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            self._last_refresh = time.time()
+            size = os.fstat(self._fd).st_size
+            size -= size % TOKEN_LENGTH
+            if size <= self._size:
+                return
+            new_map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            count = size // TOKEN_LENGTH
+            start = self._size // TOKEN_LENGTH
+            slots = self._slots
+            if count * 2 > len(slots):
+                slots_size = len(slots)
+                while count * 2 > slots_size:
+                    slots_size *= 2
+                slots = array('I', [0]) * slots_size
+                start = 0
+            for number in range(start, count):
+                offset = number * TOKEN_LENGTH
+                token = new_map[offset:offset + TOKEN_LENGTH]
+                if offset >= self._size:
+                    self.bloom.add(token)
+                self._index(slots, number, token)
+            # lookups may take the new map with the old slots, not the
+            # other way round; the old map is closed once none holds it
+            self._map = new_map
+            self._slots = slots
+            self._size = size
+
+    @staticmethod
+    def _index(slots, number, token):
+        mask = len(slots) - 1
+        slot = SLOT_KEY.unpack_from(token)[0] & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = number + 1
+
+    def _find(self, token):
+        token_map = self._map
+        slots = self._slots
+        if token_map is None:
+            return False
+        mask = len(slots) - 1
+        slot = SLOT_KEY.unpack_from(token)[0] & mask
+        number = slots[slot]
+        while number:
+            offset = (number - 1) * TOKEN_LENGTH
+            if token_map[offset:offset + TOKEN_LENGTH] == token:
+                return True
+            slot = (slot + 1) & mask
+            number = slots[slot]
+        return False
+
+    def __contains__(self, token_hex):
+        try:
+            token = a2b_hex(token_hex)
+        except TypeError:
+            return False
+        if time.time() - self._last_refresh > self.refresh_interval:
+            self.refresh()
+        if token not in self.bloom:
+            return False
+        return self._find(token)
+
+    def __len__(self):
+        return self._size // TOKEN_LENGTH
+
+    def add(self, token_hex):
+        try:
+            token = a2b_hex(token_hex)
+        except TypeError:
+            return
+        if len(token) != TOKEN_LENGTH or token_hex in self:
+            return
+        os.write(self._fd, token)
+        self.refresh()
+
+    def tokens(self, offset=0, limit=None):
+        """Yields the stored tokens as hex, oldest first"""
+        start = offset * TOKEN_LENGTH
+        end = self._size
+        if limit is not None:
+            end = min(end, start + limit * TOKEN_LENGTH)
+        for position in range(start, end, TOKEN_LENGTH):
+            yield b2a_hex(self._map[position:position + TOKEN_LENGTH])
+
+
+_store = None
+
+
+def get_store():
+    """Returns the process wide store, opened on first use"""
+    global _store
+    if _store is None:
+        _store = InvalidTokenStore(
+            config.INVALID_TOKENS_FILE,
+            capacity=config.INVALID_TOKENS_CAPACITY,
+            error_rate=config.INVALID_TOKENS_ERROR_RATE,
+            refresh_interval=config.INVALID_TOKENS_REFRESH_INTERVAL)
+    return _store
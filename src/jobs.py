@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from functools import partial
+import json
+from threading import Lock
+import zlib
+
+import config
+
+
+def priority_name(job):
+    """The priority of a push job, low for missing or unknown ones"""
+    priority = job.get('priority', 'low')
+    if priority not in config.PRIORITIES:
+        return 'low'
+    return priority
+
+
+def push_tube(job):
+    """The tube of a push job, its app's fast lane for urgent ones"""
+    if priority_name(job) in config.FAST_LANE_PRIORITIES:
+        return config.PUSH_FAST_TUBE % job['app_name']
+    return config.PUSH_TUBE % job['app_name']
+
+
+def batch_tube(priority, app_name):
+    """The batch lane of the jobs of app_name with priority"""
+    return '%s.%s.%s' % (config.BATCH_PUSH_TUBE, priority, app_name)
+
+
+def parse_batch_tube(tube):
+    """Returns (priority, app_name) of a batch lane, None for other tubes"""
+    prefix = config.BATCH_PUSH_TUBE + '.'
+    if not tube.startswith(prefix):
+        return None
+    priority, _, app_name = tube[len(prefix):].partition('.')
+    if priority not in config.PRIORITIES or not app_name:
+        return None
+    return priority, app_name
+
+
+def check_badges(job):
+    """
+    Raises ValueError unless the badges of a broadcast job, if any, are
+    integers aligned with its device tokens, for a payload without a
+    custom aps that would leave no badge to set.
+    """
+    badges = job.get('badges')
+    if badges is None:
+        return
+    device_tokens = job.get('device_tokens')
+    if not isinstance(badges, list) or \
+            not isinstance(device_tokens, list) or \
+            len(badges) != len(device_tokens):
+        raise ValueError('Badges do not match the device tokens')
+    for badge in badges:
+        if not isinstance(badge, (int, long)) or isinstance(badge, bool):
+            raise ValueError('Invalid badge %r' % (badge,))
+    payload = job.get('payload')
+    custom = payload.get('custom') if isinstance(payload, dict) else None
+    if isinstance(custom, dict) and 'aps' in custom:
+        raise ValueError('A custom aps has no badge to replace')
+
+
+def expand(job):
+    """
+    Splits a broadcast job into jobs of at most BROADCAST_CHUNK_SIZE
+    device tokens, and their badges. A single device job is returned
+    unchanged.
+    """
+    device_tokens = job.get('device_tokens')
+    if device_tokens is None:
+        return [job]
+    badges = job.get('badges')
+    chunks = []
+    for i in range(0, len(device_tokens), config.BROADCAST_CHUNK_SIZE):
+        chunk = dict(job)
+        chunk['device_tokens'] = \
+            device_tokens[i:i + config.BROADCAST_CHUNK_SIZE]
+        if badges is not None:
+            chunk['badges'] = badges[i:i + config.BROADCAST_CHUNK_SIZE]
+        chunks.append(chunk)
+    return chunks
+
+
+def drop_invalid_tokens(jobs, invalid_tokens):
+    """
+    Removes device tokens found in invalid_tokens from jobs, returns the
+    jobs left and the number of tokens dropped.
+    """
+    kept = []
+    dropped = 0
+    for job in jobs:
+        device_tokens = job.get('device_tokens')
+        if device_tokens is None:
+            if job.get('device_token') in invalid_tokens:
+                dropped += 1
+            else:
+                kept.append(job)
+            continue
+        valid = [
+            i for i, device_token in enumerate(device_tokens)
+            if device_token not in invalid_tokens]
+        dropped += len(device_tokens) - len(valid)
+        if len(valid) == len(device_tokens):
+            kept.append(job)
+        elif valid:
+            job = dict(job, device_tokens=[device_tokens[i] for i in valid])
+            badges = job.get('badges')
+            if badges is not None:
+                job['badges'] = [badges[i] for i in valid]
+            kept.append(job)
+    return kept, dropped
+
+
+class BatchBuilder(object):
+    """
+    Packs push jobs into batch jobs of at most max_bytes of JSON. Every
+    batch is handed to put as soon as it is full, broadcast jobs are
+    expanded first so that each of their chunks fits.
+    """
+    def __init__(self, put, max_bytes):
+        super(BatchBuilder, self).__init__()
+        self.put = put
+        self.max_bytes = max_bytes
+        self.jobs = 0
+        self.batches = 0
+        self._bodies = []
+        self._size = 2
+
+    def add(self, job):
+        for chunk in expand(job):
+            body = json.dumps(chunk)
+            if self._bodies and self._size + len(body) + 1 > self.max_bytes:
+                self.flush()
+            self._bodies.append(body)
+            self._size += len(body) + 1
+            self.jobs += 1
+
+    def flush(self):
+        if not self._bodies:
+            return
+        self.put('[%s]' % ','.join(self._bodies))
+        self.batches += 1
+        self._bodies = []
+        self._size = 2
+
+
+class LaneBatchBuilder(object):
+    """
+    Packs push jobs like BatchBuilder, into the batch lane of their
+    priority and app. put is called with (tube, body, priority).
+    """
+    def __init__(self, put, max_bytes):
+        super(LaneBatchBuilder, self).__init__()
+        self.put = put
+        self.max_bytes = max_bytes
+        self._builders = {}
+
+    @property
+    def jobs(self):
+        return sum(builder.jobs for builder in self._builders.values())
+
+    @property
+    def batches(self):
+        return sum(builder.batches for builder in self._builders.values())
+
+    def add(self, job):
+        lane = (priority_name(job), job['app_name'])
+        builder = self._builders.get(lane)
+        if builder is None:
+            put = partial(
+                self.put, batch_tube(*lane),
+                priority=config.PRIORITIES[lane[0]])
+            builder = self._builders[lane] = BatchBuilder(
+                put, self.max_bytes)
+        builder.add(job)
+
+    def flush(self):
+        for builder in self._builders.values():
+            builder.flush()
+
+
+class CollapseIndex(object):
+    """
+    A bounded LRU of the (jid, tube) last put for each (app_name,
+    device_token, collapse_key) of single device jobs, so that the queued
+    job a newer one supersedes can be deleted before it is reserved.
+    """
+    def __init__(self, size=100000):
+        super(CollapseIndex, self).__init__()
+        self.size = size
+        self._jids = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def key(job):
+        """The index key of a push job, None if it doesn't collapse"""
+        collapse_key = job.get('collapse_key')
+        if collapse_key is None or job.get('device_token') is None:
+            return None
+        return job['app_name'], job['device_token'], collapse_key
+
+    def replace(self, key, job):
+        """Records (jid, tube) for key, returns the one it supersedes"""
+        with self._lock:
+            superseded = self._jids.pop(key, None)
+            self._jids[key] = job
+            while len(self._jids) > self.size:
+                self._jids.popitem(last=False)
+        return superseded
+
+    def __len__(self):
+        return len(self._jids)
+
+
+def _read_chunks(stream, gzipped, chunk_size):
+    decompressor = None
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        if decompressor is None:
+            yield data
+            continue
+        # bound the output of every step, whatever the compression ratio
+        while data:
+            yield decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def iter_lines(stream, gzipped=False, chunk_size=65536, max_length=1048576):
+    """
+    Yields the lines of a file like stream as it is read, gunzipping it on
+    the way. At most max_length bytes of a line are held, longer lines are
+    yielded as None.
+    """
+    pending = []
+    pending_size = 0
+    too_long = False
+    for chunk in _read_chunks(stream, gzipped, chunk_size):
+        start = 0
+        end = chunk.find('\n')
+        while end != -1:
+            if too_long or pending_size + end - start > max_length:
+                yield None
+            else:
+                yield ''.join(pending) + chunk[start:end]
+            pending = []
+            pending_size = 0
+            too_long = False
+            start = end + 1
+            end = chunk.find('\n', start)
+        if not too_long:
+            pending.append(chunk[start:])
+            pending_size += len(chunk) - start
+            if pending_size > max_length:
+                too_long = True
+                pending = []
+                pending_size = 0
+    if too_long:
+        yield None
+    elif pending_size:
+        yield ''.join(pending)
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+IDENTIFIER_MASK = 0xffffffff
+
+
+class Ledger(object):
+    """
+    The encoded frames written to the gateway, kept for error replay.
+
+    Frames are stored in a ring indexed by identifier modulo its capacity,
+    so identifiers are added consecutively; a gap, left by frames that
+    were encoded but never written, starts the ledger over. The oldest
+    frames are forgotten once the kept frames exceed max_bytes or the
+    ring is full. Identifiers are the pipe's push ids, the gateway only
+    sees their low 32 bits.
+    """
+    def __init__(self, max_bytes, min_frame_size=64):
+        super(Ledger, self).__init__()
+        self.max_bytes = max_bytes
+        capacity = 1
+        while capacity < max_bytes // min_frame_size:
+            capacity *= 2
+        self._mask = capacity - 1
+        self._slots = [None] * capacity
+        self.first = 0
+        self.next = 0
+        self.size = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.next - self.first
+
+    def add(self, identifier, frame):
+        if identifier != self.next:
+            self.clear()
+            self.first = self.next = identifier
+        while len(self) > self._mask or \
+                (len(self) and self.size + len(frame) > self.max_bytes):
+            self._evict()
+        self._slots[identifier & self._mask] = frame
+        self.size += len(frame)
+        self.next = identifier + 1
+
+    def _evict(self):
+        slot = self.first & self._mask
+        self.size -= len(self._slots[slot])
+        self._slots[slot] = None
+        self.first += 1
+        self.evicted += 1
+
+    def find(self, error_identifier):
+        """
+        Maps a 32 bit identifier from an error response back to a push id
+        in the ledger, returns None if it has already been forgotten.
+        """
+        identifier = (self.next & ~IDENTIFIER_MASK) | error_identifier
+        if identifier >= self.next:
+            identifier -= IDENTIFIER_MASK + 1
+        if self.first <= identifier < self.next:
+            return identifier
+        return None
+
+    def get(self, identifier):
+        return self._slots[identifier & self._mask]
+
+    def fail(self, error_identifier):
+        """
+        Handles an error response: returns the failed frame, or None if
+        it is no longer known, and the frames written after it, which the
+        gateway dropped, then empties the ledger.
+        """
+        identifier = self.find(error_identifier)
+        failed = None
+        tail = []
+        if identifier is not None:
+            failed = self.get(identifier)
+            tail = [self.get(i) for i in range(identifier + 1, self.next)]
+        self.clear()
+        return failed, tail
+
+    def clear(self):
+        # stale slots are overwritten as the ring moves on
+        self.first = self.next
+        self.size = 0
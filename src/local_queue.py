@@ -0,0 +1,732 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+import fcntl
+import heapq
+import mmap
+import os
+import re
+from struct import Struct
+from threading import Condition, Lock
+import time
+
+import beanstalkc
+
+import config
+import logs
+
+
+log = logs.get_logger('local_queue')
+
+READY, RESERVED, DELAYED, BURIED = 'ready', 'reserved', 'delayed', 'buried'
+STATES = (READY, RESERVED, DELAYED, BURIED)
+
+# record operations, a PUT is followed by the tube and body
+PUT, DELETE, RELEASE, BURY = range(1, 5)
+# op, tube length, body length, priority, jid, ready at, created
+RECORD = Struct('=BHIIQdd')
+SEGMENT_HEADER = Struct('=QQ')  # bytes used, first jid
+# below which priority values jobs count as urgent, as in beanstalkd
+URGENT = 1024
+MAX_TUBE_LENGTH = 200
+
+
+class _Job(object):
+    __slots__ = (
+        'jid', 'tube', 'priority', 'ready_at', 'created', 'ttr', 'body',
+        'state', 'segment', 'seq', 'owner', 'deadline', 'reserves',
+        'timeouts', 'releases', 'buries')
+
+    def __init__(self, jid, tube, priority, ready_at, created, body):
+        self.jid = jid
+        self.tube = tube
+        self.priority = priority
+        self.ready_at = ready_at
+        self.created = created
+        self.ttr = beanstalkc.DEFAULT_TTR
+        self.body = body
+        self.state = None
+        self.segment = None
+        # bumped by every state change, heap entries of older ones are stale
+        self.seq = 0
+        self.owner = None
+        self.deadline = 0
+        self.reserves = self.timeouts = self.releases = self.buries = 0
+
+
+class _Tube(object):
+    __slots__ = (
+        'name', 'ready', 'delayed', 'counts', 'urgent', 'total_jobs',
+        'deletes', 'using', 'watching')
+
+    def __init__(self, name):
+        self.name = name
+        self.ready = []  # (priority, jid, seq)
+        self.delayed = []  # (ready at, jid, seq)
+        self.counts = Counter()
+        self.urgent = 0
+        self.total_jobs = 0
+        self.deletes = 0
+        self.using = 0
+        self.watching = 0
+
+
+class LocalQueue(object):
+    """
+    An embedded stand-in for beanstalkd, for single node installs. Jobs
+    are kept in memory, in a priority heap of ready and a heap of delayed
+    jobs per tube, and every change is appended to mmap'd segment files
+    of segment_bytes in directory, replayed on open. Reservations are
+    not persisted, like a beanstalkd restart they end with the process.
+
+    A segment is removed once it and all older ones hold no live job.
+    When a new segment is started, the few jobs still alive in the oldest
+    one are written again, so that long buried jobs don't pin the log.
+
+    Only one process can open a directory: api, batch_push and push have
+    to run in that process, see single_node.py.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        super(LocalQueue, self).__init__()
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock_fd = os.open(
+            os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(self._lock_fd)
+            raise IOError(
+                'The local queue in %s is open in another process' %
+                directory)
+        self._condition = Condition(Lock())
+        self._jobs = {}
+        self._tubes = {}
+        self._reserved = []  # (deadline, jid, seq)
+        self._live = Counter()  # live jobs per segment
+        self._segments = []
+        self._map = None
+        self._segment = None
+        self._used = 0
+        self._next_jid = 1
+        self.counters = Counter()
+        self.connections = 0
+        self.started = time.time()
+        self._replay()
+
+    # -- segments --
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, 'queue.%d.log' % number)
+
+    def _segment_numbers(self):
+        numbers = []
+        for path in os.listdir(self.directory):
+            match = re.match(r'queue\.(\d+)\.log$', path)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _map_segment(self, number):
+        fd = os.open(self._segment_path(number), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < self.segment_bytes:
+                os.ftruncate(fd, self.segment_bytes)
+            return mmap.mmap(fd, self.segment_bytes)
+        finally:
+            os.close(fd)
+
+    def _open_segment(self, number):
+        if self._map is not None:
+            self._map.close()
+        self._map = self._map_segment(number)
+        self._segment = number
+        self._used = SEGMENT_HEADER.size
+        SEGMENT_HEADER.pack_into(self._map, 0, self._used, self._next_jid)
+        self._segments.append(number)
+
+    def _read_segment(self, number):
+        with open(self._segment_path(number), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SEGMENT_HEADER.size:
+                return None
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _replay(self):
+        now = time.time()
+        for number in self._segment_numbers():
+            self._segments.append(number)
+            segment = self._read_segment(number)
+            if segment is None:
+                continue
+            try:
+                used, first_jid = SEGMENT_HEADER.unpack_from(segment)
+                self._next_jid = max(self._next_jid, first_jid)
+                offset = SEGMENT_HEADER.size
+                while offset < used:
+                    op, tube_length, body_length, priority, jid, ready_at, \
+                        created = RECORD.unpack_from(segment, offset)
+                    offset += RECORD.size
+                    tube = segment[offset:offset + tube_length]
+                    offset += tube_length
+                    body = segment[offset:offset + body_length]
+                    offset += body_length
+                    self._replay_record(
+                        number, op, tube, body, priority, jid, ready_at,
+                        created)
+            finally:
+                segment.close()
+
+        with self._condition:
+            for job in self._jobs.itervalues():
+                state = job.state
+                job.state = None
+                self._tube(job.tube).total_jobs += 1
+                if state == BURIED:
+                    self._set_state(job, BURIED)
+                elif job.ready_at > now:
+                    self._set_state(job, DELAYED)
+                else:
+                    self._set_state(job, READY)
+        if self._segments:
+            # append to a new segment, the last one may be cut short
+            number = self._segments[-1] + 1
+        else:
+            number = 0
+        self._open_segment(number)
+        self._collect()
+        log.info(
+            'Opened %s: %d jobs in %d segments', self.directory,
+            len(self._jobs), len(self._segments))
+
+    def _replay_record(
+            self, number, op, tube, body, priority, jid, ready_at, created):
+        self._next_jid = max(self._next_jid, jid + 1)
+        job = self._jobs.get(jid)
+        if op == PUT:
+            if job is not None:
+                # written again from an older segment
+                self._live[job.segment] -= 1
+            job = self._jobs[jid] = _Job(
+                jid, tube, priority, ready_at, created, body)
+            job.state = READY
+            job.segment = number
+            self._live[number] += 1
+        elif job is None:
+            return
+        elif op == DELETE:
+            del self._jobs[jid]
+            self._live[job.segment] -= 1
+        elif op == RELEASE:
+            job.priority = priority
+            job.ready_at = ready_at
+            job.state = READY
+        elif op == BURY:
+            job.priority = priority
+            job.state = BURIED
+
+    def _append(self, op, job):
+        if op == PUT:
+            tube, body = job.tube, job.body
+        else:
+            tube = body = ''
+        size = RECORD.size + len(tube) + len(body)
+        if self._used + size > self.segment_bytes:
+            self._roll()
+        RECORD.pack_into(
+            self._map, self._used, op, len(tube), len(body), job.priority,
+            job.jid, job.ready_at, job.created)
+        offset = self._used + RECORD.size
+        self._map[offset:offset + len(tube)] = tube
+        offset += len(tube)
+        self._map[offset:offset + len(body)] = body
+        self._used = offset + len(body)
+        # the record counts once complete
+        SEGMENT_HEADER.pack_into(self._map, 0, self._used, self._next_jid)
+        if op == PUT:
+            if job.segment is not None:
+                self._live[job.segment] -= 1
+            job.segment = self._segment
+            self._live[self._segment] += 1
+        elif op == DELETE:
+            self._live[job.segment] -= 1
+            self._collect()
+
+    def _roll(self):
+        self._open_segment(self._segment + 1)
+        oldest = self._segments[0]
+        if oldest == self._segment or not self._live[oldest]:
+            return
+        jobs = [job for job in self._jobs.itervalues()
+                if job.segment == oldest]
+        size = sum(
+            2 * RECORD.size + len(job.tube) + len(job.body) for job in jobs)
+        if size > self.segment_bytes // 2:
+            return
+        for job in jobs:
+            self._append(PUT, job)
+            if job.state == BURIED:
+                self._append(BURY, job)
+        self._collect()
+
+    def _collect(self):
+        while len(self._segments) > 1 and not self._live[self._segments[0]]:
+            number = self._segments.pop(0)
+            del self._live[number]
+            os.remove(self._segment_path(number))
+
+    # -- states --
+
+    def _tube(self, name):
+        tube = self._tubes.get(name)
+        if tube is None:
+            tube = self._tubes[name] = _Tube(name)
+        return tube
+
+    def _set_state(self, job, state):
+        tube = self._tube(job.tube)
+        if job.state is not None:
+            tube.counts[job.state] -= 1
+            if job.state == READY and job.priority < URGENT:
+                tube.urgent -= 1
+        job.state = state
+        job.seq += 1
+        tube.counts[state] += 1
+        if state == READY:
+            if job.priority < URGENT:
+                tube.urgent += 1
+            heapq.heappush(tube.ready, (job.priority, job.jid, job.seq))
+            self._condition.notify_all()
+        elif state == DELAYED:
+            heapq.heappush(tube.delayed, (job.ready_at, job.jid, job.seq))
+            self._condition.notify_all()
+        elif state == RESERVED:
+            heapq.heappush(self._reserved, (job.deadline, job.jid, job.seq))
+
+    def _valid(self, entry):
+        job = self._jobs.get(entry[1])
+        return job is not None and job.seq == entry[2]
+
+    def _promote(self, tube, now):
+        delayed = tube.delayed
+        while delayed and delayed[0][0] <= now:
+            entry = heapq.heappop(delayed)
+            if self._valid(entry):
+                self._set_state(self._jobs[entry[1]], READY)
+
+    def _expire(self, now):
+        reserved = self._reserved
+        while reserved and reserved[0][0] <= now:
+            entry = heapq.heappop(reserved)
+            if self._valid(entry):
+                job = self._jobs[entry[1]]
+                job.owner.reserved.discard(job.jid)
+                job.owner = None
+                job.timeouts += 1
+                self._set_state(job, READY)
+
+    def _pop_ready(self, tubes):
+        """The most urgent ready job of tubes, as beanstalkd picks it"""
+        best = None
+        for name in tubes:
+            tube = self._tubes.get(name)
+            if tube is None:
+                continue
+            ready = tube.ready
+            while ready and not self._valid(ready[0]):
+                heapq.heappop(ready)
+            if ready and (best is None or ready[0] < best.ready[0]):
+                best = tube
+        if best is None:
+            return None
+        return self._jobs[heapq.heappop(best.ready)[1]]
+
+    def _next_event(self, tubes):
+        """When a delayed job of tubes or a reservation is due next"""
+        times = [entry[0] for entry in self._reserved[:1]]
+        for name in tubes:
+            tube = self._tubes.get(name)
+            if tube is not None and tube.delayed:
+                times.append(tube.delayed[0][0])
+        return min(times) if times else None
+
+    def _reserved_job(self, owner, jid):
+        job = self._jobs.get(jid)
+        if job is None or job.state != RESERVED or job.owner is not owner:
+            return None
+        return job
+
+    # -- commands, with the beanstalkd semantics --
+
+    def put_many(self, jobs, ttr=beanstalkc.DEFAULT_TTR):
+        """
+        Puts (tube, body, priority, delay) tuples, returns their ids. A
+        CommandFailed carries the ids put before it as its jids attribute.
+        """
+        now = time.time()
+        jids = []
+        with self._condition:
+            for tube, body, priority, delay in jobs:
+                if not isinstance(body, str):
+                    raise TypeError('Job body must be a str instance')
+                # names from JSON are unicode, beanstalkc sends them as ascii
+                tube = str(tube)
+                if RECORD.size + len(tube) + len(body) > \
+                        self.segment_bytes - SEGMENT_HEADER.size:
+                    e = beanstalkc.CommandFailed('put', 'JOB_TOO_BIG', [])
+                    e.jids = jids
+                    self.counters['cmd-put'] += len(jids)
+                    raise e
+                job = _Job(
+                    self._next_jid, tube, priority, now + delay, now, body)
+                job.ttr = ttr
+                self._next_jid += 1
+                self._append(PUT, job)
+                self._jobs[job.jid] = job
+                self._tube(tube).total_jobs += 1
+                self._set_state(job, DELAYED if delay else READY)
+                jids.append(job.jid)
+            self.counters['cmd-put'] += len(jids)
+        return jids
+
+    def reserve(self, owner, tubes, timeout=None, count=1):
+        """
+        Reserves up to count jobs of tubes for owner, waiting up to
+        timeout seconds, or forever with None, for the first one
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        jobs = []
+        with self._condition:
+            while True:
+                now = time.time()
+                self._expire(now)
+                for name in tubes:
+                    tube = self._tubes.get(name)
+                    if tube is not None:
+                        self._promote(tube, now)
+                while len(jobs) < count:
+                    job = self._pop_ready(tubes)
+                    if job is None:
+                        break
+                    job.owner = owner
+                    job.deadline = now + job.ttr
+                    job.reserves += 1
+                    self._set_state(job, RESERVED)
+                    owner.reserved.add(job.jid)
+                    jobs.append(job)
+                if jobs or deadline is not None and now >= deadline:
+                    break
+                wait = self._next_event(tubes)
+                if wait is not None:
+                    wait = max(0, wait - now)
+                if deadline is not None and (
+                        wait is None or deadline - now < wait):
+                    wait = deadline - now
+                self._condition.wait(wait)
+            self.counters['cmd-reserve'] += len(jobs)
+        return jobs
+
+    def delete_many(self, owner, jids):
+        """
+        Deletes jobs but those reserved by another owner, returns how
+        many were deleted
+        """
+        deleted = 0
+        with self._condition:
+            for jid in jids:
+                job = self._jobs.get(jid)
+                if job is None or \
+                        job.state == RESERVED and job.owner is not owner:
+                    continue
+                self._append(DELETE, job)
+                del self._jobs[jid]
+                tube = self._tube(job.tube)
+                tube.counts[job.state] -= 1
+                if job.state == READY and job.priority < URGENT:
+                    tube.urgent -= 1
+                tube.deletes += 1
+                if job.state == RESERVED:
+                    owner.reserved.discard(jid)
+                deleted += 1
+            self.counters['cmd-delete'] += deleted
+        return deleted
+
+    def release(self, owner, jid, priority, delay=0):
+        with self._condition:
+            job = self._reserved_job(owner, jid)
+            if job is None:
+                return False
+            owner.reserved.discard(jid)
+            job.owner = None
+            job.priority = priority
+            job.ready_at = time.time() + delay
+            job.releases += 1
+            self._append(RELEASE, job)
+            self._set_state(job, DELAYED if delay else READY)
+            self.counters['cmd-release'] += 1
+        return True
+
+    def bury(self, owner, jid, priority):
+        with self._condition:
+            job = self._reserved_job(owner, jid)
+            if job is None:
+                return False
+            owner.reserved.discard(jid)
+            job.owner = None
+            job.priority = priority
+            job.buries += 1
+            self._append(BURY, job)
+            self._set_state(job, BURIED)
+            self.counters['cmd-bury'] += 1
+        return True
+
+    def touch(self, owner, jid):
+        with self._condition:
+            job = self._reserved_job(owner, jid)
+            if job is None:
+                return False
+            job.deadline = time.time() + job.ttr
+            # the entry of the earlier deadline goes stale
+            job.seq += 1
+            heapq.heappush(self._reserved, (job.deadline, job.jid, job.seq))
+        return True
+
+    def release_all(self, owner):
+        """Releases the jobs of owner, once it is closed"""
+        with self._condition:
+            for jid in list(owner.reserved):
+                job = self._jobs[jid]
+                job.owner = None
+                self._set_state(job, READY)
+            owner.reserved.clear()
+
+    def use(self, old, new):
+        with self._condition:
+            if old is not None:
+                self._tube(old).using -= 1
+            if new is not None:
+                self._tube(new).using += 1
+
+    def watch(self, name, count):
+        with self._condition:
+            self._tube(name).watching += count
+
+    def tubes(self):
+        with self._condition:
+            for name, tube in self._tubes.items():
+                if name != 'default' and not tube.using and \
+                        not tube.watching and not sum(tube.counts.values()):
+                    del self._tubes[name]
+            return sorted(self._tubes)
+
+    def stats_job(self, jid):
+        now = time.time()
+        with self._condition:
+            job = self._jobs.get(jid)
+            if job is None:
+                return None
+            if job.state == RESERVED:
+                time_left = job.deadline - now
+            elif job.state == DELAYED:
+                time_left = job.ready_at - now
+            else:
+                time_left = 0
+            return {
+                'id': job.jid, 'tube': job.tube, 'state': job.state,
+                'pri': job.priority, 'age': int(now - job.created),
+                'delay': max(0, int(job.ready_at - job.created)),
+                'ttr': job.ttr, 'time-left': max(0, int(time_left)),
+                'reserves': job.reserves, 'timeouts': job.timeouts,
+                'releases': job.releases, 'buries': job.buries,
+                'kicks': 0}
+
+    def stats_tube(self, name):
+        with self._condition:
+            tube = self._tubes.get(name)
+            if tube is None:
+                return None
+            self._promote(tube, time.time())
+            stats = dict(
+                ('current-jobs-%s' % state, tube.counts[state])
+                for state in STATES)
+            stats.update({
+                'name': name, 'current-jobs-urgent': tube.urgent,
+                'total-jobs': tube.total_jobs, 'cmd-delete': tube.deletes,
+                'current-using': tube.using,
+                'current-watching': tube.watching,
+                'current-waiting': 0, 'pause': 0})
+            return stats
+
+    def stats(self):
+        with self._condition:
+            counts = Counter()
+            urgent = 0
+            for tube in self._tubes.itervalues():
+                counts.update(tube.counts)
+                urgent += tube.urgent
+            stats = dict(
+                ('current-jobs-%s' % state, counts[state])
+                for state in STATES)
+            stats.update({
+                'current-jobs-urgent': urgent,
+                'total-jobs': self._next_jid - 1,
+                'current-tubes': len(self._tubes),
+                'current-connections': self.connections,
+                'uptime': int(time.time() - self.started),
+                'pid': os.getpid(), 'version': 'local',
+                'binlog-current-index': self._segment,
+                'binlog-oldest-index': self._segments[0]})
+            for command in ('put', 'reserve', 'delete', 'release', 'bury'):
+                stats['cmd-%s' % command] = self.counters['cmd-' + command]
+            return stats
+
+    def close(self):
+        with self._condition:
+            self._map.flush()
+            self._map.close()
+            os.close(self._lock_fd)
+
+
+class LocalConnection(object):
+    """
+    A connection to a LocalQueue, with the interface of beanstalkc's
+    Connection and the batch commands of queues.BeanstalkConnection.
+    Commands take no round trip. Like beanstalkd, the jobs it reserved
+    are released when it is closed.
+    """
+    def __init__(self, queue):
+        super(LocalConnection, self).__init__()
+        self.queue = queue
+        self.reserved = set()
+        self._using = None
+        self._watching = []
+        self.connect()
+
+    def connect(self):
+        self.queue.connections += 1
+        self._using = 'default'
+        self.queue.use(None, self._using)
+        self._watching = ['default']
+        self.queue.watch('default', 1)
+
+    def close(self):
+        if self._using is None:
+            return
+        self.queue.release_all(self)
+        self.queue.use(self._using, None)
+        for tube in self._watching:
+            self.queue.watch(tube, -1)
+        self._using = None
+        self._watching = []
+        self.queue.connections -= 1
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    @staticmethod
+    def _check_tube(name):
+        if not name or len(name) > MAX_TUBE_LENGTH:
+            raise beanstalkc.CommandFailed('use', 'BAD_FORMAT', [])
+
+    def put(self, body, priority=beanstalkc.DEFAULT_PRIORITY, delay=0,
+            ttr=beanstalkc.DEFAULT_TTR):
+        return self.queue.put_many(
+            [(self._using, body, priority, delay)], ttr)[0]
+
+    def put_many(self, jobs):
+        return self.queue.put_many(jobs)
+
+    def _job(self, job):
+        return beanstalkc.Job(self, job.jid, job.body)
+
+    def reserve(self, timeout=None):
+        jobs = self.queue.reserve(self, self._watching, timeout)
+        return self._job(jobs[0]) if jobs else None
+
+    def reserve_many(self, count):
+        return [self._job(job) for job in self.queue.reserve(
+            self, self._watching, 0, count)]
+
+    def delete(self, jid):
+        if not self.queue.delete_many(self, [jid]):
+            raise beanstalkc.CommandFailed('delete', 'NOT_FOUND', [])
+
+    def delete_many(self, jids):
+        return self.queue.delete_many(self, jids)
+
+    def release(self, jid, priority=beanstalkc.DEFAULT_PRIORITY, delay=0):
+        if not self.queue.release(self, jid, priority, delay):
+            raise beanstalkc.CommandFailed('release', 'NOT_FOUND', [])
+
+    def bury(self, jid, priority=beanstalkc.DEFAULT_PRIORITY):
+        if not self.queue.bury(self, jid, priority):
+            raise beanstalkc.CommandFailed('bury', 'NOT_FOUND', [])
+
+    def touch(self, jid):
+        if not self.queue.touch(self, jid):
+            raise beanstalkc.CommandFailed('touch', 'NOT_FOUND', [])
+
+    def use(self, name):
+        self._check_tube(name)
+        self.queue.use(self._using, name)
+        self._using = name
+        return name
+
+    def using(self):
+        return self._using
+
+    def watch(self, name):
+        self._check_tube(name)
+        if name not in self._watching:
+            self._watching.append(name)
+            self.queue.watch(name, 1)
+        return len(self._watching)
+
+    def ignore(self, name):
+        if name in self._watching and len(self._watching) > 1:
+            self._watching.remove(name)
+            self.queue.watch(name, -1)
+        return len(self._watching)
+
+    def watching(self):
+        return list(self._watching)
+
+    def tubes(self):
+        return self.queue.tubes()
+
+    def stats(self):
+        return self.queue.stats()
+
+    def stats_tube(self, name):
+        stats = self.queue.stats_tube(name)
+        if stats is None:
+            raise beanstalkc.CommandFailed('stats-tube', 'NOT_FOUND', [])
+        return stats
+
+    def stats_job(self, jid):
+        stats = self.queue.stats_job(jid)
+        if stats is None:
+            raise beanstalkc.CommandFailed('stats-job', 'NOT_FOUND', [])
+        return stats
+
+
+_queue = None
+_queue_lock = Lock()
+
+
+def get_queue():
+    """The LocalQueue of LOCAL_QUEUE_DIR, opened once per process"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = LocalQueue(
+                config.LOCAL_QUEUE_DIR, config.LOCAL_QUEUE_SEGMENT_BYTES)
+    return _queue
+
+
+def connect():
+    return LocalConnection(get_queue())
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import atexit
+import copy
+import logging
+import Queue
+import random
+from threading import Thread
+
+import config
+import metrics
+
+dropped_records_total = metrics.counter(
+    'log_records_dropped_total', 'Log records dropped on a full queue')
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a QueueListener instead of writing them, so callers
+    never wait on formatting or disk. Messages are formatted by the
+    listener. Records are dropped, and counted, while the queue is full.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        if record.exc_info:
+            # tracebacks don't outlive the frames they point to
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            dropped_records_total.inc()
+
+
+class QueueListener(object):
+    """Writes the records of a QueueHandler to handlers from a thread"""
+    def __init__(self, queue, handlers):
+        super(QueueListener, self).__init__()
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Writes the records queued so far and stops the thread"""
+        # a forked child inherits the listener but not its thread
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+
+class SampledLogger(logging.Logger):
+    """
+    A logger that drops all but sample_rate of its records below
+    WARNING before they are created, so unsampled calls cost about as
+    much as disabled ones.
+    """
+    sample_rate = 1
+
+    def isEnabledFor(self, level):
+        if level < logging.WARNING and self.sample_rate < 1 and \
+                random.random() >= self.sample_rate:
+            return False
+        return logging.Logger.isEnabledFor(self, level)
+
+
+def get_logger(name):
+    """Returns the logger of a subsystem, sampled by LOGGING_SAMPLE_RATES"""
+    logging.setLoggerClass(SampledLogger)
+    try:
+        return logging.getLogger(name)
+    finally:
+        logging.setLoggerClass(logging.Logger)
+
+
+class TruncatingFormatter(logging.Formatter):
+    """Cuts messages, e.g. logged job bodies, after max_length chars"""
+    def __init__(self, fmt=None, datefmt=None, max_length=None):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.max_length = max_length
+
+    def format(self, record):
+        if self.max_length is not None:
+            message = record.getMessage()
+            if len(message) > self.max_length:
+                record = copy.copy(record)
+                record.msg = '%s... (%d chars)' % (
+                    message[:self.max_length], len(message))
+                record.args = None
+        return logging.Formatter.format(self, record)
+
+
+_installed = []
+_listener = None
+
+
+def setup():
+    """
+    Configures logging from config: LOGGING_HANDLERS, or stderr, behind
+    a queue with LOGGING_ASYNC, and the levels and sample rates of the
+    subsystems. Calling it again, e.g. in a forked child, replaces the
+    earlier setup.
+    """
+    global _listener
+    root = logging.getLogger()
+    for handler in _installed:
+        root.removeHandler(handler)
+    del _installed[:]
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    root.setLevel(config.LOGGING_LEVEL)
+    for name, level in config.LOGGING_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+    for name, rate in config.LOGGING_SAMPLE_RATES.items():
+        get_logger(name).sample_rate = rate
+
+    formatter = TruncatingFormatter(
+        config.LOGGING_FORMAT, max_length=config.LOGGING_MAX_MESSAGE_LENGTH)
+    handlers = list(config.LOGGING_HANDLERS) or [logging.StreamHandler()]
+    for handler in handlers:
+        # a lock held by the parent's writer thread would never be freed
+        handler.createLock()
+        if handler.formatter is None:
+            handler.setFormatter(formatter)
+
+    if config.LOGGING_ASYNC:
+        queue = Queue.Queue(config.LOGGING_QUEUE_SIZE)
+        _listener = QueueListener(queue, handlers)
+        _listener.start()
+        handlers = [QueueHandler(queue)]
+    for handler in handlers:
+        root.addHandler(handler)
+        _installed.append(handler)
+
+
+def shutdown():
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(shutdown)
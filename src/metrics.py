@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+import BaseHTTPServer
+import logging
+from threading import Lock, Thread
+
+
+# seconds, from a fast local write up to a slow TLS handshake
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values) + list(extra)]
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+class Metric(object):
+    """
+    A named family of series, one per tuple of label values, given in
+    the order of labelnames.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        super(Metric, self).__init__()
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def _check(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('%s takes labels %s, got %r' % (
+                self.name, self.labelnames, labels))
+
+    def samples(self):
+        """Yields (suffix, label values, extra labels, value) tuples"""
+        with self._lock:
+            values = self._values.items()
+        for labels, value in sorted(values):
+            yield '', labels, (), value
+
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix,
+                _format_labels(self.labelnames, labels, extra),
+                repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, set directly or read from a function
+    every time it is exposed.
+    """
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function, labels=()):
+        """Reads the value of labels from function(), see samples"""
+        self.set(function, labels)
+
+    def samples(self):
+        for suffix, labels, extra, value in super(Gauge, self).samples():
+            if callable(value):
+                value = value()
+            yield suffix, labels, extra, value
+
+    def inc(self, amount=1, labels=()):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def get(self, labels=()):
+        value = self._values.get(labels, 0)
+        if callable(value):
+            return value()
+        return value
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, plus sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        self._check(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # per bucket counts, then +Inf, sum
+                series = self._values[labels] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def get(self, labels=()):
+        """Returns (count, sum) of the observations"""
+        series = self._values.get(labels)
+        if series is None:
+            return 0, 0.0
+        return sum(series[:-1]), series[-1]
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (labels, list(series))
+                for labels, series in self._values.items()]
+        for labels, series in sorted(values):
+            count = 0
+            for bound, bucket_count in zip(
+                    self.buckets + ('+Inf',), series[:-1]):
+                count += bucket_count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                yield '_bucket', labels, (('le', le),), count
+            yield '_sum', labels, (), series[-1]
+            yield '_count', labels, (), count
+
+
+class Registry(object):
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.metrics = []
+        self._names = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        """Returns metric, or the one registered earlier under its name"""
+        with self._lock:
+            registered = self._names.get(metric.name)
+            if registered is not None:
+                if type(registered) is not type(metric) or \
+                        registered.labelnames != metric.labelnames:
+                    raise ValueError(
+                        'Metric %s registered differently' % metric.name)
+                return registered
+            self._names[metric.name] = metric
+            self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """The text exposition format read by Prometheus"""
+        return ''.join(
+            metric.expose() + '\n' for metric in list(self.metrics))
+
+
+registry = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics %s' % (format % args))
+
+
+def serve(port, host='127.0.0.1', registry=registry):
+    """Serves GET /metrics of registry from a daemon thread"""
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    t = Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    logging.info('Serving metrics on %s:%d' % (host, server.server_port))
+    return server
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import logging
+import Queue
+import time
+
+import beanstalkc
+
+import queues
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class BeanstalkPool(object):
+    """
+    A bounded pool of queue connections shared by threads or
+    greenlets. Connections are opened lazily, checked with a cheap command
+    when they have been idle for check_interval seconds and reopened when
+    they are found or reported broken.
+    """
+    def __init__(self, host, port, size=10, check_interval=30, timeout=5):
+        super(BeanstalkPool, self).__init__()
+        self.host = host
+        self.port = port
+        self.size = size
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._queue = Queue.LifoQueue(size)
+        for i in range(size):
+            self._queue.put((None, 0))
+
+    def _connect(self):
+        logging.debug('Connect to %s:%s' % (self.host, self.port))
+        return queues.connect(self.host, self.port)
+
+    def get(self):
+        try:
+            conn, last_used = self._queue.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise PoolExhausted()
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.time() - last_used > self.check_interval:
+                try:
+                    conn.using()
+                except beanstalkc.SocketError:
+                    logging.debug(
+                        'Reconnect to %s:%s' % (self.host, self.port))
+                    conn.reconnect()
+        except Exception:
+            self._queue.put((None, 0))
+            raise
+        return conn
+
+    def put(self, conn, broken=False):
+        if broken:
+            conn.close()
+            conn = None
+        self._queue.put((conn, time.time()))
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except beanstalkc.SocketError:
+            self.put(conn, broken=True)
+            raise
+        except Exception:
+            self.put(conn)
+            raise
+        else:
+            self.put(conn)
@@ -4,25 +4,98 @@
 from gevent import monkey
 monkey.patch_all()
 
+from collections import Counter, OrderedDict
 import json
 import logging
-import Queue
+import math
 import select
+import signal
 import socket
 import ssl
 import time
 from threading import Thread
 
 import beanstalkc
+import gevent
+from gevent.pool import Group
 
 import apns
+import codec
 import config
+import deliveries
+import logs
+import invalid_tokens
+from jobs import check_badges, expand, priority_name
+import metrics
+import queues
+import ratelimit
+from ledger import IDENTIFIER_MASK, Ledger
+
+
+# ready jobs in a tube before a non-master pipe starts pushing
+BACKLOG_TO_START = 100
+
+payload_cache = apns.PayloadCache(config.PAYLOAD_CACHE_SIZE)
+
+# one signed JWT for all HTTP/2 pipes of the process
+provider_token = None
+if config.APNS_PROTOCOL == 'http2' and config.APNS_AUTH_KEY_FILE:
+    provider_token = apns.ProviderToken(
+        config.APNS_AUTH_KEY_FILE, config.APNS_AUTH_KEY_ID,
+        config.APNS_TEAM_ID, config.APNS_AUTH_TOKEN_REFRESH)
+
+log = logs.get_logger('push')
+
+# gevent.signal of the pinned gevent 1.0 is signal_handler since 1.5
+signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+
+# the DeliveryLog of the process, opened by __main__ or the supervisor
+delivery_log = None
+
+# process wide counters, reported to the supervisor
+stats = Counter()
+
+reserve_seconds = metrics.histogram(
+    'push_reserve_seconds', 'Wait for a batch of jobs to reserve', ('tube',))
+stage_seconds = metrics.histogram(
+    'push_stage_seconds',
+    'Time per batch spent preparing jobs, encoding and writing',
+    ('tube', 'stage'))
+notifications_total = metrics.counter(
+    'push_notifications_total', 'Notifications sent', ('tube',))
+jobs_total = metrics.counter(
+    'push_jobs_total', 'Jobs pushed and deleted', ('tube',))
+connect_seconds = metrics.histogram(
+    'gateway_connect_seconds', 'Gateway (re)connects, handshake included',
+    ('tube',))
+connect_failures_total = metrics.counter(
+    'gateway_connect_failures_total', 'Failed gateway connects',
+    ('tube', 'error'))
+throttled_seconds_total = metrics.counter(
+    'push_throttled_seconds_total', 'Time waited for the rate limit',
+    ('tube',))
+collapsed_total = metrics.counter(
+    'push_collapsed_total',
+    'Notifications dropped for a later one with the same collapse_key',
+    ('tube',))
+gateway_errors_total = metrics.counter(
+    'gateway_errors_total',
+    'Error responses by status, HTTP/2 failures by reason',
+    ('tube', 'status'))
+payload_cache_hits = metrics.gauge(
+    'push_payload_cache_hits', 'Payloads found in the payload cache')
+payload_cache_hits.set_function(lambda: payload_cache.hits)
+payload_cache_misses = metrics.gauge(
+    'push_payload_cache_misses', 'Payloads built and added to the cache')
+payload_cache_misses.set_function(lambda: payload_cache.misses)
 
 
 class Pipe(object):
     def __init__(
             self, beanstalkd_host, beanstalkd_port, tube,
-            gateway_host, gateway_port, key_file, cert_file, master_worker):
+            gateway_host, gateway_port, key_file, cert_file, master_worker,
+            topic=None, extra_tubes=(), linger_ms=None, limiter=None,
+            app_name=None):
         self.beanstalkd_host = beanstalkd_host
         self.beanstalkd_port = beanstalkd_port
         self.tube = tube
@@ -31,202 +104,1097 @@ class Pipe(object):
         self.key_file = key_file
         self.cert_file = cert_file
         self.master_worker = master_worker
+        self.topic = topic
+        self.app_name = app_name or tube
+        # watched besides tube, e.g. the app's fast lane
+        self.extra_tubes = extra_tubes
+        if linger_ms is None:
+            linger_ms = config.PUSH_BATCH_LINGER_MS
+        self.linger_ms = linger_ms
+        self.limiter = limiter
+        # notifications per job, to reserve what the rate limit allows
+        self.tokens_per_job = 1.0
+        self.http2 = config.APNS_PROTOCOL == 'http2'
 
         self.push_id = 0
         self.last_push_time = 0
-        self.pushed_buffer = Queue.Queue(maxsize=1000)
+        self.ledger = Ledger(config.LEDGER_MAX_BYTES)
+        self.invalid_tokens = invalid_tokens.get_store()
+        self.resend = []
         self.beanstalk = None
         self.gateway_connection = None
         self.gateway_invalid = False
+        self.stopping = False
+        # reconnect with a new certificate once drained
+        self.swap_pending = False
+        self.write_time = 0.0
+
+    def reconfigure(self, cert_file, key_file, topic=None, limiter=None):
+        """
+        Takes the app settings of a reloaded config. The topic and limit
+        apply from the next batch on, a new certificate once the
+        notifications in flight are drained and the gateway reconnected.
+        """
+        self.topic = topic
+        self.limiter = limiter
+        if self.gateway_connection is not None and self.http2:
+            self.gateway_connection.topic = topic
+        if (cert_file, key_file) == (self.cert_file, self.key_file):
+            return
+        log.info('New certificate for %s: %s', self.tube, cert_file)
+        self.cert_file = cert_file
+        self.key_file = key_file
+        if self.gateway_connection is not None:
+            self.gateway_connection.set_credentials(cert_file, key_file)
+            self.swap_pending = True
 
     def init_beanstalk(self):
         # init beanstalk
-        logging.debug('Init beanstalk start')
+        log.debug('Init beanstalk start')
         while True:
             try:
                 if self.beanstalk:
                     self.beanstalk.close()
 
-                self.beanstalk = beanstalkc.Connection(
+                self.beanstalk = queues.connect(
+                    self.beanstalkd_host, self.beanstalkd_port)
+                log.debug(
+                    'Connect to %s:%s success',
                     self.beanstalkd_host, self.beanstalkd_port)
-                logging.debug(
-                    'Connect to %s:%s success' % (
-                        self.beanstalkd_host, self.beanstalkd_port))
                 self.beanstalk.watch(self.tube)
+                for tube in self.extra_tubes:
+                    self.beanstalk.watch(tube)
                 for tube in self.beanstalk.watching():
-                    if tube != self.tube:
+                    if tube != self.tube and tube not in self.extra_tubes:
                         self.beanstalk.ignore(tube)
-                self.beanstalk.use(tube)
-                logging.debug('Init beanstalk end')
+                self.beanstalk.use(self.tube)
+                log.debug('Init beanstalk end')
                 return
             except beanstalkc.SocketError:
-                logging.debug(
-                    'Connect to %s:%s failed' % (
-                        self.beanstalkd_host, self.beanstalkd_port))
+                log.debug(
+                    'Connect to %s:%s failed',
+                    self.beanstalkd_host, self.beanstalkd_port)
                 time.sleep(2)
                 continue
             except Exception as e:
-                logging.critical('Unknown init beanstalk error: %s' % e)
+                log.critical('Unknown init beanstalk error: %s', e)
+
+    def make_gateway_connection(self):
+        if self.http2:
+            return apns.HTTP2GatewayConnection(
+                host=self.gateway_host,
+                port=self.gateway_port,
+                topic=self.topic,
+                provider_token=provider_token,
+                secure=config.APNS_HTTP2_SECURE,
+                max_concurrent_streams=config.APNS_HTTP2_CONCURRENT_STREAMS,
+                cert_file=self.cert_file,
+                key_file=self.key_file,
+                standby=config.GATEWAY_STANDBY,
+                tube=self.tube,
+            )
+        return apns.GatewayConnection(
+            host=self.gateway_host,
+            port=self.gateway_port,
+            cert_file=self.cert_file,
+            key_file=self.key_file,
+            standby=config.GATEWAY_STANDBY,
+            tube=self.tube,
+        )
 
     def init_gateway(self):
-        logging.debug('Init gateway start')
+        log.debug('Init gateway start')
         while True:
+            start = time.time()
             try:
-                if not self.gateway_connection:
-                    self.gateway_connection = apns.GatewayConnection(
-                        host=self.gateway_host,
-                        port=self.gateway_port,
-                        cert_file=self.cert_file,
-                        key_file=self.key_file,
-                    )
-                else:
+                if self.gateway_connection:
                     self.gateway_connection.reconnect()
-                logging.debug('Init gateway end')
+                else:
+                    self.gateway_connection = self.make_gateway_connection()
+                    # connect now, so that failures are retried here
+                    self.gateway_connection.connect()
+                connect_seconds.observe(time.time() - start, (self.tube,))
+                log.debug('Init gateway end')
                 return
             except ssl.SSLError as e:
-                logging.error('Init gateway error: %s' % e)
+                connect_failures_total.inc(labels=(self.tube, 'ssl'))
+                log.error('Init gateway error: %s', e)
                 if e.errno == ssl.SSL_ERROR_SSL:
                     self.gateway_invalid = True
                     time.sleep(3600)
-                    logging.debug('Invalid key')
+                    log.debug('Invalid key')
             except (socket.error, IOError) as e:
-                logging.debug('Gateway connect error %s' % e)
+                connect_failures_total.inc(labels=(self.tube, 'socket'))
+                log.debug('Gateway connect error %s', e)
             time.sleep(2)
 
     def process_gateway_input(self):
-        buff = self.gateway_connection.read(apns.ERROR_RESPONSE_LENGTH)
+        """Handles a readable gateway, returns True if it was closed"""
+        try:
+            buff = self.gateway_connection.read(
+                apns.ERROR_RESPONSE_LENGTH, timeout=1)
+        except socket.timeout as e:
+            log.debug('No error response to read: %s', e)
+            return False
+        except ssl.SSLError as e:
+            if apns.is_ssl_timeout(e):
+                # TLS records without application data, e.g. session tickets
+                log.debug('No error response to read: %s', e)
+                return False
+            log.error('Gateway connection broken: %s', e)
+            return True
         if len(buff) == apns.ERROR_RESPONSE_LENGTH:
             command, status, error_identifier = \
                 apns.unpack(apns.ERROR_RESPONSE_FORMAT, buff)
 
             if 8 == command:
-                found = False
-                while not self.pushed_buffer.empty():
-                    identifier, job = self.pushed_buffer.get()
-                    if found:
-                        logging.debug('Reput failed job %s' % identifier)
-                        self.beanstalk.put(json.dumps(job))
-                    elif identifier == error_identifier:
-                        logging.debug('Found error identifier %s' % identifier)
-                        found = True
+                stats['error_responses'] += 1
+                gateway_errors_total.inc(labels=(self.tube, str(status)))
+                failed, tail = self.ledger.fail(error_identifier)
+                if failed is None:
+                    log.error(
+                        'Error identifier %s is no longer in the ledger, '
+                        '%s frames may be lost',
+                        error_identifier, len(tail))
+                else:
+                    log.debug(
+                        'Notification %s failed with status %s, '
+                        'resend %s frames',
+                        error_identifier, status, len(tail))
+                    token_hex = apns.parse_notification(failed)[2]
+                    self.log_deliveries(
+                        [(0, token_hex, 0, time.time(), status)],
+                        correction=True)
+                    if status == apns.INVALID_TOKEN_STATUS:
+                        log.info('Invalid token: %s', token_hex)
+                        self.invalid_tokens.add(token_hex)
+                self.resend.extend(tail)
         elif len(buff) == 0:
-            logging.debug('Close by server')
+            log.debug('Close by server')
         else:
-            logging.debug('Unexcepted read buf size %s' % len(buff))
-        logging.debug('Process gateway input end')
+            log.debug('Unexcepted read buf size %s', len(buff))
+        log.debug('Process gateway input end')
+        return True
 
-    def push_job(self):
-        job = self.beanstalk.reserve(timeout=10)
-        if not job:
-            logging.debug('No job found')
+    def reconnect_gateway(self):
+        start = time.time()
+        self.gateway_connection.reconnect()
+        connect_seconds.observe(time.time() - start, (self.tube,))
+        stats['reconnects'] += 1
+        self.swap_pending = False
+
+    def drain(self):
+        """
+        Waits for the notifications in flight before the gateway
+        connection is closed or swapped. The binary gateway only answers
+        failures, so they are in flight until PUSH_DRAIN_SECONDS after
+        the last write; the ones written after a failed notification are
+        resent and waited for in turn. HTTP/2 batches are answered in
+        full before the next one starts.
+        """
+        if self.http2 or self.gateway_connection is None:
             return
+        while True:
+            if self.resend:
+                self.resend_frames()
+            # an error response may be waiting since well before
+            timeout = max(0, self.last_push_time + config.PUSH_DRAIN_SECONDS -
+                          time.time())
+            rlist, _, _ = select.select(
+                [self.gateway_connection.connection()], [], [], timeout)
+            if not rlist:
+                return
+            if self.process_gateway_input():
+                self.reconnect_gateway()
 
-        # delete job that job age > 3 hours
-        if job.stats()['age'] > 10800:
-            logging.debug('Reserved too old job: %s' % job.body)
-            job.delete()
+    def reserve_limit(self):
+        """
+        Returns how many jobs to reserve, fewer than PUSH_BATCH_SIZE when
+        the rate limit has fewer tokens left. While every priority the
+        pipe takes is in debt, sleeps up to a second and returns 0,
+        leaving the jobs queued. take_tokens paces the jobs reserved.
+        """
+        if self.limiter is None:
+            return config.PUSH_BATCH_SIZE
+        available = self.limiter.available()
+        if available <= 0:
+            wait = min(self.limiter.wait(), 1)
+            throttled_seconds_total.inc(wait, (self.tube,))
+            time.sleep(wait)
+            return 0
+        return max(1, int(min(
+            config.PUSH_BATCH_SIZE, available / self.tokens_per_job)))
+
+    def take_tokens(self, job_body, count):
+        """
+        Takes the count notifications of a job from the rate limit,
+        returns the seconds to wait before sending them.
+        """
+        if self.limiter is None:
+            return 0
+        self.tokens_per_job = 0.9 * self.tokens_per_job + 0.1 * count
+        wait = self.limiter.take(priority_name(job_body), count)
+        if wait > 0:
+            throttled_seconds_total.inc(wait, (self.tube,))
+        return wait
+
+    def reserve_jobs(self):
+        jobs = []
+        if self.stopping:
+            return jobs
+        limit = self.reserve_limit()
+        if not limit:
+            return jobs
+        start = time.time()
+        job = None
+        # written notifications may still fail, poll the tube while
+        # waiting on the gateway for their error response
+        while not job and not self.http2 and \
+                time.time() < self.last_push_time + config.PUSH_DRAIN_SECONDS:
+            job = self.beanstalk.reserve(timeout=0)
+            if not job and select.select(
+                    [self.gateway_connection.connection()], [], [], 0.01)[0]:
+                return jobs
+        if not job:
+            job = self.beanstalk.reserve(timeout=10)
+        if not job:
+            return jobs
+        jobs.append(job)
+        deadline = time.time() + self.linger_ms / 1000.0
+        while len(jobs) < limit:
+            jobs.extend(self.beanstalk.reserve_many(limit - len(jobs)))
+            if len(jobs) >= limit or time.time() >= deadline:
+                break
+            time.sleep(0.001)
+        reserve_seconds.observe(time.time() - start, (self.tube,))
+        return jobs
+
+    def delete_jobs(self, jobs):
+        """Deletes the jobs pushed, in one batch"""
+        if not jobs:
             return
-        logging.debug('Reserved job: %s' % job.body)
+        log.debug('Delete %s jobs', len(jobs))
+        deleted = self.beanstalk.delete_many([job.jid for job in jobs])
+        for job in jobs:
+            job.reserved = False
+        if deleted < len(jobs):
+            # their TTR ran out, another pipe may push them again
+            log.error(
+                '%s pushed jobs were no longer reserved', len(jobs) - deleted)
+        stats['jobs'] += len(jobs)
+        jobs_total.inc(len(jobs), (self.tube,))
+
+    def log_deliveries(self, records, correction=False):
+        """
+        Appends (jid, token_hex, enqueued_at, sent_at, status) records,
+        see DeliveryLog.append
+        """
+        if delivery_log is not None and records:
+            delivery_log.append(self.app_name, records, correction)
+
+    def write_frames(self, encoder, pushed, done_jobs, sent=()):
+        """
+        Writes the encoded frames, then deletes done_jobs. sent holds
+        (jid, token_hex, enqueued_at) of the frames for the delivery log.
+        """
+        if len(encoder):
+            log.debug('Write %s notifications', len(pushed))
+            # the ledger keeps views of this copy, the encoder is reused
+            data = encoder.getvalue().tobytes()
+            encoder.reset()
+            write_start = time.time()
+            try:
+                self.gateway_connection.write(data)
+            except (ssl.SSLError, socket.error, IOError):
+                # the gateway closes the connection after an error response,
+                # read it so the notifications written after it are resent
+                try:
+                    self.process_gateway_input()
+                except (ssl.SSLError, socket.error, IOError) as e:
+                    log.debug('No error response to read: %s', e)
+                raise
+            self.last_push_time = time.time()
+            self.write_time += self.last_push_time - write_start
+            stats['notifications'] += len(pushed)
+            notifications_total.inc(len(pushed), (self.tube,))
+            view = memoryview(data)
+            for push_id, start, length in pushed:
+                self.ledger.add(push_id, view[start:start + length])
+            if delivery_log is not None:
+                self.log_deliveries([
+                    (jid, token_hex, enqueued_at, self.last_push_time,
+                     deliveries.SENT)
+                    for jid, token_hex, enqueued_at in sent])
+        self.delete_jobs(done_jobs)
 
+    def prepare_job(self, job):
+        """
+        Returns (job_body, device_payloads, expiry) of a reserved job,
+        device_payloads being (device_token, payload) pairs, or None if
+        the job was deleted or buried instead.
+        """
+        log.debug('Reserved job: %s', job.body)
         try:
-            job_body = json.loads(job.body)
+            job_body = codec.decode(job.body)
         except ValueError:
-            logging.debug(
-                'Failed to loads job body: %s' % job.body)
+            log.debug('Failed to loads job body: %s', job.body)
             job.bury()
+            return None
+
+        # delete job that job age > 3 hours, jobs of older api processes
+        # have no enqueued_at and cost a stats-job round trip
+        enqueued_at = job_body.get('enqueued_at')
+        if enqueued_at is None:
+            age = job.stats()['age']
+        else:
+            age = time.time() - enqueued_at
+        if age > 10800:
+            log.debug('Reserved too old job: %s', job.body)
+            job.delete()
+            return None
 
-        # push job
-        self.push_id += 1
+        # a broadcast job carries many tokens for one payload, or for
+        # one payload with a badge per token
+        device_tokens = job_body.get('device_tokens')
+        if device_tokens is None:
+            device_tokens = [job_body['device_token']]
+        badges = job_body.get('badges')
         try:
-            logging.debug('Send notification: %s %s' % (self.push_id, job.body))
-            expire_seconds = job_body.get(
-                'expire_seconds', config.EXPIRE_SECONDS)
-            expiry = int(time.time()) + expire_seconds
-            self.gateway_connection.send_notification(
-                job_body['device_token'],
-                apns.Payload(**job_body['payload']),
-                self.push_id,
-                expiry)
-        except apns.InvalidTokenError:
-            pass
+            check_badges(job_body)
+            if badges is None:
+                payload = payload_cache.get(job_body['payload'])
+                device_payloads = [
+                    (device_token, payload) for device_token in device_tokens]
+            else:
+                template = payload_cache.get_template(job_body['payload'])
+                device_payloads = [
+                    (device_token, template.render(badge))
+                    for device_token, badge in zip(device_tokens, badges)]
+        except apns.PayloadTooLargeError as e:
+            log.debug(
+                'Payload too large (%s): %s', e.payload_size, job.body)
+            job.bury()
+            return None
+        except (ValueError, TypeError) as e:
+            log.debug('Invalid payload (%s): %s', e, job.body)
+            job.bury()
+            return None
+
+        expire_seconds = job_body.get(
+            'expire_seconds', config.EXPIRE_SECONDS)
+        expiry = int(time.time()) + expire_seconds
+        return job_body, device_payloads, expiry
+
+    def prepare_jobs(self, jobs):
+        """
+        Returns (job, job_body, device_payloads, expiry) of the reserved
+        jobs left to push. A device's notification with a
+        collapse_key is dropped when a later job of the batch carries the
+        same collapse_key for it.
+        """
+        prepared = []
+        latest = {}
+        for job in jobs:
+            result = self.prepare_job(job)
+            if result is None:
+                continue
+            prepared.append((job,) + result)
+            collapse_key = result[0].get('collapse_key')
+            if collapse_key is None:
+                continue
+            for device_token, payload in result[1]:
+                key = (device_token, collapse_key)
+                latest[key] = max(latest.get(key, 0), job.jid)
+        if not latest:
+            return prepared
+
+        collapsed = 0
+        for i, (job, job_body, device_payloads, expiry) in \
+                enumerate(prepared):
+            collapse_key = job_body.get('collapse_key')
+            if collapse_key is None:
+                continue
+            kept = [
+                (device_token, payload)
+                for device_token, payload in device_payloads
+                if latest[(device_token, collapse_key)] == job.jid]
+            if len(kept) < len(device_payloads):
+                collapsed += len(device_payloads) - len(kept)
+                prepared[i] = (job, job_body, kept, expiry)
+        if collapsed:
+            log.debug('Collapsed %s notifications', collapsed)
+            stats['collapsed_notifications'] += collapsed
+            collapsed_total.inc(collapsed, (self.tube,))
+        return prepared
+
+    def push_job(self):
+        jobs = self.reserve_jobs()
+        if not jobs:
+            log.debug('No job found')
+            return
+        log.debug('Reserved %s jobs', len(jobs))
+
+        encoder = self.gateway_connection.encoder
+        encoder.reset()
+        pushed = []
+        sent = []
+        done_jobs = []
+        prepared = []
+        # jid: device payloads of a job being written that were written
+        written = {}
+        batch_start = time.time()
+        self.write_time = 0.0
+        waited = 0.0
+        try:
+            prepared = self.prepare_jobs(jobs)
+            prepare_time = time.time() - batch_start
+            for job, job_body, device_payloads, expiry in prepared:
+                wait = self.take_tokens(job_body, len(device_payloads))
+                if wait > 0:
+                    # write what the tokens paid for, then pace
+                    self.write_frames(encoder, pushed, done_jobs, sent)
+                    pushed = []
+                    sent = []
+                    done_jobs = []
+                    time.sleep(wait)
+                    waited += wait
+                enqueued_at = job_body.get('enqueued_at')
+                for i, (device_token, payload) in enumerate(device_payloads):
+                    if device_token in self.invalid_tokens:
+                        stats['invalid_tokens'] += 1
+                        continue
+                    push_id = self.push_id + 1
+                    start = len(encoder)
+                    try:
+                        encoder.add(
+                            device_token, payload,
+                            push_id & IDENTIFIER_MASK, expiry)
+                    except apns.InvalidTokenError:
+                        log.debug(
+                            'Invalid token: %s %s', job.jid, device_token)
+                        continue
+                    self.push_id = push_id
+                    pushed.append((push_id, start, len(encoder) - start))
+                    sent.append((job.jid, device_token, enqueued_at))
+                    if len(encoder) >= config.PUSH_BATCH_MAX_BYTES:
+                        self.write_frames(encoder, pushed, done_jobs, sent)
+                        pushed = []
+                        sent = []
+                        done_jobs = []
+                        written[job.jid] = i + 1
+                done_jobs.append(job)
+            self.write_frames(encoder, pushed, done_jobs, sent)
         except Exception as e:
-            logging.debug('Unknown send notification error: %s' % e)
-            job.release()
+            log.debug('Unknown send notification error: %s', e)
+            for job, job_body, device_payloads, expiry in prepared:
+                count = written.get(job.jid)
+                if not count or not job.reserved:
+                    continue
+                # a broadcast cut mid-write, only its unsent tokens go back
+                unsent = [
+                    device_token for device_token, payload in
+                    device_payloads[count:]]
+                if unsent:
+                    self.put_tokens(job, job_body, unsent)
+                job.delete()
+            for job in jobs:
+                try:
+                    job.release()
+                except beanstalkc.CommandFailed:
+                    # pushed and deleted, or deleted or buried by
+                    # prepare_job
+                    pass
+            raise
+        encode_time = time.time() - batch_start - prepare_time - \
+            self.write_time - waited
+        stage_seconds.observe(prepare_time, (self.tube, 'prepare'))
+        stage_seconds.observe(encode_time, (self.tube, 'encode'))
+        stage_seconds.observe(self.write_time, (self.tube, 'write'))
+
+    def push_job_http2(self):
+        jobs = self.reserve_jobs()
+        if not jobs:
+            log.debug('No job found')
+            return
+        log.debug('Reserved %s jobs', len(jobs))
+
+        notifications = []
+        owners = []
+        done_jobs = []
+        start = time.time()
+        wait = 0
+        try:
+            for job, job_body, device_payloads, expiry in \
+                    self.prepare_jobs(jobs):
+                wait = max(
+                    wait, self.take_tokens(job_body, len(device_payloads)))
+                for device_token, payload in device_payloads:
+                    if device_token in self.invalid_tokens:
+                        stats['invalid_tokens'] += 1
+                        continue
+                    self.push_id += 1
+                    notifications.append(
+                        (device_token, payload, self.push_id, expiry))
+                    owners.append((job, job_body))
+                done_jobs.append(job)
+            prepare_end = time.time()
+            if wait > 0:
+                time.sleep(wait)
+            log.debug('Send %s notifications', len(notifications))
+            send_start = time.time()
+            results = self.gateway_connection.send_notifications(
+                notifications)
+        except Exception as e:
+            log.debug('Unknown send notification error: %s', e)
+            results = getattr(e, 'results', None)
+            if results and any(results):
+                # streams answered before the connection broke are not
+                # sent again, the unanswered ones are retried
+                self.last_push_time = time.time()
+                self.handle_results(notifications, owners, results)
+                self.delete_jobs(done_jobs)
+                raise
+            for job in jobs:
+                try:
+                    job.release()
+                except beanstalkc.CommandFailed:
+                    # deleted or buried by prepare_job
+                    pass
             raise
-        if self.pushed_buffer.full():
-            self.pushed_buffer.get()
-        logging.debug('Enqueue pushed buffer: %s' % self.push_id)
-        self.pushed_buffer.put((self.push_id, job_body))
         self.last_push_time = time.time()
+        stage_seconds.observe(prepare_end - start, (self.tube, 'prepare'))
+        stage_seconds.observe(
+            self.last_push_time - send_start, (self.tube, 'send'))
+
+        self.handle_results(notifications, owners, results)
+        self.delete_jobs(done_jobs)
+
+    def handle_results(self, notifications, owners, results):
+        """
+        Counts, logs and retries the (status, reason) results of the
+        notifications sent for the (job, job_body) owners, a None result
+        being a stream left unanswered by a connection error
+        """
+        retry = {}
+        records = []
+        for notification, (job, job_body), result in zip(
+                notifications, owners, results):
+            status, reason = result or (None, 'ConnectionError')
+            # a stream without a response, e.g. after GOAWAY, is recorded
+            # with the binary protocol's processing error status
+            records.append((
+                job.jid, notification[0], job_body.get('enqueued_at'),
+                self.last_push_time,
+                deliveries.SENT if status == 200 else status or 1))
+            if status == 200:
+                stats['notifications'] += 1
+                notifications_total.inc(labels=(self.tube,))
+                continue
+            stats['failed_notifications'] += 1
+            gateway_errors_total.inc(
+                labels=(self.tube, reason or str(status)))
+            device_token = notification[0]
+            if reason in apns.INVALID_TOKEN_REASONS:
+                log.info('Invalid token: %s', device_token)
+                self.invalid_tokens.add(device_token)
+            elif status is None or status == 429 or status >= 500 or \
+                    reason == 'ExpiredProviderToken':
+                if reason == 'ExpiredProviderToken' and provider_token:
+                    provider_token.expire()
+                retry.setdefault(job.jid, (job, job_body, []))[2].append(
+                    device_token)
+            else:
+                log.error(
+                    'Notification %s to %s failed with %s %s',
+                    notification[2], device_token, status, reason)
+        self.log_deliveries(records)
+        for job, job_body, device_tokens in retry.values():
+            self.retry_tokens(job, job_body, device_tokens)
 
-        logging.debug('Delete job: %s %s' % (self.push_id, job.body))
-        job.delete()
+    def retry_tokens(self, job, job_body, device_tokens):
+        """Requeues the tokens of job that failed for a transient reason"""
+        retries = job_body.get('retries', 0) + 1
+        if retries > config.APNS_HTTP2_MAX_RETRIES:
+            log.error(
+                'Give up %s notifications of job %s',
+                len(device_tokens), job.jid)
+            return
+        self.put_tokens(
+            job, job_body, device_tokens, delay=1, retries=retries)
+        stats['retried_notifications'] += len(device_tokens)
+
+    def put_tokens(self, job, job_body, device_tokens, delay=0, **fields):
+        """
+        Puts a copy of job for device_tokens only, with their badges, at
+        the job's priority. fields are set in the copy.
+        """
+        body = dict(job_body, device_tokens=device_tokens, **fields)
+        body.pop('device_token', None)
+        badges = job_body.get('badges')
+        if badges is not None:
+            badges = dict(zip(job_body['device_tokens'], badges))
+            body['badges'] = [
+                badges[device_token] for device_token in device_tokens]
+        self.beanstalk.put(
+            codec.encode(body), priority=job.stats()['pri'], delay=delay)
+
+    def resend_frames(self):
+        encoder = self.gateway_connection.encoder
+        encoder.reset()
+        pushed = []
+        for frame in self.resend:
+            push_id = self.push_id + 1
+            start = len(encoder)
+            encoder.add_frame(frame, push_id & IDENTIFIER_MASK)
+            self.push_id = push_id
+            pushed.append((push_id, start, len(encoder) - start))
+        log.debug('Resend %s notifications', len(pushed))
+        self.write_frames(encoder, pushed, [])
+        self.resend = []
+
+    def flush_resend(self):
+        """
+        Resends the frames left after an error response before the pipe
+        exits, on a new gateway connection if the current one fails, and
+        puts them back into the tube if that fails too.
+        """
+        if self.http2 or not self.resend:
+            return
+        for reconnect in (False, True):
+            if self.gateway_connection is None:
+                break
+            try:
+                if reconnect:
+                    self.reconnect_gateway()
+                self.drain()
+                return
+            except (ssl.SSLError, socket.error, IOError) as e:
+                log.error(
+                    'Failed to resend %s notifications: %s',
+                    len(self.resend), e)
+        frames, self.resend = self.resend, []
+        try:
+            self.requeue_frames(frames)
+        except (beanstalkc.SocketError, beanstalkc.CommandFailed) as e:
+            log.error('Lost %s notifications: %s', len(frames), e)
+
+    def requeue_frames(self, frames):
+        """
+        Puts the notifications of frames back into the tube, as broadcast
+        jobs of their payload and expiry. Expired ones are dropped.
+        """
+        now = int(time.time())
+        groups = OrderedDict()
+        for frame in frames:
+            identifier, expiry, token_hex, payload = \
+                apns.parse_notification(frame)
+            if expiry and expiry <= now:
+                continue
+            groups.setdefault((payload, expiry), []).append(token_hex)
+        for (payload, expiry), device_tokens in groups.items():
+            # the encoded payload, aps included, as custom fields
+            job = dict(
+                app_name=self.app_name, device_tokens=device_tokens,
+                payload=dict(custom=json.loads(payload)),
+                expire_seconds=expiry - now if expiry else 0)
+            for chunk in expand(job):
+                self.beanstalk.put(
+                    codec.encode(chunk), priority=config.PRIORITIES['high'])
+        log.info(
+            'Requeued %s notifications to resend',
+            sum(len(tokens) for tokens in groups.values()))
 
     def reserve_and_push(self):
-        logging.debug('Reserve and push start')
+        log.debug('Reserve and push start')
         while True:
+            if self.http2:
+                # every stream is answered, nothing to select on
+                self.push_job_http2()
+                if self.swap_pending:
+                    self.reconnect_gateway()
+                if self.ok_to_stop():
+                    break
+                continue
             rlist, wlist, _ = select.select(
                 [self.gateway_connection.connection()],
                 [self.gateway_connection.connection()],
                 [],
                 10)
             if rlist:
-                logging.debug('Start reading from gateway')
-                self.process_gateway_input()
-                self.gateway_connection.reconnect()
+                log.debug('Start reading from gateway')
+                if self.process_gateway_input():
+                    self.reconnect_gateway()
+            elif wlist and self.resend:
+                self.resend_frames()
             elif wlist:
-                logging.debug('Start writing to gateway')
+                log.debug('Start writing to gateway')
                 self.push_job()
 
+            if self.swap_pending:
+                self.drain()
+                self.reconnect_gateway()
             if self.ok_to_stop():
+                # the jobs of written notifications are deleted already,
+                # only failures may still be reported
+                self.drain()
                 break
 
     def need_to_start(self):
         if self.master_worker:
             return True
         tube_stat = self.beanstalk.stats_tube(self.tube)
-        if tube_stat['current-jobs-ready'] > 100:
+        if tube_stat['current-jobs-ready'] > BACKLOG_TO_START:
             return True
         return False
 
     def ok_to_stop(self):
+        if self.stopping:
+            return True
         if self.master_worker:
             return False
         if time.time() - self.last_push_time > 10:
             return True
         return False
 
+    def stop(self):
+        """Asks the pipe to finish its current batch and return from run"""
+        self.stopping = True
+
     def run(self):
         self.init_beanstalk()
 
-        while True:
+        while not self.stopping:
             try:
                 if not self.need_to_start():
-                    logging.debug('Sleepy')
+                    log.debug('Sleepy')
                     time.sleep(30)
                     continue
-                logging.debug('Start to reserve and push')
+                log.debug('Start to reserve and push')
                 self.init_gateway()
                 self.reserve_and_push()
-                self.gateway_connection.disconnect()
-                logging.debug('Stop to reserve and push')
+                self.gateway_connection.close()
+                log.debug('Stop to reserve and push')
             except beanstalkc.SocketError as e:
-                logging.error('Beanstalkd connection error: %s' % e)
+                log.error('Beanstalkd connection error: %s', e)
                 self.init_beanstalk()
             except (ssl.SSLError, socket.error, IOError) as e:
-                logging.error('Apns connection error: %s' % e)
+                log.error('Apns connection error: %s', e)
             except Exception as e:
-                logging.critical('Unknown error: %s' % e)
+                log.critical('Unknown error: %s', e)
+        self.flush_resend()
+        self.beanstalk.close()
 
+    def run_until_idle(self):
+        """Pushes until ok_to_stop, for pipes started on demand"""
+        self.last_push_time = time.time()
+        try:
+            self.init_beanstalk()
+            self.init_gateway()
+            self.reserve_and_push()
+        except beanstalkc.SocketError as e:
+            log.error('Beanstalkd connection error: %s', e)
+        except (ssl.SSLError, socket.error, IOError) as e:
+            log.error('Apns connection error: %s', e)
+        except Exception as e:
+            log.critical('Unknown error: %s', e)
+        finally:
+            self.flush_resend()
+            if self.gateway_connection:
+                self.gateway_connection.close()
+            if self.beanstalk:
+                self.beanstalk.close()
+        log.debug('Stop to reserve and push')
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        format=config.LOGGING_FORMAT, level=config.LOGGING_LEVEL)
-    for app_name, app_config in config.APPS.items():
+
+def make_pipe(app_name, app_config, master_worker, fast=False):
+    """
+    Returns a pipe of app_name's tube, which drains the fast lane first,
+    or with fast one that only drains the fast lane, without lingering.
+    """
+    if config.APNS_PROTOCOL == 'http2':
+        gateway_host = config.APNS_HTTP2_HOST
+        gateway_port = config.APNS_HTTP2_PORT
+    else:
+        gateway_host = config.APNS_HOST
+        gateway_port = config.APNS_PORT
+    fast_tube = config.PUSH_FAST_TUBE % app_name
+    if fast:
+        tube = fast_tube
+        kwargs = dict(linger_ms=0)
+    else:
+        tube = config.PUSH_TUBE % app_name
+        # beanstalkd reserves the lowest priority value of all watched
+        # tubes first, which is the fast lane
+        kwargs = dict(extra_tubes=(fast_tube,))
+    kwargs.update(pipe_settings(app_name, app_config, fast))
+    return Pipe(
+        config.BEANSTALKD_HOST, config.BEANSTALKD_PORT,
+        tube, gateway_host, gateway_port, master_worker=master_worker,
+        app_name=app_name, **kwargs)
+
+
+def pipe_settings(app_name, app_config, fast=False):
+    """The settings of app_name's pipes a config reload may change"""
+    if fast:
+        limiter = ratelimit.get_limiter(app_name, config.FAST_LANE_PRIORITIES)
+    else:
+        limiter = ratelimit.get_limiter(app_name)
+    return dict(
+        cert_file=app_config[0], key_file=app_config[1],
+        topic=config.APNS_TOPICS.get(app_name), limiter=limiter)
+
+
+def reload_config():
+    """
+    Re-reads the config module and returns it. Settings read once at
+    startup, like the beanstalkd and gateway addresses, pool and cache
+    sizes or the engine, still need a restart.
+    """
+    reload(config)
+    return config
+
+
+def start_threads(apps):
+    for app_name, app_config in apps.items():
         for i in range(app_config[2]):
-            pipe = Pipe(
-                config.BEANSTALKD_HOST, config.BEANSTALKD_PORT,
-                config.PUSH_TUBE % app_name, config.APNS_HOST,
-                config.APNS_PORT, app_config[1], app_config[0], i == 0)
+            pipe = make_pipe(app_name, app_config, i == 0)
             t = Thread(target=pipe.run, name='%s.%d' % (app_name, i))
             t.start()
+        for i in range(config.PUSH_FAST_PIPES):
+            pipe = make_pipe(app_name, app_config, True, fast=True)
+            t = Thread(target=pipe.run, name='%s.fast.%d' % (app_name, i))
+            t.start()
+
+
+class Scaler(object):
+    """
+    Decides how many pipes an app needs from its tube backlog.
+
+    The drain rate of one pipe is estimated from the tube's delete count
+    while there is a backlog. Pipes are added as soon as the backlog can't
+    be drained within AUTOSCALE_TARGET_SECONDS and removed one at a time
+    after AUTOSCALE_DOWN_INTERVALS consecutive samples asking for fewer.
+    """
+    def __init__(self, min_pipes, max_pipes):
+        super(Scaler, self).__init__()
+        self.min_pipes = min_pipes
+        self.max_pipes = max_pipes
+        self.rate_per_pipe = None
+        self.last_sample = None
+        self.below = 0
+
+    def sample_rate(self, now, ready, deletes, active):
+        if self.last_sample is not None and active:
+            last_now, last_ready, last_deletes = self.last_sample
+            if last_ready and now > last_now:
+                rate = (deletes - last_deletes) / (now - last_now) / active
+                if self.rate_per_pipe is None:
+                    self.rate_per_pipe = rate
+                else:
+                    self.rate_per_pipe = \
+                        0.7 * self.rate_per_pipe + 0.3 * rate
+        self.last_sample = (now, ready, deletes)
+
+    def desired(self, tube_stat, active):
+        ready = tube_stat['current-jobs-ready']
+        self.sample_rate(time.time(), ready, tube_stat['cmd-delete'], active)
+        if not ready:
+            need = self.min_pipes
+        elif not self.rate_per_pipe:
+            need = active + 1
+        else:
+            need = int(math.ceil(
+                ready / (self.rate_per_pipe *
+                         config.AUTOSCALE_TARGET_SECONDS)))
+        need = max(self.min_pipes, min(self.max_pipes, need))
+
+        if need >= active:
+            self.below = 0
+            return need
+        self.below += 1
+        if self.below < config.AUTOSCALE_DOWN_INTERVALS:
+            return active
+        self.below = 0
+        return active - 1
+
+
+class Engine(object):
+    """
+    Runs the pipes of all apps as greenlets on the gevent hub.
+
+    The master pipe of every app runs all the time. Instead of each extra
+    pipe holding a beanstalk connection to poll its tube, one watcher
+    polls every tube over a single connection and spawns extra pipes, up
+    to the app's pipe count, which exit again once idle. With AUTOSCALE
+    a Scaler per app decides how many pipes run instead. The
+    PUSH_FAST_PIPES of every app run all the time, besides those.
+
+    reload switches to a new APPS without a restart, stop lets every
+    pipe drain and run return.
+    """
+    def __init__(self, apps):
+        super(Engine, self).__init__()
+        self.apps = apps
+        self.group = Group()
+        self.pipes = dict((app_name, []) for app_name in apps)
+        self.fast_pipes = dict((app_name, []) for app_name in apps)
+        self.limiters = dict(
+            (app_name, ratelimit.get_limiter(app_name)) for app_name in apps)
+        self.scalers = dict(
+            (app_name, Scaler(config.AUTOSCALE_MIN_PIPES, app_config[2]))
+            for app_name, app_config in apps.items())
+        self.beanstalk = None
+        self.watcher = None
+
+    def active_pipes(self, app_name, fast=False):
+        pipes = (self.fast_pipes if fast else self.pipes)[app_name]
+        return [pipe for pipe in pipes if not pipe.stopping]
+
+    def throttled(self, app_name):
+        """More pipes don't help a backlog the rate limit holds back"""
+        limiter = self.limiters[app_name]
+        return limiter is not None and limiter.available() <= 0
+
+    def scale(self, app_name, tube_stat):
+        active = self.active_pipes(app_name)
+        desired = self.scalers[app_name].desired(tube_stat, len(active))
+        if desired > len(active) and self.throttled(app_name):
+            desired = len(active)
+        if desired != len(active):
+            log.info(
+                'Scale %s from %d to %d pipes',
+                app_name, len(active), desired)
+        for i in range(len(active), desired):
+            self.spawn(app_name, True)
+        for pipe in active[max(desired, 1):]:
+            pipe.stop()
+
+    def spawn(self, app_name, master_worker, fast=False):
+        pipe = make_pipe(app_name, self.apps[app_name], master_worker, fast)
+        pipes = (self.fast_pipes if fast else self.pipes)[app_name]
+        pipes.append(pipe)
+        if master_worker:
+            greenlet = self.group.spawn(pipe.run)
+        else:
+            greenlet = self.group.spawn(pipe.run_until_idle)
+        greenlet.link(lambda _: pipes.remove(pipe))
+        log.debug('Spawned pipe %s.%d', pipe.tube, len(pipes))
+
+    def start(self, app_name):
+        """Starts or stops the pipes of app_name that run all the time"""
+        if not self.active_pipes(app_name):
+            self.spawn(app_name, True)
+        fast = self.active_pipes(app_name, fast=True)
+        for i in range(len(fast), config.PUSH_FAST_PIPES):
+            self.spawn(app_name, True, fast=True)
+        for pipe in fast[config.PUSH_FAST_PIPES:]:
+            pipe.stop()
+
+    def reload(self, apps):
+        """
+        Switches to apps, e.g. the APPS of a reloaded config. The pipes
+        of removed apps are stopped and those of new apps started. Pipes
+        of the other apps take their new settings as they run, surplus
+        ones are stopped. Stopped pipes drain before they exit.
+        """
+        old_apps, self.apps = self.apps, apps
+        for app_name in set(old_apps) - set(apps):
+            log.info('Stop pipes of %s', app_name)
+            for pipe in self.pipes[app_name] + self.fast_pipes[app_name]:
+                pipe.stop()
+            ratelimit.drop_buckets(app_name)
+        for app_name, app_config in apps.items():
+            self.limiters[app_name] = ratelimit.get_limiter(app_name)
+            if app_name not in old_apps:
+                log.info('Start pipes of %s', app_name)
+                # pipes of an app removed before may still be draining
+                self.pipes.setdefault(app_name, [])
+                self.fast_pipes.setdefault(app_name, [])
+                self.scalers[app_name] = Scaler(
+                    config.AUTOSCALE_MIN_PIPES, app_config[2])
+                self.start(app_name)
+                continue
+            for fast in (False, True):
+                settings = pipe_settings(app_name, app_config, fast)
+                for pipe in self.active_pipes(app_name, fast):
+                    pipe.reconfigure(**settings)
+            scaler = self.scalers[app_name]
+            scaler.min_pipes = config.AUTOSCALE_MIN_PIPES
+            scaler.max_pipes = app_config[2]
+            for pipe in self.active_pipes(app_name)[max(app_config[2], 1):]:
+                pipe.stop()
+            self.start(app_name)
+
+    def stop(self):
+        """
+        Stops every pipe, run returns once they have drained or after
+        PUSH_STOP_TIMEOUT
+        """
+        log.info('Stopping')
+        if self.watcher is not None:
+            self.watcher.kill(block=False)
+        for pipes in self.pipes.values() + self.fast_pipes.values():
+            for pipe in pipes:
+                pipe.stop()
+        gevent.spawn_later(config.PUSH_STOP_TIMEOUT, self.group.kill)
+
+    def handle_signals(self, load_apps):
+        """
+        Reloads with the apps load_apps returns on SIGHUP, stops on
+        SIGTERM and SIGINT
+        """
+        def reload():
+            try:
+                apps = load_apps()
+            except Exception as e:
+                log.error('Failed to reload config: %s', e)
+                return
+            log.info('Reload config, apps: %s', ', '.join(sorted(apps)))
+            self.reload(apps)
+        signal_handler(signal.SIGHUP, reload)
+        signal_handler(signal.SIGTERM, self.stop)
+        signal_handler(signal.SIGINT, self.stop)
+
+    def watch_tubes(self):
+        while True:
+            try:
+                if not self.beanstalk:
+                    self.beanstalk = queues.connect()
+                for app_name, app_config in self.apps.items():
+                    if not config.AUTOSCALE and \
+                            len(self.pipes[app_name]) >= app_config[2]:
+                        continue
+                    try:
+                        tube_stat = self.beanstalk.stats_tube(
+                            config.PUSH_TUBE % app_name)
+                    except beanstalkc.CommandFailed:
+                        tube_stat = {'current-jobs-ready': 0, 'cmd-delete': 0}
+                    if config.AUTOSCALE:
+                        self.scale(app_name, tube_stat)
+                    elif tube_stat['current-jobs-ready'] > \
+                            BACKLOG_TO_START and \
+                            not self.throttled(app_name):
+                        self.spawn(app_name, False)
+            except beanstalkc.SocketError as e:
+                log.error('Beanstalkd connection error: %s', e)
+                self.beanstalk = None
+            gevent.sleep(config.ENGINE_WATCH_INTERVAL)
+
+    def run(self):
+        for app_name in self.apps:
+            self.start(app_name)
+        self.watcher = self.group.spawn(self.watch_tubes)
+        self.group.join()
+
+
+if __name__ == '__main__':
+    logs.setup()
+    if config.PUSH_METRICS_PORT is not None:
+        metrics.serve(config.PUSH_METRICS_PORT)
+    delivery_log = deliveries.open_log('push')
+    if config.PUSH_ENGINE == 'gevent':
+        engine = Engine(config.APPS)
+        engine.handle_signals(lambda: reload_config().APPS)
+        engine.run()
+    else:
+        start_threads(config.APPS)
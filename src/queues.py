@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import beanstalkc
+
+import config
+import local_queue
+
+
+class BeanstalkConnection(beanstalkc.Connection):
+    """
+    A beanstalkc connection with the batch commands of the queue
+    interface, put_many, reserve_many and delete_many. Their commands are
+    pipelined, up to BATCH_PIPELINE_SIZE are written back to back before
+    the replies are read.
+    """
+    def put_many(self, jobs):
+        """
+        Puts (tube, body, priority, delay) tuples and returns the inserted
+        job ids. use is only sent when the tube changes, so sort jobs by
+        tube first. A CommandFailed carries the ids inserted before it as
+        its jids attribute.
+        """
+        jids = []
+        using = None
+        for i in range(0, len(jobs), config.BATCH_PIPELINE_SIZE):
+            commands = []
+            expected = []
+            for tube, body, priority, delay in \
+                    jobs[i:i + config.BATCH_PIPELINE_SIZE]:
+                if tube != using:
+                    commands.append('use %s\r\n' % tube)
+                    expected.append(('use', 'USING'))
+                    using = tube
+                commands.append('put %d %d %d %d\r\n%s\r\n' % (
+                    priority, delay, beanstalkc.DEFAULT_TTR, len(body),
+                    body))
+                expected.append(('put', 'INSERTED'))
+            beanstalkc.SocketError.wrap(
+                self._socket.sendall, ''.join(commands))
+
+            # read every reply to keep the connection in sync before failing
+            failed = None
+            for command, status in expected:
+                reply, results = self._read_response()
+                if reply != status:
+                    failed = failed or beanstalkc.CommandFailed(
+                        command, reply, results)
+                elif reply == 'INSERTED':
+                    jids.append(int(results[0]))
+            if failed:
+                failed.jids = jids
+                raise failed
+        return jids
+
+    def reserve_many(self, count):
+        """
+        Reserves up to count jobs ready now, without waiting. Rounds of
+        reserves double from one, so an empty tube costs one command.
+        """
+        jobs = []
+        chunk = 1
+        while len(jobs) < count:
+            chunk = min(chunk, count - len(jobs))
+            beanstalkc.SocketError.wrap(
+                self._socket.sendall, 'reserve-with-timeout 0\r\n' * chunk)
+            timed_out = False
+            for i in range(chunk):
+                reply, results = self._read_response()
+                if reply == 'RESERVED':
+                    body = self._read_body(int(results[1]))
+                    jobs.append(beanstalkc.Job(self, int(results[0]), body))
+                else:
+                    # TIMED_OUT, or DEADLINE_SOON of a job reserved before
+                    timed_out = True
+            if timed_out:
+                break
+            chunk = min(chunk * 2, config.BATCH_PIPELINE_SIZE)
+        return jobs
+
+    def delete_many(self, jids):
+        """
+        Deletes jobs by id and returns how many were deleted. Jobs
+        reserved by another connection or already gone are left alone.
+        """
+        deleted = 0
+        for i in range(0, len(jids), config.BATCH_PIPELINE_SIZE):
+            chunk = jids[i:i + config.BATCH_PIPELINE_SIZE]
+            beanstalkc.SocketError.wrap(
+                self._socket.sendall,
+                ''.join('delete %d\r\n' % jid for jid in chunk))
+            for jid in chunk:
+                reply, results = self._read_response()
+                if reply == 'DELETED':
+                    deleted += 1
+        return deleted
+
+
+def delete_queued(beanstalk, jobs):
+    """
+    Deletes the (jid, tube) jobs still waiting in their tube, returns how
+    many were deleted. Ids of a beanstalkd restarted without a binlog
+    start over, so an old id may be another tube's job by now.
+    """
+    jids = []
+    for jid, tube in jobs:
+        try:
+            stats = beanstalk.stats_job(jid)
+        except beanstalkc.CommandFailed:
+            # gone already
+            continue
+        if stats['tube'] == tube and stats['state'] in ('ready', 'delayed'):
+            jids.append(jid)
+    if not jids:
+        return 0
+    return beanstalk.delete_many(jids)
+
+
+def connect(host=None, port=None):
+    """
+    Returns a connection to the job queue of QUEUE_BACKEND: beanstalkd at
+    host and port, BEANSTALKD_HOST and BEANSTALKD_PORT by default, or the
+    local queue of the process. Both speak the beanstalkc interface
+    besides the batch commands, raising its errors.
+    """
+    if config.QUEUE_BACKEND == 'local':
+        return local_queue.connect()
+    return BeanstalkConnection(
+        host or config.BEANSTALKD_HOST, port or config.BEANSTALKD_PORT)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import fcntl
+import mmap
+import os
+from struct import Struct
+from threading import Lock
+import time
+
+import config
+
+
+class TokenBucket(object):
+    """
+    Holds up to burst tokens, refilled at rate per second. take may
+    overdraw it, so a batch is never split, and returns how long the
+    caller has to wait for the debt to be paid off.
+    """
+    def __init__(self, rate, burst):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = Lock()
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            state = [self._tokens, self._updated]
+            yield state
+            self._tokens, self._updated = state
+
+    def _refill(self, state):
+        now = time.time()
+        tokens, updated = state
+        state[0] = min(self.burst, tokens + (now - updated) * self.rate)
+        state[1] = now
+
+    def take(self, count):
+        """Takes count tokens, returns the seconds to wait before use"""
+        with self._state() as state:
+            self._refill(state)
+            state[0] -= count
+            tokens = state[0]
+        return max(0.0, -tokens / self.rate)
+
+    def available(self):
+        """The tokens left, negative while in debt"""
+        with self._state() as state:
+            self._refill(state)
+            return state[0]
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A TokenBucket kept in a small mmap'd file, shared by every process
+    opening the same path. Updates hold an flock on the file.
+    """
+    STATE = Struct('=dd')  # tokens, last refill
+
+    def __init__(self, path, rate, burst):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.STATE.size:
+                os.ftruncate(self._fd, self.STATE.size)
+                os.write(self._fd, self.STATE.pack(self.burst, time.time()))
+            self._map = mmap.mmap(self._fd, self.STATE.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __del__(self):
+        # once dropped by a reload and no limiter holds it
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            os.close(self._fd)
+
+    @contextmanager
+    def _state(self):
+        # flock doesn't exclude the threads of a process, sharing the fd
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = list(self.STATE.unpack_from(self._map))
+                yield state
+                self.STATE.pack_into(self._map, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RateLimiter(object):
+    """
+    The token buckets of one app by priority, the None bucket applying
+    to every priority. Notifications of priorities without a bucket
+    aren't limited. priorities are those of the jobs taken under the
+    limiter, all of PRIORITIES by default: jobs can be taken while any
+    of them has tokens left.
+    """
+    def __init__(self, buckets, priorities=None):
+        super(RateLimiter, self).__init__()
+        self.buckets = buckets
+        if priorities is None:
+            priorities = config.PRIORITIES
+        self.priorities = list(priorities)
+
+    def _bucket(self, priority):
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets.get(None)
+        return bucket
+
+    def take(self, priority, count):
+        """Takes count notifications, returns the seconds to wait"""
+        bucket = self._bucket(priority)
+        if bucket is None:
+            return 0.0
+        return bucket.take(count)
+
+    def available(self):
+        """
+        The tokens left for the priority with the most, infinite if one
+        isn't limited, negative while all are in debt.
+        """
+        available = float('-inf')
+        for priority in self.priorities:
+            bucket = self._bucket(priority)
+            if bucket is None:
+                return float('inf')
+            available = max(available, bucket.available())
+        return available
+
+    def wait(self):
+        """Seconds until a priority's bucket is out of debt"""
+        wait = float('inf')
+        for priority in self.priorities:
+            bucket = self._bucket(priority)
+            if bucket is None:
+                return 0.0
+            wait = min(wait, max(0.0, -bucket.available() / bucket.rate))
+        return wait
+
+
+_buckets = {}
+_buckets_lock = Lock()
+
+
+def _get_bucket(app_name, priority, rate, burst):
+    key = (app_name, priority)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if config.RATE_LIMIT_SHARED_DIR:
+                path = os.path.join(
+                    config.RATE_LIMIT_SHARED_DIR,
+                    '%s.%s' % (app_name, priority or 'all'))
+                bucket = SharedTokenBucket(path, rate, burst)
+            else:
+                bucket = TokenBucket(rate, burst)
+            _buckets[key] = bucket
+        else:
+            # the limits of a reloaded config apply to the tokens left
+            bucket.rate = float(rate)
+            bucket.burst = float(burst)
+    return bucket
+
+
+def drop_buckets(app_name, keep=()):
+    """
+    Forgets the buckets of app_name but those of the priorities in keep,
+    limiters holding them keep working until they are replaced
+    """
+    with _buckets_lock:
+        for key in list(_buckets):
+            if key[0] == app_name and key[1] not in keep:
+                del _buckets[key]
+
+
+def get_limiter(app_name, priorities=None):
+    """
+    Returns a RateLimiter of app_name's RATE_LIMITS, over the buckets of
+    priorities only if given, or None if those aren't limited. The
+    buckets are shared by all limiters of the app in the process, or
+    across processes with RATE_LIMIT_SHARED_DIR.
+    """
+    limits = config.RATE_LIMITS.get(app_name)
+    if limits is None:
+        drop_buckets(app_name)
+        return None
+    if not isinstance(limits, dict):
+        limits = {None: limits}
+    drop_buckets(app_name, keep=limits)
+    buckets = {}
+    for priority, (rate, burst) in limits.items():
+        if priorities is not None and priority is not None and \
+                priority not in priorities:
+            continue
+        buckets[priority] = _get_bucket(app_name, priority, rate, burst)
+    if not buckets:
+        return None
+    return RateLimiter(buckets, priorities)
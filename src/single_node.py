@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from gevent import monkey
+monkey.patch_all()
+
+from threading import Thread
+
+from gevent.pywsgi import WSGIServer
+
+from app import app
+import batch_push
+import config
+import deliveries
+import logs
+import metrics
+import push
+
+
+# the api, batch workers and pushers of one host in one process, around
+# the local queue of QUEUE_BACKEND = 'local' which no other process can open
+if __name__ == '__main__':
+    logs.setup()
+    if config.PUSH_METRICS_PORT is not None:
+        metrics.serve(config.PUSH_METRICS_PORT)
+    push.delivery_log = deliveries.open_log('push')
+    args = (config.BEANSTALKD_HOST, config.BEANSTALKD_PORT)
+    for i in range(config.BATCH_WORKER_COUNT):
+        t = Thread(
+            target=batch_push.batch_push, args=args, name='worker.%d' % i)
+        t.start()
+    server = WSGIServer(('0.0.0.0', config.SINGLE_NODE_PORT), app)
+    server.start()
+    if config.PUSH_ENGINE == 'gevent':
+        engine = push.Engine(config.APPS)
+        engine.handle_signals(lambda: push.reload_config().APPS)
+        engine.run()
+    else:
+        push.start_threads(config.APPS)
+        server.serve_forever()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect
+from collections import Counter
+from hashlib import md5
+import json
+import logging
+import os
+import select
+import signal
+import sys
+import time
+
+import config
+import logs
+
+
+log = logs.get_logger('supervisor')
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes, with virtual replicas"""
+    def __init__(self, nodes, replicas=100):
+        super(HashRing, self).__init__()
+        ring = sorted(
+            (self._hash('%s:%d' % (node, i)), node)
+            for node in nodes for i in range(replicas))
+        self._keys = [key for key, node in ring]
+        self._nodes = [node for key, node in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        i = bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+def shard_apps(apps, worker_count):
+    ring = HashRing(range(worker_count))
+    shards = [{} for i in range(worker_count)]
+    for app_name, app_config in apps.items():
+        shards[ring.get_node(app_name)][app_name] = app_config
+    return shards
+
+
+def run_worker(index, apps, report_fd):
+    # gevent is only imported and patched in the forked worker
+    import deliveries
+    import gevent
+    import metrics
+    import push
+
+    logs.setup()
+    # one writer per process, the api reads the aggregates of them all
+    push.delivery_log = deliveries.open_log('push.%d' % index)
+
+    def report():
+        while True:
+            line = json.dumps(dict(
+                worker=index, pid=os.getpid(), stats=push.stats))
+            os.write(report_fd, line + '\n')
+            gevent.sleep(config.SUPERVISOR_REPORT_INTERVAL)
+
+    log.info('Worker %d serves %s', index, ', '.join(sorted(apps)))
+    if config.PUSH_METRICS_PORT is not None:
+        metrics.serve(config.PUSH_METRICS_PORT + 1 + index)
+    if config.PUSH_ENGINE == 'gevent':
+        def load_apps():
+            # the supervisor stops workers its new shards leave out
+            shards = shard_apps(
+                push.reload_config().APPS, config.PUSH_WORKER_COUNT)
+            return shards[index] if index < len(shards) else {}
+
+        engine = push.Engine(apps)
+        engine.handle_signals(load_apps)
+        gevent.spawn(report)
+        engine.run()
+    else:
+        push.start_threads(apps)
+        report()
+
+
+class Supervisor(object):
+    """
+    Forks one pusher process per shard of APPS, restarts the ones that
+    die and aggregates the stats they report over a pipe.
+
+    SIGHUP reloads the config and reshards APPS. Workers of a shard
+    reload theirs in place, or with the thread engine are restarted,
+    workers beyond PUSH_WORKER_COUNT are stopped and new ones started.
+    """
+    def __init__(self, apps, worker_count):
+        super(Supervisor, self).__init__()
+        self.shards = shard_apps(apps, worker_count)
+        self.workers = {}
+        self.readers = {}
+        self.buffers = {}
+        self.stats = {}
+        self.restarts = {}
+        self.last_report = time.time()
+
+    def spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            status = 1
+            try:
+                run_worker(index, self.shards[index], write_fd)
+                status = 0
+            except Exception as e:
+                log.critical('Worker %d crashed: %s', index, e)
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        self.workers[pid] = index
+        self.readers[read_fd] = index
+        self.buffers[read_fd] = ''
+        log.info('Started worker %d with pid %d', index, pid)
+
+    def read_reports(self, timeout):
+        try:
+            rlist, _, _ = select.select(self.readers.keys(), [], [], timeout)
+        except select.error:
+            return
+        for fd in rlist:
+            data = os.read(fd, 65536)
+            if not data:
+                os.close(fd)
+                del self.readers[fd]
+                del self.buffers[fd]
+                continue
+            lines = (self.buffers[fd] + data).split('\n')
+            self.buffers[fd] = lines.pop()
+            for line in lines:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    continue
+                self.stats[report['worker']] = report['stats']
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            index = self.workers.pop(pid)
+            self.stats.pop(index, None)
+            if not self.serves(index):
+                log.info('Worker %d (pid %d) stopped', index, pid)
+                continue
+            log.error(
+                'Worker %d (pid %d) exited with status %d',
+                index, pid, status)
+            self.restarts[index] = \
+                time.time() + config.SUPERVISOR_RESTART_DELAY
+
+    def serves(self, index):
+        """Whether the worker index has a shard of APPS"""
+        return index < len(self.shards) and bool(self.shards[index])
+
+    def restart(self):
+        for index, restart_time in self.restarts.items():
+            if not self.serves(index):
+                del self.restarts[index]
+            elif time.time() >= restart_time:
+                del self.restarts[index]
+                self.spawn(index)
+
+    def log_stats(self):
+        if time.time() - self.last_report < config.SUPERVISOR_REPORT_INTERVAL:
+            return
+        self.last_report = time.time()
+        total = Counter()
+        for worker_stats in self.stats.values():
+            total.update(worker_stats)
+        log.info('Workers: %d, stats: %s',
+                 len(self.workers), json.dumps(total, sort_keys=True))
+
+    def stop(self, signum, frame):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    def reload(self, signum, frame):
+        try:
+            reload(config)
+        except Exception as e:
+            log.error('Failed to reload config: %s', e)
+            return
+        self.shards = shard_apps(config.APPS, config.PUSH_WORKER_COUNT)
+        log.info('Reload config, %d workers', len(self.shards))
+        running = set()
+        for pid, index in self.workers.items():
+            running.add(index)
+            try:
+                if self.serves(index) and config.PUSH_ENGINE == 'gevent':
+                    os.kill(pid, signal.SIGHUP)
+                else:
+                    # restarted by reap if it still has a shard
+                    os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for index in range(len(self.shards)):
+            if self.serves(index) and index not in running and \
+                    index not in self.restarts:
+                self.spawn(index)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for index, apps in enumerate(self.shards):
+            if apps:
+                self.spawn(index)
+        while True:
+            self.read_reports(1)
+            self.reap()
+            self.restart()
+            self.log_stats()
+
+
+if __name__ == '__main__':
+    logs.setup()
+    Supervisor(config.APPS, config.PUSH_WORKER_COUNT).run()
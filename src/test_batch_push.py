@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import beanstalkc
+
+import batch_push
+import config
+import local_queue
+
+
+class DrainingConnection(local_queue.LocalConnection):
+    """A connection whose put_many fails after puts jobs"""
+    puts = None
+
+    def put_many(self, jobs):
+        if self.puts is None or len(jobs) <= self.puts:
+            return super(DrainingConnection, self).put_many(jobs)
+        jids = super(DrainingConnection, self).put_many(jobs[:self.puts])
+        e = beanstalkc.CommandFailed('put', 'DRAINING', [])
+        e.jids = jids
+        raise e
+
+
+class ExpandJobTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = local_queue.LocalQueue(self.directory, 1024 * 1024)
+        self.beanstalk = DrainingConnection(self.queue)
+        self.beanstalk.use(config.BATCH_PUSH_TUBE)
+        self.beanstalk.watch(config.BATCH_PUSH_TUBE)
+
+    def tearDown(self):
+        self.beanstalk.close()
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def push_job(self, alert):
+        return dict(
+            app_name='test_app', device_token='%064x' % 1,
+            payload=dict(alert=alert))
+
+    def test_failed_put_leaves_no_job(self):
+        jid = self.beanstalk.put(json.dumps([
+            self.push_job('Hello'), self.push_job('Hello again'),
+            self.push_job('Bye')]))
+        job = self.beanstalk.reserve(timeout=0)
+        self.beanstalk.puts = 2
+        batch_push.expand_job(self.beanstalk, job, config.BATCH_PUSH_TUBE)
+        self.assertEqual(self.queue.stats_job(jid)['state'], 'buried')
+        stats = self.queue.stats()
+        self.assertEqual(stats['current-jobs-ready'], 0)
+        # the batch, then the two jobs put before the failure
+        self.assertEqual(stats['total-jobs'], 3)
+
+    def test_expand(self):
+        self.beanstalk.put(json.dumps([
+            self.push_job('Hello'), self.push_job('Hello again')]))
+        job = self.beanstalk.reserve(timeout=0)
+        batch_push.expand_job(self.beanstalk, job, config.BATCH_PUSH_TUBE)
+        stats = self.queue.stats_tube(config.PUSH_TUBE % 'test_app')
+        self.assertEqual(stats['current-jobs-ready'], 2)
+        self.assertIsNone(self.queue.stats_job(job.jid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import config
+import deliveries
+
+
+class DeliveryLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = config.DELIVERY_LOG_DIR
+        config.DELIVERY_LOG_DIR = self.directory
+        self.log = deliveries.DeliveryLog(
+            self.directory, 'test', segment_bytes=4096,
+            minutes=config.DELIVERY_AGGREGATE_MINUTES,
+            apps=config.DELIVERY_AGGREGATE_APPS)
+        self.tokens = ['%064x' % i for i in range(10)]
+
+    def tearDown(self):
+        self.log.close()
+        config.DELIVERY_LOG_DIR = self.saved
+        shutil.rmtree(self.directory)
+
+    def summary(self):
+        return deliveries.summary('test_app', 60)
+
+    def test_sent_and_failed_are_disjoint(self):
+        now = time.time()
+        self.log.append('test_app', [
+            (1, token, now - 0.7, now, deliveries.SENT)
+            for token in self.tokens])
+        # an error response for a written notification
+        self.log.append(
+            'test_app', [(0, self.tokens[3], 0, now, 8)], correction=True)
+        # an HTTP/2 failure, recorded once
+        self.log.append('test_app', [(2, self.tokens[0], now, now, 410)])
+        summary = self.summary()
+        self.assertEqual(summary['sent'], 9)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual(summary['p50'], 1)
+
+    def test_segments_roll(self):
+        now = time.time()
+        capacity = self.log.capacity
+        self.log.append('test_app', [
+            (1, self.tokens[0], now, now, deliveries.SENT)
+            for i in range(capacity + 1)])
+        self.assertEqual(self.log.number, 1)
+        self.assertEqual(self.log.count, 1)
+        self.assertEqual(self.summary()['sent'], capacity + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import beanstalkc
+
+import local_queue
+
+
+class LocalQueueTest(unittest.TestCase):
+    tube = 'ios_push.test_app'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = None
+        self.connections = []
+        self.open()
+
+    def tearDown(self):
+        self.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, segment_bytes=1024 * 1024):
+        self.queue = local_queue.LocalQueue(self.directory, segment_bytes)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.queue.close()
+
+    def connect(self):
+        connection = local_queue.LocalConnection(self.queue)
+        connection.use(self.tube)
+        connection.watch(self.tube)
+        connection.ignore('default')
+        self.connections.append(connection)
+        return connection
+
+    def segments(self):
+        return sorted(
+            path for path in os.listdir(self.directory)
+            if path.endswith('.log'))
+
+    def test_reserve_by_priority(self):
+        connection = self.connect()
+        connection.put('low', priority=2000)
+        connection.put('high', priority=10)
+        connection.put('high again', priority=10)
+        bodies = [connection.reserve(timeout=0).body for i in range(3)]
+        self.assertEqual(bodies, ['high', 'high again', 'low'])
+        self.assertIsNone(connection.reserve(timeout=0))
+
+    def test_ttr_expiry(self):
+        connection = self.connect()
+        jid = connection.put('job', ttr=1)
+        self.assertEqual(connection.reserve(timeout=0).jid, jid)
+        other = self.connect()
+        self.assertIsNone(other.reserve(timeout=0))
+        job = other.reserve(timeout=2)
+        self.assertEqual(job.jid, jid)
+        self.assertEqual(self.queue.stats_job(jid)['timeouts'], 1)
+
+    def test_touch(self):
+        connection = self.connect()
+        jid = connection.put('job', ttr=1)
+        connection.reserve(timeout=0)
+        time.sleep(0.6)
+        connection.touch(jid)
+        other = self.connect()
+        # the first deadline has passed, the touched one has not
+        time.sleep(0.6)
+        self.assertIsNone(other.reserve(timeout=0))
+        self.assertEqual(other.reserve(timeout=1).jid, jid)
+        self.assertRaises(beanstalkc.CommandFailed, connection.touch, jid)
+
+    def test_release_with_delay(self):
+        connection = self.connect()
+        jid = connection.put('job')
+        connection.reserve(timeout=0)
+        connection.release(jid, priority=5, delay=1)
+        stats = self.queue.stats_job(jid)
+        self.assertEqual(stats['state'], 'delayed')
+        self.assertEqual(stats['pri'], 5)
+        self.assertIsNone(connection.reserve(timeout=0))
+        self.assertEqual(connection.reserve(timeout=2).jid, jid)
+
+    def test_put_with_delay(self):
+        connection = self.connect()
+        jid = connection.put('job', delay=1)
+        self.assertEqual(
+            connection.stats_tube(self.tube)['current-jobs-delayed'], 1)
+        self.assertIsNone(connection.reserve(timeout=0))
+        self.assertEqual(connection.reserve(timeout=2).jid, jid)
+
+    def test_bury(self):
+        connection = self.connect()
+        jid = connection.put('job')
+        connection.reserve(timeout=0)
+        connection.bury(jid)
+        self.assertEqual(self.queue.stats_job(jid)['state'], 'buried')
+        self.assertIsNone(connection.reserve(timeout=0))
+        self.assertRaises(beanstalkc.CommandFailed, connection.release, jid)
+        connection.delete(jid)
+        self.assertIsNone(self.queue.stats_job(jid))
+
+    def test_put_too_big(self):
+        self.close()
+        self.open(segment_bytes=4096)
+        connection = self.connect()
+        jobs = [(self.tube, 'job', 1024, 0), (self.tube, 'x' * 4096, 1024, 0)]
+        with self.assertRaises(beanstalkc.CommandFailed) as context:
+            connection.put_many(jobs)
+        self.assertEqual(len(context.exception.jids), 1)
+        job = connection.reserve(timeout=0)
+        self.assertEqual(job.jid, context.exception.jids[0])
+
+    def test_close_releases_reserved(self):
+        connection = self.connect()
+        jid = connection.put('job')
+        connection.reserve(timeout=0)
+        other = self.connect()
+        self.assertIsNone(other.reserve(timeout=0))
+        connection.close()
+        self.assertEqual(other.reserve(timeout=0).jid, jid)
+
+    def test_replay(self):
+        connection = self.connect()
+        jids = [connection.put('job %d' % i) for i in range(5)]
+        connection.delete(jids[0])
+        connection.reserve(timeout=0)  # jids[1]
+        connection.release(jids[1], priority=3, delay=3600)
+        connection.reserve(timeout=0)  # jids[2]
+        connection.bury(jids[2])
+        connection.reserve(timeout=0)  # jids[3], reservations end
+        self.close()
+        self.open()
+        states = dict(
+            (jid, self.queue.stats_job(jid)) for jid in jids)
+        self.assertIsNone(states[jids[0]])
+        self.assertEqual(states[jids[1]]['state'], 'delayed')
+        self.assertEqual(states[jids[1]]['pri'], 3)
+        self.assertEqual(states[jids[2]]['state'], 'buried')
+        self.assertEqual(states[jids[3]]['state'], 'ready')
+        self.assertEqual(states[jids[4]]['state'], 'ready')
+        connection = self.connect()
+        self.assertEqual(connection.reserve(timeout=0).body, 'job 3')
+        self.assertGreater(connection.put('job 5'), jids[-1])
+
+    def test_compaction(self):
+        self.close()
+        self.open(segment_bytes=4096)
+        connection = self.connect()
+        buried = connection.put('buried')
+        connection.reserve(timeout=0)
+        connection.bury(buried)
+        for i in range(500):
+            jid = connection.put('x' * 100)
+            connection.delete(jid)
+        # the buried job is written again instead of pinning every segment
+        self.assertLessEqual(len(self.segments()), 2)
+        self.close()
+        self.open(segment_bytes=4096)
+        self.assertEqual(self.queue.stats_job(buried)['state'], 'buried')
+        self.assertEqual(self.queue.stats()['current-jobs-ready'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import time
+import unittest
+
+import apns
+import codec
+import config
+import invalid_tokens
+import local_queue
+import push
+
+
+def split_frames(data):
+    """Returns the frames of encoded notifications"""
+    frames = []
+    offset = 0
+    while offset < len(data):
+        length = apns.NOTIFICATION_HEADER.size + \
+            apns.NOTIFICATION_HEADER.unpack_from(data, offset)[-1]
+        frames.append(data[offset:offset + length])
+        offset += length
+    return frames
+
+
+class FakeGateway(object):
+    """A binary gateway connection whose writes fail after `writes`"""
+    def __init__(self, writes):
+        super(FakeGateway, self).__init__()
+        self.encoder = apns.NotificationEncoder()
+        self.writes = writes
+        self.tokens = []
+
+    def write(self, data):
+        if not self.writes:
+            raise socket.error(errno.EPIPE, 'Broken pipe')
+        self.writes -= 1
+        self.tokens.extend(
+            apns.parse_notification(frame)[2]
+            for frame in split_frames(data))
+
+    def read(self, length, timeout=None):
+        # closed without an error response
+        return ''
+
+    def reconnect(self):
+        raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
+
+class FakeHTTP2Gateway(object):
+    """An HTTP/2 gateway connection lost after `answers` responses"""
+    def __init__(self, answers):
+        super(FakeHTTP2Gateway, self).__init__()
+        self.answers = answers
+
+    def send_notifications(self, notifications):
+        results = [(200, None)] * self.answers + \
+            [None] * (len(notifications) - self.answers)
+        e = socket.error('Connection closed by the gateway')
+        e.results = results
+        raise e
+
+
+class PushJobTest(unittest.TestCase):
+    tube = 'ios_push.test_app'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = dict(
+            INVALID_TOKENS_FILE=config.INVALID_TOKENS_FILE,
+            PUSH_BATCH_MAX_BYTES=config.PUSH_BATCH_MAX_BYTES)
+        config.INVALID_TOKENS_FILE = os.path.join(
+            self.directory, 'invalid_tokens')
+        invalid_tokens._store = None
+        self.queue = local_queue.LocalQueue(
+            os.path.join(self.directory, 'queue'), 1024 * 1024)
+        self.pipe = push.Pipe(
+            None, None, self.tube, None, None, None, None, True,
+            linger_ms=0)
+        self.pipe.beanstalk = local_queue.LocalConnection(self.queue)
+        self.pipe.beanstalk.use(self.tube)
+        self.pipe.beanstalk.watch(self.tube)
+        self.pipe.beanstalk.ignore('default')
+        self.tokens = ['%064x' % i for i in range(10)]
+
+    def tearDown(self):
+        self.pipe.beanstalk.close()
+        self.queue.close()
+        invalid_tokens._store = None
+        for name, value in self.saved.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.directory)
+
+    def push_failing(self, writes, **job):
+        """Pushes a broadcast job through a gateway failing after writes"""
+        job = dict(
+            job, app_name='test_app', device_tokens=self.tokens,
+            payload=dict(alert='Hello'))
+        jid = self.pipe.beanstalk.put(codec.encode(job))
+        # a write every three frames
+        frame_size = apns.NOTIFICATION_HEADER.size + len(
+            push.payload_cache.get(job['payload']))
+        config.PUSH_BATCH_MAX_BYTES = 3 * frame_size
+        self.pipe.gateway_connection = FakeGateway(writes)
+        self.assertRaises(socket.error, self.pipe.push_job)
+        return jid
+
+    def reserve_body(self, timeout=0):
+        job = self.pipe.beanstalk.reserve(timeout=timeout)
+        self.assertIsNotNone(job)
+        body = codec.decode(job.body)
+        job.delete()
+        self.assertIsNone(self.pipe.beanstalk.reserve(timeout=0))
+        return job.jid, body
+
+    def test_broadcast_cut_mid_write(self):
+        jid = self.push_failing(2, badges=range(10))
+        written = self.pipe.gateway_connection.tokens
+        self.assertEqual(written, self.tokens[:6])
+        new_jid, body = self.reserve_body()
+        self.assertNotEqual(new_jid, jid)
+        self.assertEqual(body['device_tokens'], self.tokens[6:])
+        self.assertEqual(body['badges'], range(6, 10))
+
+    def test_nothing_written_is_released(self):
+        jid = self.push_failing(0)
+        self.assertEqual(self.pipe.gateway_connection.tokens, [])
+        released_jid, body = self.reserve_body()
+        self.assertEqual(released_jid, jid)
+        self.assertEqual(body['device_tokens'], self.tokens)
+
+    def test_http2_unanswered_retried(self):
+        jid = self.pipe.beanstalk.put(codec.encode(dict(
+            app_name='test_app', device_tokens=self.tokens,
+            badges=range(10), payload=dict(alert='Hello'))))
+        self.pipe.gateway_connection = FakeHTTP2Gateway(4)
+        self.assertRaises(socket.error, self.pipe.push_job_http2)
+        # retried after a second
+        new_jid, body = self.reserve_body(timeout=2)
+        self.assertNotEqual(new_jid, jid)
+        self.assertEqual(body['device_tokens'], self.tokens[4:])
+        self.assertEqual(body['badges'], range(4, 10))
+        self.assertEqual(body['retries'], 1)
+
+    def test_invalid_badges_buried(self):
+        for badges, payload in (
+                (['1'] * 10, dict(alert='Hello')),
+                (range(9), dict(alert='Hello')),
+                (range(10), dict(custom=dict(aps=dict(alert='Hello'))))):
+            jid = self.pipe.beanstalk.put(codec.encode(dict(
+                app_name='test_app', device_tokens=self.tokens,
+                badges=badges, payload=payload)))
+            self.pipe.gateway_connection = FakeGateway(1)
+            self.pipe.push_job()
+            self.assertEqual(self.pipe.gateway_connection.tokens, [])
+            self.assertEqual(
+                self.pipe.beanstalk.stats_job(jid)['state'], 'buried')
+
+    def test_broken_tls_session_closes(self):
+        self.pipe.gateway_connection = FakeGateway(0)
+        for error, closed in (
+                (socket.timeout('timed out'), False),
+                (ssl.SSLError('The read operation timed out'), False),
+                (ssl.SSLError(ssl.SSL_ERROR_WANT_READ, 'want read'), False),
+                (ssl.SSLError(ssl.SSL_ERROR_SSL, 'bad record mac'), True)):
+            def read(length, timeout=None):
+                raise error
+            self.pipe.gateway_connection.read = read
+            self.assertEqual(self.pipe.process_gateway_input(), closed)
+
+    def test_resend_requeued_without_gateway(self):
+        payload = push.payload_cache.get(dict(alert='Hello'))
+        expiry = int(time.time()) + 3600
+        encoder = apns.NotificationEncoder()
+        for i, token in enumerate(self.tokens):
+            encoder.add(token, payload, i, expiry)
+        self.pipe.resend = split_frames(encoder.getvalue().tobytes())
+        self.pipe.gateway_connection = FakeGateway(0)
+        self.pipe.flush_resend()
+        self.assertEqual(self.pipe.resend, [])
+        jid, body = self.reserve_body()
+        self.assertEqual(body['device_tokens'], self.tokens)
+        self.assertEqual(push.payload_cache.get(body['payload']), payload)
+        self.assertAlmostEqual(body['expire_seconds'], 3600, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import config
+import invalid_tokens
+import push
+import ratelimit
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_overdraft_wait(self):
+        bucket = ratelimit.TokenBucket(10, 10)
+        self.assertEqual(bucket.take(5), 0)
+        # a batch is never split, the debt is paid off at rate
+        self.assertAlmostEqual(bucket.take(10), 0.5, delta=0.01)
+        self.assertAlmostEqual(bucket.available(), -5, delta=0.1)
+
+    def test_refill_up_to_burst(self):
+        bucket = ratelimit.TokenBucket(10, 20)
+        bucket.take(15)
+        bucket._updated -= 1
+        self.assertAlmostEqual(bucket.available(), 15, delta=0.1)
+        bucket._updated -= 100
+        self.assertEqual(bucket.available(), 20)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test_app.all')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_state(self):
+        first = ratelimit.SharedTokenBucket(self.path, 10, 10)
+        first.take(8)
+        # opening the file again keeps the tokens taken
+        second = ratelimit.SharedTokenBucket(self.path, 10, 10)
+        self.assertAlmostEqual(second.available(), 2, delta=0.1)
+        self.assertAlmostEqual(second.take(4), 0.2, delta=0.01)
+        self.assertAlmostEqual(first.available(), -2, delta=0.1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    priorities = ('high', 'low')
+
+    def test_fallback_bucket(self):
+        high = ratelimit.TokenBucket(10, 10)
+        default = ratelimit.TokenBucket(100, 100)
+        limiter = ratelimit.RateLimiter(
+            {'high': high, None: default}, self.priorities)
+        limiter.take('low', 50)
+        limiter.take('high', 5)
+        self.assertAlmostEqual(default.available(), 50, delta=0.1)
+        self.assertAlmostEqual(high.available(), 5, delta=0.1)
+
+    def test_unlimited_priority(self):
+        high = ratelimit.TokenBucket(10, 10)
+        limiter = ratelimit.RateLimiter({'high': high}, self.priorities)
+        self.assertEqual(limiter.take('low', 1000), 0)
+        high.take(20)
+        # low jobs can still be taken
+        self.assertEqual(limiter.available(), float('inf'))
+        self.assertEqual(limiter.wait(), 0)
+        limiter = ratelimit.RateLimiter({'high': high}, ('high',))
+        self.assertLess(limiter.available(), 0)
+        self.assertAlmostEqual(limiter.wait(), 1, delta=0.01)
+
+    def test_throttled_while_all_in_debt(self):
+        high = ratelimit.TokenBucket(10, 10)
+        low = ratelimit.TokenBucket(1, 10)
+        limiter = ratelimit.RateLimiter(
+            {'high': high, 'low': low}, self.priorities)
+        low.take(20)
+        self.assertAlmostEqual(limiter.available(), 10, delta=0.1)
+        self.assertEqual(limiter.wait(), 0)
+        high.take(15)
+        self.assertLess(limiter.available(), 0)
+        # the first bucket out of debt
+        self.assertAlmostEqual(limiter.wait(), 0.5, delta=0.01)
+
+
+class PipeLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = config.INVALID_TOKENS_FILE
+        config.INVALID_TOKENS_FILE = os.path.join(
+            self.directory, 'invalid_tokens')
+        invalid_tokens._store = None
+        self.bucket = ratelimit.TokenBucket(100, 100)
+        self.pipe = push.Pipe(
+            None, None, 'ios_push.test_app', None, None, None, None, True,
+            limiter=ratelimit.RateLimiter({None: self.bucket}))
+
+    def tearDown(self):
+        invalid_tokens._store = None
+        config.INVALID_TOKENS_FILE = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_reserve_limit(self):
+        self.assertEqual(
+            self.pipe.reserve_limit(),
+            min(config.PUSH_BATCH_SIZE, 100))
+        # jobs of 10 notifications
+        self.pipe.tokens_per_job = 10.0
+        self.bucket.take(50)
+        self.assertEqual(self.pipe.reserve_limit(), 5)
+        self.pipe.limiter = None
+        self.assertEqual(self.pipe.reserve_limit(), config.PUSH_BATCH_SIZE)
+
+    def test_reserve_nothing_in_debt(self):
+        self.bucket.take(105)
+        start = time.time()
+        self.assertEqual(self.pipe.reserve_limit(), 0)
+        self.assertAlmostEqual(time.time() - start, 0.05, delta=0.03)
+
+    def test_take_tokens(self):
+        self.assertEqual(self.pipe.take_tokens(dict(), 100), 0)
+        throttled = push.throttled_seconds_total.get(
+            ('ios_push.test_app',))
+        wait = self.pipe.take_tokens(dict(priority='high'), 50)
+        self.assertAlmostEqual(wait, 0.5, delta=0.01)
+        self.assertAlmostEqual(
+            push.throttled_seconds_total.get(('ios_push.test_app',)),
+            throttled + wait, delta=0.01)
+        # a moving average of the notifications per job
+        self.assertAlmostEqual(
+            self.pipe.tokens_per_job, 0.9 * (0.9 * 1 + 10) + 5)
+
+
+class GetLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(
+            RATE_LIMITS=config.RATE_LIMITS,
+            RATE_LIMIT_SHARED_DIR=config.RATE_LIMIT_SHARED_DIR)
+        config.RATE_LIMIT_SHARED_DIR = None
+        ratelimit._buckets.clear()
+
+    def tearDown(self):
+        ratelimit._buckets.clear()
+        for name, value in self.saved.items():
+            setattr(config, name, value)
+
+    def test_buckets_shared(self):
+        config.RATE_LIMITS = {'test_app': (10, 10)}
+        first = ratelimit.get_limiter('test_app')
+        second = ratelimit.get_limiter('test_app')
+        self.assertIs(first.buckets[None], second.buckets[None])
+        self.assertIsNone(ratelimit.get_limiter('other_app'))
+
+    def test_reload_changes_limits(self):
+        config.RATE_LIMITS = {'test_app': (10, 10)}
+        bucket = ratelimit.get_limiter('test_app').buckets[None]
+        bucket.take(10)
+        config.RATE_LIMITS = {'test_app': (1000, 1000)}
+        limiter = ratelimit.get_limiter('test_app')
+        self.assertEqual(limiter.buckets[None].rate, 1000.0)
+        self.assertEqual(limiter.buckets[None].burst, 1000.0)
+        # the tokens taken stay taken
+        self.assertLess(limiter.available(), 10)
+
+    def test_reload_drops_removed_limits(self):
+        config.RATE_LIMITS = {
+            'test_app': {'high': (10, 10), 'low': (1, 1)},
+            'other_app': (5, 5)}
+        ratelimit.get_limiter('test_app')
+        ratelimit.get_limiter('other_app')
+        config.RATE_LIMITS = {'test_app': {'high': (10, 10)}}
+        limiter = ratelimit.get_limiter('test_app')
+        self.assertEqual(limiter.buckets.keys(), ['high'])
+        self.assertIsNone(ratelimit.get_limiter('other_app'))
+        self.assertEqual(ratelimit._buckets.keys(), [('test_app', 'high')])
+
+    def test_drop_buckets(self):
+        config.RATE_LIMITS = {'test_app': (10, 10)}
+        bucket = ratelimit.get_limiter('test_app').buckets[None]
+        bucket.take(10)
+        ratelimit.drop_buckets('test_app')
+        self.assertEqual(ratelimit._buckets, {})
+        # a new app of the same name starts with a full bucket
+        limiter = ratelimit.get_limiter('test_app')
+        self.assertAlmostEqual(limiter.available(), 10, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()